@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import json
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "client", "backend"))
+from crypto import CryptoManager
+from crypto_pool import CryptoWorkerPool
+
+# КОНФИГУРАЦИЯ
+NUM_ROWS = 500      # Строк истории чата
+NUM_PROBES = 500    # Проб в "шторме"
+ROUNDS = 5
+
+def make_user() -> CryptoManager:
+    # Argon2 здесь не нужен: ключи из случайного seed
+    crypto = CryptoManager()
+    crypto.load_keys(os.urandom(32), os.urandom(32))
+    return crypto
+
+def best_of(fn) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+async def abest_of(fn) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        await fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def report(title: str, count: int, single: float, batched: float):
+    print(f"📊 {title}: {count} items")
+    print(f"   single calls : {count / single:10.1f} items/s")
+    print(f"   worker pool  : {count / batched:10.1f} items/s")
+    print(f"🏁 Speedup: x{single / batched:.1f}")
+
+async def main():
+    alice, bob = make_user(), make_user()
+    pool = CryptoWorkerPool()
+    print(f"🧵 Workers: {pool.workers}")
+
+    # 1. История чата: decrypt_db_field на каждую строку
+    rows = [alice.encrypt_db_field(f"message number {i} " * 8) for i in range(NUM_ROWS)]
+    single = best_of(lambda: [alice.decrypt_db_field(r) for r in rows])
+    batched = await abest_of(lambda: pool.decrypt_db_fields(alice, rows))
+    report("History decrypt", NUM_ROWS, single, batched)
+
+    # 2. Проверка подписей
+    sigs = [(alice.my_id, alice.my_id + f"{i}", alice.sign_data(alice.my_id + f"{i}")) for i in range(NUM_PROBES)]
+    single = best_of(lambda: [bob.verify_sig(*item) for item in sigs])
+    batched = await abest_of(lambda: pool.verify_many(bob, sigs))
+    report("Signature verify", NUM_PROBES, single, batched)
+
+    # 3. Пробы к нам: SealedBox auth + подпись, каждая отдельным заданием
+    auth = bob.encrypt_for_probe(alice.my_id, json.dumps({"sid": bob.my_id}))
+    sig = bob.sign_data(bob.my_id + alice.my_id)
+    single = best_of(lambda: [alice.open_probe_auth(auth, sig) for _ in range(NUM_PROBES)])
+    batched = await abest_of(lambda: asyncio.gather(*(pool.run(alice.open_probe_auth, auth, sig) for _ in range(NUM_PROBES))))
+    report("Probe auth open", NUM_PROBES, single, batched)
+
+    pool.shutdown()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import uuid
+import json
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "client", "backend"))
+from database import DatabaseManager
+
+# КОНФИГУРАЦИЯ
+NUM_PACKETS = 2000
+NUM_NEIGHBORS = 8
+
+async def relay_probe(db: DatabaseManager, from_peer: str):
+    """Повторяет набор записей, который делает нода при ретрансляции PROBE"""
+    pkt_id = str(uuid.uuid4())
+    packet = {"type": "PROBE", "id": pkt_id, "route_id": uuid.uuid4().hex, "metric": 1, "ttl": 19}
+    await db.mark_packet_seen(pkt_id)
+    await db.add_route(packet['route_id'], from_peer, packet['metric'] + 1)
+    await db.execute_write("""
+        INSERT INTO outbox (packet_id, next_hop_id, packet_json, exclude_peer)
+        VALUES (?, NULL, ?, ?)
+    """, (pkt_id, json.dumps(packet), from_peer))
+
+async def neighbor(db: DatabaseManager, peer_id: str, count: int):
+    for _ in range(count):
+        await relay_probe(db, peer_id)
+
+async def run_mode(group_commit: bool) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, "bench.db"), group_commit=group_commit)
+        await db.connect()
+        per_peer = NUM_PACKETS // NUM_NEIGHBORS
+        start = time.perf_counter()
+        await asyncio.gather(*(neighbor(db, f"peer{i}", per_peer) for i in range(NUM_NEIGHBORS)))
+        await db.flush_seen()
+        await db.flush()
+        elapsed = time.perf_counter() - start
+        await db.close()
+    return per_peer * NUM_NEIGHBORS / elapsed
+
+async def main():
+    print(f"📊 PROBE relay writes: {NUM_PACKETS} packets from {NUM_NEIGHBORS} neighbors")
+    direct = await run_mode(group_commit=False)
+    print(f"   commit per write : {direct:10.1f} packets/s")
+    grouped = await run_mode(group_commit=True)
+    print(f"   group commit     : {grouped:10.1f} packets/s")
+    print(f"🏁 Speedup: x{grouped / direct:.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
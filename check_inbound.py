@@ -0,0 +1,59 @@
+import os
+import sys
+import uuid
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "client", "backend"))
+from inbound import InboundQueues
+import wire
+
+# Проверка входящих очередей под перегрузкой: кадры пути DATA (DATA, FRAG, REFRESH) не теряются,
+# отбрасываются и вытесняются только кадры с одними PROBE. Код возврата 1 при потере.
+
+def make_packet(pkt_type: str) -> bytes:
+    packet = {"type": pkt_type, "id": str(uuid.uuid4()), "route_id": "ab" * 32, "ttl": 20, "content": ""}
+    if pkt_type == "PROBE":
+        packet.update(rev_id="cd" * 32, target_hash="ef" * 32, sig="", auth="")
+    if pkt_type == "FRAG":
+        packet.update(group=str(uuid.uuid4()), seq=0, count=3)
+    return wire.encode_packet(packet)
+
+async def check_kind(pkt_type: str, frames: int = 3, queue_size: int = 2) -> dict:
+    """queue_size кадров ждут заблокированный обработчик, остальные давят на очередь"""
+    release = asyncio.Event()
+    handled = []
+
+    async def handler(packets, peer_id):
+        await release.wait()
+        handled.extend(wire.packet_type(raw) for raw in packets)
+
+    inbound = InboundQueues(handler, queue_size=queue_size, workers=1)
+    # Первый кадр занимает обработчик, очередь заполняется следующими
+    puts = [asyncio.create_task(inbound.put("peer", [make_packet(pkt_type)])) for _ in range(frames + 1)]
+    await asyncio.sleep(0.05)
+    release.set()
+    await asyncio.wait_for(asyncio.gather(*puts), 2)
+    await asyncio.sleep(0.05)
+    stats = inbound.get_stats()["peers"]["peer"]
+    inbound.stop()
+    return {"handled": len(handled), "sent": frames + 1, "dropped": stats["dropped"], "evicted": stats["evicted"]}
+
+async def main() -> int:
+    ok = True
+    for pkt_type in ("DATA", "FRAG", "REFRESH", "PROBE"):
+        result = await check_kind(pkt_type)
+        lost = result["dropped"] + result["evicted"]
+        expect_loss = pkt_type == "PROBE"
+        passed = bool(lost) == expect_loss
+        mark = "✅" if passed else "❌"
+        print(f"   {mark} {pkt_type:8} handled {result['handled']}/{result['sent']}, dropped {result['dropped']}, "
+              f"evicted {result['evicted']}")
+        ok = ok and passed
+    if ok:
+        print("🏁 Inbound queues keep every DATA-path frame")
+        return 0
+    print("💥 DATA-path frames were lost under overload")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,37 @@
+import os
+import sys
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "client", "backend"))
+from database import DatabaseManager
+import migrations
+
+# Проверка схемы: каждый горячий запрос из migrations.HOT_QUERIES должен идти по индексу.
+# Код возврата 1, если какой-то запрос скатился в полный SCAN или сортировку во временном B-дереве.
+
+async def check_schema(schema: str, path: str) -> bool:
+    db = DatabaseManager(path, schema=schema, group_commit=False)
+    await db.connect()
+    report = await db.check_query_plans()
+    print(f"🗄️ {schema} schema v{db.schema_version}")
+    ok = True
+    for name, result in report.items():
+        mark = "❌" if result["full_scan"] else "✅"
+        print(f"   {mark} {name:20} {' | '.join(result['plan'])}")
+        ok = ok and not result["full_scan"]
+    await db.close()
+    return ok
+
+async def main() -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [await check_schema(schema, os.path.join(tmp, f"{schema}.db"))
+                   for schema in (migrations.SYSTEM, migrations.USER)]
+    if all(results):
+        print("🏁 All hot queries use indexes")
+        return 0
+    print("🏁 FAILED: full scans in hot queries")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
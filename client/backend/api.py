@@ -1,250 +1,404 @@
-import os
-import hashlib
-import json
-import uuid
-import time
-from datetime import datetime
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import RedirectResponse
-from pydantic import BaseModel
-from typing import Optional
-from nacl.public import PrivateKey
-from nacl.encoding import Base64Encoder
-
-from core import state
-from database import DatabaseManager
-from crypto import CryptoManager
-
-router = APIRouter()
-
-# --- Pydantic Models ---
-class LoginData(BaseModel):
-    username: str
-    password: str
-class ConnectData(BaseModel):
-    address: str
-class SendData(BaseModel):
-    target_id: str
-    text: str
-class RenameData(BaseModel):
-    target_id: str
-    name: Optional[str] = None
-class ReadChatData(BaseModel):
-    chat_id: str
-class RouteIdRequest(BaseModel):
-    sender_id: str
-    receiver_id: str
-
-# --- API ROUTES ---
-
-@router.get("/")
-async def root():
-    return RedirectResponse(url="/auth/login.html")
-
-# --- DEBUG ЭНДПОИНТЫ ДЛЯ ТЕСТОВ ---
-
-@router.get("/api/debug/packet/{pkt_id}")
-async def debug_packet_status(pkt_id: str):
-    """Проверяет статус пакета (был ли виден или в очереди)"""
-    if not state.system_db: return {"status": "offline"}
-    async with state.system_db.conn.execute("SELECT received_at FROM seen_packets WHERE packet_id = ?", (pkt_id,)) as cursor:
-        seen = await cursor.fetchone()
-    async with state.system_db.conn.execute("SELECT count(*) as cnt FROM outbox WHERE packet_id = ?", (pkt_id,)) as cursor:
-        outbox = await cursor.fetchone()
-    return {
-        "seen": bool(seen), 
-        "received_at": seen['received_at'] if seen else None, 
-        "in_outbox": outbox['cnt'] if outbox else 0
-    }
-
-@router.get("/api/debug/outbox")
-async def debug_get_outbox():
-    """Возвращает текущую очередь отправки"""
-    if not state.system_db: return []
-    async with state.system_db.conn.execute("SELECT * FROM outbox") as cursor:
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
-
-@router.get("/api/debug/routes")
-async def debug_get_routes():
-    """Возвращает таблицу маршрутизации"""
-    if not state.system_db: return []
-    async with state.system_db.conn.execute("SELECT * FROM routing_table WHERE expires_at > ?", (time.time(),)) as cursor:
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
-
-@router.post("/api/debug/get_route_ids")
-async def debug_get_route_ids(data: RouteIdRequest):
-    """Хелпер для тестов: вычисляет хеши маршрутов"""
-    if not state.crypto: return {}
-    return {
-        "route_fwd": state.crypto.get_route_id(data.sender_id, data.receiver_id),
-        "route_bwd": state.crypto.get_route_id(data.receiver_id, data.sender_id)
-    }
-
-# --- ОСНОВНЫЕ ЭНДПОИНТЫ ---
-
-@router.post("/api/login")
-async def login(data: LoginData):
-    crypto = CryptoManager()
-    crypto.derive_keys_from_password(data.username, data.password)
-    new_user_id = crypto.my_id
-    
-    if state.is_logged_in and state.user_id != new_user_id:
-        state.node.remove_active_user()
-        if state.db: await state.db.close()
-        state.is_logged_in = False
-    
-    if not state.is_logged_in:
-        await state.system_db.register_local_user(new_user_id)
-        
-        state.user_id = new_user_id
-        state.crypto = crypto
-        
-        state.db = DatabaseManager(f"node_{new_user_id}.db")
-        state.db.set_crypto(crypto)
-        await state.db.connect()
-        
-        state.node.set_active_user(new_user_id, state.db, crypto)
-        
-        # Загрузка офлайн сообщений
-        offline_packets = await state.system_db.fetch_mailbox(new_user_id)
-        if offline_packets:
-            for pkt_json in offline_packets:
-                try:
-                    packet = json.loads(pkt_json)
-                    # В Beta-2 отправитель зашит внутри E2EE контента
-                    await state.node._deliver_to_active_user(packet, None)
-                except: pass
-
-        state.is_logged_in = True
-    
-    return {"status": "ok", "user_id": new_user_id}
-
-@router.post("/api/logout")
-async def logout():
-    if state.is_logged_in:
-        state.node.remove_active_user()
-        if state.db: await state.db.close()
-        state.db = None
-        state.user_id = ""
-        state.crypto = None
-        state.is_logged_in = False
-    return {"status": "ok"}
-
-@router.post("/api/connect")
-async def connect_peer(data: ConnectData):
-    if not state.node: raise HTTPException(400, "Node not ready")
-    res = await state.node.connect_to(data.address)
-    return {"success": res}
-
-@router.post("/api/send")
-async def send_message(data: SendData):
-    if not state.db: raise HTTPException(400)
-    
-    try: enc_net = state.crypto.encrypt_message(data.target_id, data.text)
-    except: raise HTTPException(400, "Invalid Target ID")
-    
-    pkt_uuid = str(uuid.uuid4())
-    enc_local = state.crypto.encrypt_db_field(data.text)
-    
-    # Сохраняем локально
-    await state.db.conn.execute("""
-        INSERT INTO messages (packet_id, chat_id, sender_id, content, timestamp, is_outgoing, is_read) 
-        VALUES (?, ?, ?, ?, ?, 1, 1)
-    """, (pkt_uuid, data.target_id, state.user_id, enc_local, datetime.now().isoformat()))
-    await state.db.conn.execute("INSERT OR IGNORE INTO contacts (user_id, last_seen) VALUES (?, ?)", (data.target_id, datetime.now().isoformat()))
-    await state.db.conn.commit()
-
-    route_id = state.crypto.get_route_id(state.user_id, data.target_id)
-    rev_id = state.crypto.get_route_id(data.target_id, state.user_id)
-    
-    route = await state.system_db.get_best_route(route_id)
-
-    if route and not route['is_local']:
-        # DATA
-        packet = {"type": "DATA", "id": pkt_uuid, "route_id": route_id, "content": enc_net, "ttl": 20}
-        await state.system_db.mark_packet_seen(pkt_uuid)
-        await state.system_db.conn.execute("""
-            INSERT INTO outbox (packet_id, next_hop_id, packet_json, exclude_peer) 
-            VALUES (?, ?, ?, NULL)
-        """, (pkt_uuid, route['next_hop_id'], json.dumps(packet)))
-        p_type, status = "DATA", "sent"
-    else:
-        # PROBE
-        # Алиса метит СВОЙ входящий канал (rev_id) как LOCAL
-        await state.system_db.add_route(rev_id, "LOCAL", 0, is_local=1, remote_user_id=data.target_id)
-        
-        sig = state.crypto.sign_data(state.user_id + data.target_id)
-        auth = state.crypto.encrypt_for_probe(data.target_id, json.dumps({"sid": state.user_id}))
-        
-        probe = {
-            "type": "PROBE", "id": pkt_uuid, "route_id": route_id, "rev_id": rev_id, 
-            "target_hash": state.crypto.get_target_hash(data.target_id), 
-            "auth": auth, "sig": sig, "content": enc_net, "metric": 0, "ttl": 20
-        }
-        await state.system_db.mark_packet_seen(pkt_uuid)
-        await state.system_db.conn.execute("""
-            INSERT INTO outbox (packet_id, next_hop_id, packet_json, exclude_peer) 
-            VALUES (?, NULL, ?, NULL)
-        """, (pkt_uuid, json.dumps(probe)))
-        p_type, status = "PROBE", "finding_route"
-
-    await state.system_db.conn.commit()
-    return {"status": status, "packet_id": pkt_uuid, "packet_type": p_type}
-
-@router.get("/api/state")
-async def get_state():
-    if not state.node: return {"status": "offline"}
-    return {
-        "user_id": state.user_id if state.is_logged_in else "OFFLINE", 
-        "peers": list(state.node.active_connections.keys())
-    }
-
-@router.get("/api/peers")
-async def get_contacts():
-    if not state.db: return []
-    async with state.db.conn.execute("""
-        SELECT c.user_id, c.nickname, 
-        (SELECT COUNT(id) FROM messages WHERE chat_id = c.user_id AND is_read = 0 AND is_outgoing = 0) as unread_count 
-        FROM contacts c
-    """) as cursor:
-        rows = await cursor.fetchall()
-    res = []
-    for r in rows:
-        d = dict(r)
-        if d['nickname']: d['nickname'] = state.crypto.decrypt_db_field(d['nickname'])
-        res.append(d)
-    return res
-
-@router.get("/api/messages/{chat_id}")
-async def get_chat_history(chat_id: str):
-    if not state.db: return []
-    async with state.db.conn.execute("SELECT * FROM messages WHERE chat_id = ? ORDER BY timestamp ASC", (chat_id,)) as cursor:
-        rows = await cursor.fetchall()
-    res = []
-    for r in rows:
-        d = dict(r)
-        d['content'] = state.crypto.decrypt_db_field(d['content'])
-        res.append(d)
-    await state.db.conn.execute("UPDATE messages SET is_read = 1 WHERE chat_id = ? AND is_outgoing = 0", (chat_id,))
-    await state.db.conn.commit()
-    return res
-
-@router.post("/api/rename")
-async def rename_peer(data: RenameData):
-    if not state.db: raise HTTPException(400)
-    enc_name = state.crypto.encrypt_db_field(data.name) if data.name else None
-    await state.db.conn.execute("""
-        INSERT INTO contacts (user_id, nickname, last_seen) VALUES (?, ?, ?) 
-        ON CONFLICT(user_id) DO UPDATE SET nickname=excluded.nickname
-    """, (data.target_id, enc_name, datetime.now().isoformat()))
-    await state.db.conn.commit()
-    return {"status": "ok"}
-
-@router.post("/api/read_chat")
-async def mark_chat_as_read(data: ReadChatData):
-    if not state.db: raise HTTPException(400)
-    await state.db.conn.execute("UPDATE messages SET is_read = 1 WHERE chat_id = ? AND is_outgoing = 0", (data.chat_id,))
-    await state.db.conn.commit()
+import os
+import hashlib
+import base64
+import json
+import uuid
+import time
+import asyncio
+from datetime import datetime
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import RedirectResponse, StreamingResponse
+from pydantic import BaseModel
+from typing import Optional
+from nacl.public import PrivateKey
+from nacl.encoding import Base64Encoder
+
+from core import (
+    state, DB_GROUP_COMMIT, DB_COMMIT_DELAY, DB_COMMIT_BATCH, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE, SSE_KEEPALIVE,
+    PLAINTEXT_CACHE_SIZE, PLAINTEXT_CACHE_BYTES, DB_READ_POOL_SIZE, MESSAGE_MAX_BYTES,
+    MESSAGE_MAX_FRAGMENTS, PACKET_SIZE
+)
+from database import DatabaseManager
+from crypto import CryptoManager
+from crypto_pool import PoolBusy
+from events import EventBus
+import migrations
+import wire
+
+router = APIRouter()
+
+# --- Pydantic Models ---
+class LoginData(BaseModel):
+    username: str
+    password: str
+class ConnectData(BaseModel):
+    address: str
+class SendData(BaseModel):
+    target_id: str
+    text: str
+class RenameData(BaseModel):
+    target_id: str
+    name: Optional[str] = None
+class ReadChatData(BaseModel):
+    chat_id: str
+class RouteIdRequest(BaseModel):
+    sender_id: str
+    receiver_id: str
+
+# --- API ROUTES ---
+
+@router.get("/")
+async def root():
+    return RedirectResponse(url="/auth/login.html")
+
+# --- DEBUG ЭНДПОИНТЫ ДЛЯ ТЕСТОВ ---
+
+@router.get("/api/debug/packet/{pkt_id}")
+async def debug_packet_status(pkt_id: str):
+    """Проверяет статус пакета (был ли виден или в очереди)"""
+    if not state.system_db: return {"status": "offline"}
+    async with state.system_db.read() as conn, conn.execute("SELECT received_at FROM seen_packets WHERE packet_id = ?", (pkt_id,)) as cursor:
+        seen = await cursor.fetchone()
+    return {
+        "seen": bool(seen) or pkt_id in state.system_db.seen, 
+        "received_at": seen['received_at'] if seen else None, 
+        "in_outbox": state.node.outbox.count(pkt_id)
+    }
+
+@router.get("/api/debug/dedup")
+async def debug_dedup_stats():
+    """Счетчики кеша дедупликации (для подбора окна)"""
+    if not state.system_db: return {}
+    return state.system_db.seen.stats()
+
+@router.get("/api/debug/tact")
+async def debug_tact_stats():
+    """Метрики такта: сколько кадров ушло и насколько они заполнены"""
+    if not state.tact: return {}
+    return state.tact.get_stats()
+
+@router.get("/api/debug/gc")
+async def debug_gc_stats():
+    """Сколько строк освободила фоновая чистка БД"""
+    if not state.janitor: return {}
+    return state.janitor.get_stats()
+
+@router.get("/api/debug/crypto")
+async def debug_crypto_stats():
+    """Попадания в кеш ключей собеседников"""
+    if not state.crypto: return {}
+    return state.crypto.peer_cache.stats()
+
+@router.get("/api/debug/crypto_pool")
+async def debug_crypto_pool_stats():
+    """Задания пула потоков для libsodium"""
+    if not state.crypto_pool: return {}
+    return state.crypto_pool.get_stats()
+
+@router.get("/api/debug/query_plans")
+async def debug_query_plans():
+    """EXPLAIN QUERY PLAN горячих запросов: full_scan=true значит, что индекс не используется"""
+    res = {}
+    if state.system_db: res["system"] = await state.system_db.check_query_plans()
+    if state.db: res["user"] = await state.db.check_query_plans()
+    return res
+
+@router.get("/api/debug/plaintext")
+async def debug_plaintext_stats():
+    """Кеш расшифрованных сообщений и ников (без содержимого)"""
+    if not state.db: return {}
+    return state.db.plaintext.stats()
+
+@router.get("/api/debug/events")
+async def debug_events_stats():
+    """Подписчики SSE и сбросы переполненных очередей"""
+    if not state.events: return {}
+    return state.events.get_stats()
+
+@router.get("/api/debug/discovery")
+async def debug_discovery_stats():
+    """Идущие поиски маршрута, повторы и отложенные сообщения"""
+    if not state.node: return {}
+    return state.node.discovery.get_stats()
+
+@router.get("/api/debug/inbound")
+async def debug_inbound_stats():
+    """Входящие очереди соседей: глубина, потери PROBE, ожидание места под DATA"""
+    if not state.node: return {}
+    return state.node.inbound.get_stats()
+
+@router.get("/api/debug/links")
+async def debug_links_stats():
+    """RTT и потери до соседей по кадрам такта, сколько DATA ушло через каждого"""
+    if not state.node: return {}
+    return state.node.links.get_stats()
+
+@router.get("/api/debug/refresh")
+async def debug_refresh_stats():
+    """Активные разговоры и продления их маршрутов"""
+    if not state.node: return {}
+    return state.node.active_routes.get_stats()
+
+@router.get("/api/debug/reliable")
+async def debug_reliable_stats():
+    """Окна надежной доставки: в полете, ждут, RTO по разговорам, повторы и ACK"""
+    if not state.node: return {}
+    return state.node.reliable.get_stats()
+
+@router.get("/api/debug/fragments")
+async def debug_fragment_stats():
+    """Сборка входящих FRAG: незавершенные сообщения, байты в памяти, выброшенные по лимитам"""
+    if not state.node: return {}
+    return state.node.reassembly.get_stats()
+
+@router.get("/api/debug/probes")
+async def debug_probe_stats():
+    """Ретрансляция PROBE (сколько копий сэкономлено) против успеха своих поисков"""
+    if not state.node: return {}
+    return {"forwarding": state.node.probe_policy.get_stats(), "discovery": state.node.discovery.get_stats()}
+
+@router.get("/api/debug/kdf")
+async def debug_kdf_stats():
+    """Очередь и активные Argon2 логина"""
+    if not state.kdf: return {}
+    return state.kdf.get_stats()
+
+@router.get("/api/debug/outbox")
+async def debug_get_outbox():
+    """Возвращает текущую очередь отправки"""
+    if not state.node: return []
+    # Формат строк таблицы outbox; бинарные пакеты для отладки показываем как JSON
+    return [{
+        "id": entry.id,
+        "packet_id": entry.packet_id,
+        "next_hop_id": entry.next_hop_id,
+        "packet_json": json.dumps(wire.decode_packet(entry.packet)) if isinstance(entry.packet, bytes) else entry.packet,
+        "exclude_peer": entry.exclude_peer,
+        "priority": entry.priority,
+        "created_at": datetime.utcfromtimestamp(entry.created_at).strftime("%Y-%m-%d %H:%M:%S"),
+    } for entry in state.node.outbox.entries()]
+
+@router.get("/api/debug/outbox_stats")
+async def debug_outbox_stats():
+    """Глубина приоритетной очереди по классам и соседям"""
+    if not state.node: return {}
+    return state.node.outbox.get_stats()
+
+@router.get("/api/debug/routes")
+async def debug_get_routes():
+    """Возвращает таблицу маршрутизации"""
+    if not state.system_db: return []
+    return state.system_db.routes.all_routes()
+
+@router.post("/api/debug/get_route_ids")
+async def debug_get_route_ids(data: RouteIdRequest):
+    """Хелпер для тестов: вычисляет хеши маршрутов"""
+    if not state.crypto: return {}
+    return {
+        "route_fwd": state.crypto.get_route_id(data.sender_id, data.receiver_id),
+        "route_bwd": state.crypto.get_route_id(data.receiver_id, data.sender_id)
+    }
+
+# --- ОСНОВНЫЕ ЭНДПОИНТЫ ---
+
+@router.post("/api/login")
+async def login(data: LoginData):
+    # Argon2 считается в пуле потоков: такт и ретрансляция не останавливаются
+    try: seeds = await state.kdf.derive(data.username, data.password)
+    except PoolBusy: raise HTTPException(503, "Too many logins in progress")
+    crypto = CryptoManager()
+    crypto.load_keys(*seeds)
+    new_user_id = crypto.my_id
+    
+    async with state.login_lock:
+        return await _switch_user(crypto, new_user_id)
+
+async def _switch_user(crypto: CryptoManager, new_user_id: str):
+    if state.is_logged_in and state.user_id != new_user_id:
+        state.node.remove_active_user()
+        if state.db: await state.db.close()
+        state.is_logged_in = False
+    
+    if not state.is_logged_in:
+        await state.system_db.register_local_user(new_user_id)
+        
+        state.user_id = new_user_id
+        state.crypto = crypto
+        
+        state.db = DatabaseManager(
+            f"node_{new_user_id}.db", schema=migrations.USER,
+            group_commit=DB_GROUP_COMMIT, commit_delay=DB_COMMIT_DELAY, commit_batch=DB_COMMIT_BATCH,
+            plaintext_cache_size=PLAINTEXT_CACHE_SIZE, plaintext_cache_bytes=PLAINTEXT_CACHE_BYTES,
+            read_pool_size=DB_READ_POOL_SIZE
+        )
+        state.db.set_crypto(crypto)
+        await state.db.connect()
+        
+        state.node.set_active_user(new_user_id, state.db, crypto)
+        # Сообщения без ACK прошлой сессии снова в окне (окно живет только в памяти)
+        await state.node.restore_outgoing()
+        
+        # Загрузка офлайн сообщений
+        offline_packets = await state.system_db.fetch_mailbox(new_user_id)
+        if offline_packets:
+            for pkt_json in offline_packets:
+                try:
+                    packet = wire.decode_packet(pkt_json) if isinstance(pkt_json, bytes) else json.loads(pkt_json)
+                    # В Beta-2 отправитель зашит внутри E2EE контента
+                    await state.node._deliver_to_active_user(packet, None)
+                except: pass
+
+        state.is_logged_in = True
+    
+    return {"status": "ok", "user_id": new_user_id}
+
+@router.post("/api/logout")
+async def logout():
+    async with state.login_lock:
+        if state.is_logged_in:
+            state.node.remove_active_user()
+            if state.db: await state.db.close()
+            state.db = None
+            state.user_id = ""
+            state.crypto = None
+            state.is_logged_in = False
+    return {"status": "ok"}
+
+@router.post("/api/connect")
+async def connect_peer(data: ConnectData):
+    if not state.node: raise HTTPException(400, "Node not ready")
+    res = await state.node.connect_to(data.address)
+    return {"success": res}
+
+@router.post("/api/send")
+async def send_message(data: SendData):
+    if not state.db: raise HTTPException(400)
+    if len(data.text.encode('utf-8')) > MESSAGE_MAX_BYTES: raise HTTPException(413, "Message too large")
+    
+    pkt_uuid = str(uuid.uuid4())  # ID сообщения: первый пакет и mid у всех повторов
+    try: enc_net = state.crypto.encrypt_message(data.target_id, data.text, pkt_uuid)
+    except: raise HTTPException(400, "Invalid Target ID")
+    # Точный потолок - по фрагментам шифротекста: столько же примет получатель
+    if wire.fragment_count(len(base64.b64decode(enc_net)), PACKET_SIZE) > MESSAGE_MAX_FRAGMENTS:
+        raise HTTPException(413, "Message too large")
+    
+    enc_local = state.crypto.encrypt_db_field(data.text)
+    
+    # Сохраняем локально
+    cursor = await state.db.execute_write("""
+        INSERT INTO messages (packet_id, chat_id, sender_id, content, timestamp, is_outgoing, is_read, status) 
+        VALUES (?, ?, ?, ?, ?, 1, 1, 'queued')
+    """, (pkt_uuid, data.target_id, state.user_id, enc_local, datetime.now().isoformat()), durable=True)
+    state.db.cache_plaintext(("msg", cursor.lastrowid), data.text)
+    state.events.publish("message", chat_id=data.target_id, id=cursor.lastrowid, is_outgoing=1)
+    await state.db.execute_write("INSERT OR IGNORE INTO contacts (user_id, last_seen) VALUES (?, ?)", (data.target_id, datetime.now().isoformat()), durable=True)
+
+    # DATA по маршруту в пределах окна, PROBE без маршрута; статус дальше ведет нода (ACK, повторы)
+    p_type, status = await state.node.send_message(data.target_id, pkt_uuid, data.text, enc_net)
+    return {"status": status, "packet_id": pkt_uuid, "packet_type": p_type}
+
+@router.get("/api/events")
+async def events_stream():
+    """SSE: сообщения, соседи и статусы отправки. Заменяет опрос /api/state и /api/messages."""
+    bus = state.events
+    async def stream():
+        queue = bus.subscribe()
+        try:
+            yield EventBus.format_sse("hello", {"user_id": state.user_id if state.is_logged_in else "OFFLINE"})
+            while True:
+                try:
+                    event_type, payload = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"  # Комментарий SSE держит соединение через прокси
+                    continue
+                yield EventBus.format_sse(event_type, payload)
+        finally:
+            bus.unsubscribe(queue)
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.get("/api/state")
+async def get_state():
+    if not state.node: return {"status": "offline"}
+    return {
+        "user_id": state.user_id if state.is_logged_in else "OFFLINE", 
+        "peers": list(state.node.active_connections.keys())
+    }
+
+@router.get("/api/peers")
+async def get_contacts():
+    if not state.db: return []
+    # unread_count поддерживается триггерами на messages (см. migrations._add_unread_counters, UNREAD_TRIGGERS)
+    async with state.db.read() as conn, conn.execute("SELECT user_id, nickname, unread_count FROM contacts") as cursor:
+        rows = await cursor.fetchall()
+    res = [dict(r) for r in rows]
+    nicknames = await _decrypt_cached([("nick", d['user_id']) for d in res], [d['nickname'] for d in res])
+    for d, nickname in zip(res, nicknames):
+        if d['nickname']: d['nickname'] = nickname
+    return res
+
+async def _decrypt_cached(keys: list, values: list) -> list:
+    """Расшифровка полей БД: из кеша открытого текста, промахи - одной пачкой в пуле"""
+    db = state.db
+    res = [db.plaintext.get(key) if value else "" for key, value in zip(keys, values)]
+    missing = [i for i, text in enumerate(res) if text is None]
+    if missing:
+        decrypted = await state.crypto_pool.decrypt_db_fields(state.crypto, [values[i] for i in missing])
+        for i, text in zip(missing, decrypted):
+            res[i] = text
+            db.cache_plaintext(keys[i], text)
+    return res
+
+@router.get("/api/messages/{chat_id}")
+async def get_chat_history(chat_id: str, before: Optional[int] = None, after: Optional[int] = None,
+                           limit: int = HISTORY_PAGE_SIZE):
+    """
+    Keyset-пагинация по id (индекс (chat_id, id)), ответ всегда по возрастанию id:
+    - after=N  - только новые сообщения после N (режим опроса);
+    - before=N - страница старее N (подгрузка при прокрутке вверх);
+    - без параметров - последняя страница.
+    """
+    if not state.db: return []
+    limit = max(1, min(limit, HISTORY_MAX_PAGE))
+    if after is not None:
+        sql = "SELECT * FROM messages WHERE chat_id = ? AND id > ? ORDER BY id ASC LIMIT ?"
+        params = (chat_id, after, limit)
+    elif before is not None:
+        sql = "SELECT * FROM messages WHERE chat_id = ? AND id < ? ORDER BY id DESC LIMIT ?"
+        params = (chat_id, before, limit)
+    else:
+        sql = "SELECT * FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?"
+        params = (chat_id, limit)
+    async with state.db.read() as conn, conn.execute(sql, params) as cursor:
+        rows = await cursor.fetchall()
+    res = [dict(r) for r in rows]
+    if after is None: res.reverse()
+    # Расшифровка страницы: из кеша, промахи пачкой в пуле потоков
+    contents = await _decrypt_cached([("msg", d['id']) for d in res], [d['content'] for d in res])
+    for d, content in zip(res, contents): d['content'] = content
+    # Пишем в БД только если на странице есть непрочитанные входящие
+    unread = [d['id'] for d in res if not d['is_outgoing'] and not d['is_read']]
+    if unread:
+        await state.db.execute_write(
+            "UPDATE messages SET is_read = 1 WHERE chat_id = ? AND is_outgoing = 0 AND is_read = 0 AND id <= ?",
+            (chat_id, max(unread)))
+    return res
+
+@router.post("/api/rename")
+async def rename_peer(data: RenameData):
+    if not state.db: raise HTTPException(400)
+    enc_name = state.crypto.encrypt_db_field(data.name) if data.name else None
+    await state.db.execute_write("""
+        INSERT INTO contacts (user_id, nickname, last_seen) VALUES (?, ?, ?) 
+        ON CONFLICT(user_id) DO UPDATE SET nickname=excluded.nickname
+    """, (data.target_id, enc_name, datetime.now().isoformat()), durable=True)
+    if data.name: state.db.cache_plaintext(("nick", data.target_id), data.name)
+    else: state.db.plaintext.pop(("nick", data.target_id))
+    state.events.publish("contacts", user_id=data.target_id)
+    return {"status": "ok"}
+
+@router.post("/api/read_chat")
+async def mark_chat_as_read(data: ReadChatData):
+    if not state.db: raise HTTPException(400)
+    await state.db.execute_write("UPDATE messages SET is_read = 1 WHERE chat_id = ? AND is_outgoing = 0", (data.chat_id,), durable=True)
+    state.events.publish("contacts", user_id=data.chat_id)
     return {"status": "ok"}
\ No newline at end of file
@@ -1,70 +1,244 @@
-import os
-from contextlib import asynccontextmanager
-from typing import Optional, Set
-import asyncio
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-
-from database import DatabaseManager
-from network import P2PNode
-from tact import TactEngine
-from crypto import CryptoManager
-
-# --- D-MASH CONFIGURATION ---
-TACT_INTERVAL = 1.5
-PACKET_SIZE = 4096
-P2P_PORT = int(os.getenv("P2P_PORT", 9000))
-
-class AppState:
-    node: Optional[P2PNode] = None
-    tact: Optional[TactEngine] = None
-    
-    system_db: Optional[DatabaseManager] = None # База демона
-    db: Optional[DatabaseManager] = None        # База юзера
-    
-    crypto: Optional[CryptoManager] = None
-    user_id: str = ""
-    is_logged_in: bool = False
-    background_tasks: Set[asyncio.Task] = set()
-
-state = AppState()
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # 1. Запускаем Системную БД
-    state.system_db = DatabaseManager("bootstrap_peers.db")
-    await state.system_db.connect()
-
-    # 2. Запускаем Демона
-    # ИСПРАВЛЕНИЕ: P2PNode теперь принимает только базу данных
-    state.node = P2PNode(state.system_db) 
-    
-    state.tact = TactEngine(state.system_db, state.node, TACT_INTERVAL, PACKET_SIZE)
-    
-    t1 = asyncio.create_task(state.node.start_server(P2P_PORT))
-    t2 = asyncio.create_task(state.tact.start())
-    state.background_tasks.update([t1, t2])
-    t1.add_done_callback(state.background_tasks.discard)
-    t2.add_done_callback(state.background_tasks.discard)
-    
-    yield
-    
-    for task in state.background_tasks: task.cancel()
-    if state.db: await state.db.close()
-    if state.system_db: await state.system_db.close()
-
-app = FastAPI(lifespan=lifespan)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-from api import router as api_router
-app.include_router(api_router)
-
-frontend_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "frontend")
+import os
+from contextlib import asynccontextmanager
+from typing import Optional, Set
+import asyncio
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.staticfiles import StaticFiles
+
+from database import DatabaseManager
+from network import P2PNode
+from tact import TactEngine
+from crypto import CryptoManager
+from janitor import DatabaseJanitor
+from outbox import Outbox
+from discovery import RouteDiscovery
+from links import LinkMonitor
+from refresh import ActiveRoutes
+from probe_policy import ProbePolicy
+from reliable import ReliableSender
+from fragments import Reassembly
+from crypto_pool import KeyDerivationPool, CryptoWorkerPool
+from events import EventBus
+import migrations
+import wire
+
+# --- D-MASH CONFIGURATION ---
+TACT_INTERVAL = 1.5
+# Адаптивный темп: при хвосте в outbox такт ускоряется до TACT_MIN_INTERVAL, затем растет до
+# TACT_MAX_BURST кадров на соседа; в простое замедляется, но не ниже TACT_MIN_COVER_RATE кадров/с
+TACT_MIN_INTERVAL = float(os.getenv("TACT_MIN_INTERVAL", 0.25))
+TACT_MIN_COVER_RATE = float(os.getenv("TACT_MIN_COVER_RATE", 0.5))
+TACT_MAX_BURST = int(os.getenv("TACT_MAX_BURST", 4))
+PACKET_SIZE = 4096
+TACT_SCAN_LIMIT = 64  # Сколько пакетов одного источника рассматривается за такт при упаковке кадров
+
+# Справедливая очередь: квант DRR (байт на источник за круг) и квота пакетов источника в подочереди
+DRR_QUANTUM = 1024
+OUTBOX_SOURCE_LIMIT = 256
+
+# Входящие кадры: очередь на соседа (кадров) и число обработчиков
+INBOUND_QUEUE_SIZE = 64
+INBOUND_WORKERS = 4
+
+# Поиск маршрута: ожидание ответа на PROBE, рост паузы между повторами, число повторов
+DISCOVERY_TIMEOUT = 5.0
+DISCOVERY_BACKOFF = 2.0
+DISCOVERY_MAX_RETRIES = 3
+DISCOVERY_CHECK_INTERVAL = 1.0
+
+# Маршруты: время жизни пути и продление для активных разговоров (REFRESH до истечения)
+ROUTE_TTL = 1800
+ROUTE_REFRESH_BEFORE = 300
+ROUTE_REFRESH_INTERVAL = 60
+ROUTE_ACTIVE_WINDOW = ROUTE_TTL  # Разговор без сообщений дольше этого - маршруты истекают
+
+# Ретрансляция PROBE: gossip после первых хопов, потолок fanout, ноды с малым числом соседей шлют всем,
+# expanding ring для своих поисков (0 - сразу PROBE_MAX_TTL).
+# По умолчанию вероятность 1 и fanout 0 - прежний флуд. Gossip включается явно, например
+# PROBE_GOSSIP_PROB=0.75 PROBE_FANOUT=8: ~98% охвата при 20-24% меньше копий, но часть поисков уходит в повтор
+PROBE_GOSSIP_PROB = float(os.getenv("PROBE_GOSSIP_PROB", 1.0))
+PROBE_GOSSIP_MIN_HOPS = 2
+PROBE_FANOUT = int(os.getenv("PROBE_FANOUT", 0))
+PROBE_DEGREE_THRESHOLD = 3
+PROBE_RING_START = int(os.getenv("PROBE_RING_START", 0))
+PROBE_MAX_TTL = 20
+
+# Надежная доставка: окно сообщений без ACK на разговор, RTO (начальный, границы), число попыток,
+# сколько сообщение может ждать маршрута и ACK, период повторов и отправки подтверждений
+RELIABLE_WINDOW = 16
+RELIABLE_INITIAL_RTO = 15.0
+RELIABLE_MIN_RTO = 3.0
+RELIABLE_MAX_RTO = 120.0
+RELIABLE_MAX_ATTEMPTS = 6
+RELIABLE_MAX_WAIT = 600
+RELIABLE_CHECK_INTERVAL = 0.5
+
+# Большие сообщения: потолок - число FRAG шифротекста (JSON-экранирование раздувает текст до 6x),
+# текст длиннее такого числа фрагментов отсекается еще до шифрования.
+# Получатель принимает на фрагмент больше: перешифрованный повтор может вырасти на несколько байт
+MESSAGE_MAX_FRAGMENTS = 64
+MESSAGE_MAX_BYTES = MESSAGE_MAX_FRAGMENTS * wire.fragment_chunk(PACKET_SIZE)
+REASSEMBLY_MAX_FRAGMENTS = MESSAGE_MAX_FRAGMENTS + 1
+REASSEMBLY_MAX_MESSAGES = 64
+REASSEMBLY_MAX_BYTES = 4 * 1024 * 1024
+REASSEMBLY_TIMEOUT = 120
+
+# Выбор пути для DATA: цена хопа (мс, ожидание такта) и допуск почти равных путей для multipath
+ROUTE_HOP_COST_MS = TACT_INTERVAL * 1000 / 2
+ROUTE_SPREAD = 0.25
+
+# Отправка кадров соседям: очередь, дедлайн и пороги деградации/отключения
+SEND_QUEUE_SIZE = 4
+SEND_TIMEOUT = 1.0
+DEGRADED_AFTER_MISSES = 3
+DROP_AFTER_MISSES = 10
+
+# Фоновая чистка системной БД (сроки хранения в секундах)
+GC_INTERVAL = 60
+GC_CHUNK_SIZE = 500
+GC_SEEN_RETENTION = 3600
+GC_OUTBOX_STALE_AFTER = 120
+GC_OUTBOX_MAX_AGE = 1800
+GC_MAILBOX_RETENTION = 7 * 24 * 3600
+GC_VACUUM_INTERVAL = 6 * 3600
+P2P_PORT = int(os.getenv("P2P_PORT", 9000))
+
+# Окно дедупликации пакетов (сек) и пакетная запись в seen_packets
+SEEN_WINDOW = float(os.getenv("SEEN_WINDOW", 600))
+SEEN_GENERATIONS = 4
+SEEN_FLUSH_BATCH = 256
+SEEN_FLUSH_INTERVAL = 2.0
+
+# Групповой коммит записей в SQLite
+DB_GROUP_COMMIT = os.getenv("DB_GROUP_COMMIT", "1") == "1"
+DB_COMMIT_DELAY = 0.005
+DB_COMMIT_BATCH = 256
+# Read-only соединения (WAL) для запросов API, отдельно от писателя
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 2))
+
+# Argon2 логина: сколько KDF одновременно (по ~1 ГиБ) и сколько логинов ждут в очереди
+KDF_MAX_CONCURRENT = int(os.getenv("KDF_MAX_CONCURRENT", 1))
+KDF_MAX_PENDING = 8
+
+# Пул потоков для пакетной расшифровки/проверки подписей (0 = по числу ядер)
+CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS", 0))
+CRYPTO_MIN_CHUNK = 64
+
+# История чата: размер страницы по умолчанию и максимум
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE = 500
+
+# Push-канал для UI (SSE): очередь на вкладку и интервал keepalive
+EVENT_QUEUE_SIZE = 256
+SSE_KEEPALIVE = 15.0
+
+# Кеш расшифрованных сообщений/ников в памяти: записи и бюджет в байтах
+PLAINTEXT_CACHE_SIZE = 5000
+PLAINTEXT_CACHE_BYTES = int(os.getenv("PLAINTEXT_CACHE_BYTES", 4 * 1024 * 1024))
+
+class AppState:
+    node: Optional[P2PNode] = None
+    tact: Optional[TactEngine] = None
+    janitor: Optional[DatabaseJanitor] = None
+    kdf: Optional[KeyDerivationPool] = None
+    crypto_pool: Optional[CryptoWorkerPool] = None
+    events: Optional[EventBus] = None
+    login_lock: Optional[asyncio.Lock] = None
+    
+    system_db: Optional[DatabaseManager] = None # База демона
+    db: Optional[DatabaseManager] = None        # База юзера
+    
+    crypto: Optional[CryptoManager] = None
+    user_id: str = ""
+    is_logged_in: bool = False
+    background_tasks: Set[asyncio.Task] = set()
+
+state = AppState()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 1. Запускаем Системную БД
+    state.system_db = DatabaseManager(
+        "bootstrap_peers.db", schema=migrations.SYSTEM,
+        seen_window=SEEN_WINDOW, seen_generations=SEEN_GENERATIONS,
+        seen_flush_batch=SEEN_FLUSH_BATCH, seen_flush_interval=SEEN_FLUSH_INTERVAL,
+        group_commit=DB_GROUP_COMMIT, commit_delay=DB_COMMIT_DELAY, commit_batch=DB_COMMIT_BATCH,
+        read_pool_size=DB_READ_POOL_SIZE, route_ttl=ROUTE_TTL
+    )
+    await state.system_db.connect()
+
+    state.kdf = KeyDerivationPool(KDF_MAX_CONCURRENT, KDF_MAX_PENDING)
+    state.login_lock = asyncio.Lock()
+    state.crypto_pool = CryptoWorkerPool(CRYPTO_WORKERS or None, CRYPTO_MIN_CHUNK)
+    state.events = EventBus(EVENT_QUEUE_SIZE)
+
+    # 2. Запускаем Демона
+    # ИСПРАВЛЕНИЕ: P2PNode теперь принимает только базу данных
+    state.node = P2PNode(
+        state.system_db, state.crypto_pool, state.events, Outbox(state.system_db, OUTBOX_SOURCE_LIMIT),
+        RouteDiscovery(DISCOVERY_TIMEOUT, DISCOVERY_BACKOFF, DISCOVERY_MAX_RETRIES),
+        inbound_queue_size=INBOUND_QUEUE_SIZE, inbound_workers=INBOUND_WORKERS,
+        links=LinkMonitor(ROUTE_HOP_COST_MS, ROUTE_SPREAD),
+        active_routes=ActiveRoutes(ROUTE_REFRESH_BEFORE, ROUTE_ACTIVE_WINDOW),
+        probe_policy=ProbePolicy(PROBE_GOSSIP_PROB, PROBE_GOSSIP_MIN_HOPS, PROBE_FANOUT, PROBE_DEGREE_THRESHOLD,
+                                 PROBE_RING_START, PROBE_MAX_TTL),
+        reliable=ReliableSender(RELIABLE_WINDOW, RELIABLE_INITIAL_RTO, RELIABLE_MIN_RTO, RELIABLE_MAX_RTO,
+                                RELIABLE_MAX_ATTEMPTS, RELIABLE_MAX_WAIT),
+        reassembly=Reassembly(REASSEMBLY_MAX_MESSAGES, REASSEMBLY_MAX_BYTES, REASSEMBLY_MAX_FRAGMENTS,
+                              REASSEMBLY_TIMEOUT),
+        frame_size=PACKET_SIZE
+    )
+    await state.node.outbox.load()
+    
+    state.tact = TactEngine(
+        state.system_db, state.node, TACT_INTERVAL, PACKET_SIZE, TACT_SCAN_LIMIT,
+        send_queue_size=SEND_QUEUE_SIZE, send_timeout=SEND_TIMEOUT,
+        degraded_after=DEGRADED_AFTER_MISSES, drop_after=DROP_AFTER_MISSES, quantum=DRR_QUANTUM,
+        min_interval=TACT_MIN_INTERVAL, max_interval=1 / TACT_MIN_COVER_RATE, max_burst=TACT_MAX_BURST
+    )
+    
+    state.janitor = DatabaseJanitor(
+        state.system_db, state.node, GC_INTERVAL, GC_CHUNK_SIZE,
+        seen_retention=GC_SEEN_RETENTION, outbox_stale_after=GC_OUTBOX_STALE_AFTER,
+        outbox_max_age=GC_OUTBOX_MAX_AGE, mailbox_retention=GC_MAILBOX_RETENTION,
+        vacuum_interval=GC_VACUUM_INTERVAL
+    )
+    
+    t1 = asyncio.create_task(state.node.start_server(P2P_PORT))
+    t2 = asyncio.create_task(state.tact.start())
+    t3 = asyncio.create_task(state.janitor.start())
+    t4 = asyncio.create_task(state.node.run_discovery(DISCOVERY_CHECK_INTERVAL))
+    t5 = asyncio.create_task(state.node.run_refresh(ROUTE_REFRESH_INTERVAL))
+    t6 = asyncio.create_task(state.node.run_reliable(RELIABLE_CHECK_INTERVAL))
+    state.background_tasks.update([t1, t2, t3, t4, t5, t6])
+    t1.add_done_callback(state.background_tasks.discard)
+    t2.add_done_callback(state.background_tasks.discard)
+    t3.add_done_callback(state.background_tasks.discard)
+    t4.add_done_callback(state.background_tasks.discard)
+    t5.add_done_callback(state.background_tasks.discard)
+    t6.add_done_callback(state.background_tasks.discard)
+    
+    yield
+    
+    for task in state.background_tasks: task.cancel()
+    if state.node: state.node.inbound.stop()
+    if state.db: await state.db.close()
+    if state.system_db: await state.system_db.close()
+    if state.kdf: state.kdf.shutdown()
+    if state.crypto_pool: state.crypto_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+from api import router as api_router
+app.include_router(api_router)
+
+frontend_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "frontend")
 app.mount("/", StaticFiles(directory=frontend_path, html=True), name="frontend")
\ No newline at end of file
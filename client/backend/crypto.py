@@ -1,175 +1,289 @@
-import time
-import json
-import base64
-import os
-import hashlib
-from typing import Optional
-
-import nacl.utils
-import nacl.secret
-import nacl.pwhash
-from nacl.public import PrivateKey, PublicKey, Box, SealedBox
-from nacl.signing import SigningKey, VerifyKey
-from nacl.encoding import HexEncoder, Base64Encoder
-import blake3
-
-MAX_MESSAGE_AGE = 300 
-
-class CryptoManager:
-    def __init__(self):
-        self.signing_key: Optional[SigningKey] = None 
-        self.verify_key: Optional[VerifyKey] = None   
-        self.private_key: Optional[PrivateKey] = None 
-        self.public_key: Optional[PublicKey] = None   
-        self.sym_key: Optional[bytes] = None          
-        self.my_id: str = ""                          
-
-    def derive_keys_from_password(self, username: str, password: str):
-        """Генерация всех ключей из пары логин/пароль"""
-        salt = hashlib.sha256(username.encode()).digest()[:16]
-        
-        kdf = nacl.pwhash.argon2id.kdf(
-            nacl.secret.SecretBox.KEY_SIZE, password.encode(), salt,
-            opslimit=nacl.pwhash.argon2id.OPSLIMIT_SENSITIVE,
-            memlimit=nacl.pwhash.argon2id.MEMLIMIT_SENSITIVE
-        )
-        # Ключи для подписи (Ed25519)
-        self.signing_key = SigningKey(kdf)
-        self.verify_key = self.signing_key.verify_key
-        
-        # Ключи для шифрования (Curve25519)
-        self.private_key = self.signing_key.to_curve25519_private_key()
-        self.public_key = self.verify_key.to_curve25519_public_key()
-        
-        # ID пользователя - это Hex его публичного ключа подписи
-        self.my_id = self.verify_key.encode(encoder=HexEncoder).decode()
-        
-        # Симметричный ключ для БД
-        db_salt = hashlib.sha256((username + "_db_secure").encode()).digest()[:16]
-        self.sym_key = nacl.pwhash.argon2id.kdf(
-            nacl.secret.SecretBox.KEY_SIZE, password.encode(), db_salt,
-            opslimit=nacl.pwhash.argon2id.OPSLIMIT_INTERACTIVE,
-            memlimit=nacl.pwhash.argon2id.MEMLIMIT_INTERACTIVE
-        )
-
-    # --- ROUTING & IDENTITY (Blake3) ---
-    
-    def get_route_id(self, sender_pub_hex: str, receiver_pub_hex: str) -> str:
-        """ID маршрута = blake3(A + B). Конкатенация строк."""
-        combined = sender_pub_hex + receiver_pub_hex
-        return blake3.blake3(combined.encode()).hexdigest()
-
-    def get_target_hash(self, pub_key_hex: str) -> str:
-        """Хеш цели = blake3(B)"""
-        return blake3.blake3(pub_key_hex.encode()).hexdigest()
-
-    # --- SIGNATURES (Ed25519) ---
-
-    def sign_data(self, data_str: str) -> str:
-        """Подписывает строку и возвращает подпись в Base64"""
-        signed = self.signing_key.sign(data_str.encode('utf-8'))
-        return base64.b64encode(signed.signature).decode('utf-8')
-
-    def verify_sig(self, pub_key_hex: str, data_str: str, sig_b64: str) -> bool:
-        """Проверяет подпись данных"""
-        try:
-            verify_key = VerifyKey(pub_key_hex, encoder=HexEncoder)
-            sig_bytes = base64.b64decode(sig_b64)
-            verify_key.verify(data_str.encode('utf-8'), sig_bytes)
-            return True
-        except Exception:
-            return False
-
-    # --- E2EE (XSalsa20-Poly1305 + Ed25519 Signature) ---
-
-    def encrypt_message(self, target_pub_key_hex: str, message_text: str) -> str:
-        try:
-            recipient_verify_key = VerifyKey(target_pub_key_hex, encoder=HexEncoder)
-            recipient_pub_key = recipient_verify_key.to_curve25519_public_key()
-        except Exception:
-            raise ValueError("Invalid target public key")
-
-        timestamp = time.time()
-        # Данные для подписи: текст + время + мой ID
-        sig_content = f"{message_text}{timestamp}{self.my_id}"
-        signature = self.sign_data(sig_content)
-
-        payload = {
-            "txt": message_text,
-            "ts": timestamp,
-            "sid": self.my_id,   # Мой ID (отправитель)
-            "sig": signature,    # Моя подпись
-            "rnd": base64.b64encode(os.urandom(16)).decode()
-        }
-        
-        payload_bytes = json.dumps(payload).encode('utf-8')
-        box = Box(self.private_key, recipient_pub_key)
-        encrypted = box.encrypt(payload_bytes)
-        return base64.b64encode(encrypted).decode('utf-8')
-
-    def decrypt_message(self, sender_pub_key_hex: str, encrypted_b64: str) -> str:
-        """Расшифровывает и ОБЯЗАТЕЛЬНО проверяет подпись автора"""
-        try:
-            sender_verify_key = VerifyKey(sender_pub_key_hex, encoder=HexEncoder)
-            sender_pub_key_curve = sender_verify_key.to_curve25519_public_key()
-            
-            box = Box(self.private_key, sender_pub_key_curve)
-            encrypted_bytes = base64.b64decode(encrypted_b64)
-            plaintext_bytes = box.decrypt(encrypted_bytes)
-            
-            payload = json.loads(plaintext_bytes.decode('utf-8'))
-            
-            # 1. Проверка времени (защита от Replay-атак)
-            if time.time() - payload.get("ts", 0) > MAX_MESSAGE_AGE:
-                return "[ERROR: Message expired]"
-            
-            # 2. Проверка соответствия отправителя
-            if payload.get("sid") != sender_pub_key_hex:
-                return "[ERROR: Sender ID mismatch]"
-
-            # 3. Проверка цифровой подписи
-            sig_content = f"{payload['txt']}{payload['ts']}{payload['sid']}"
-            if not self.verify_sig(sender_pub_key_hex, sig_content, payload['sig']):
-                return "[ERROR: Invalid Signature]"
-
-            return payload.get("txt", "")
-        except Exception as e:
-            return f"[ERROR: Decryption Failed]"
-
-    # --- PROBE ENCRYPTION (SealedBox) ---
-
-    def encrypt_for_probe(self, target_pub_key_hex: str, data_str: str) -> str:
-        try:
-            recipient_verify_key = VerifyKey(target_pub_key_hex, encoder=HexEncoder)
-            recipient_pub_key = recipient_verify_key.to_curve25519_public_key()
-            box = SealedBox(recipient_pub_key)
-            encrypted = box.encrypt(data_str.encode('utf-8'))
-            return base64.b64encode(encrypted).decode('utf-8')
-        except Exception:
-            return ""
-
-    def decrypt_from_probe(self, encrypted_b64: str) -> str:
-        try:
-            box = SealedBox(self.private_key)
-            encrypted_bytes = base64.b64decode(encrypted_b64)
-            plaintext = box.decrypt(encrypted_bytes)
-            return plaintext.decode('utf-8')
-        except Exception:
-            return ""
-
-    # --- DB Encryption (SecretBox) ---
-    def encrypt_db_field(self, data: str) -> str:
-        if not data: return ""
-        box = nacl.secret.SecretBox(self.sym_key)
-        encrypted = box.encrypt(data.encode('utf-8'))
-        return base64.b64encode(encrypted).decode('utf-8')
-
-    def decrypt_db_field(self, data_b64: str) -> str:
-        if not data_b64: return ""
-        try:
-            box = nacl.secret.SecretBox(self.sym_key)
-            encrypted = base64.b64decode(data_b64)
-            plaintext = box.decrypt(encrypted)
-            return plaintext.decode('utf-8')
-        except:
-            return "[DB DECRYPT FAIL]"
\ No newline at end of file
+import time
+import json
+import base64
+import os
+import hashlib
+from typing import Optional
+
+import nacl.utils
+import nacl.secret
+import nacl.pwhash
+from nacl.public import PrivateKey, PublicKey, Box, SealedBox
+from nacl.signing import SigningKey, VerifyKey
+from nacl.encoding import HexEncoder, Base64Encoder
+import blake3
+
+from lru import LRUCache
+
+MAX_MESSAGE_AGE = 300 
+PEER_CACHE_SIZE = 256
+
+class PeerKeys:
+    """Разобранные ключи собеседника и готовый Box (общий ключ X25519 уже посчитан)"""
+    __slots__ = ("verify_key", "curve_key", "box")
+
+    def __init__(self, verify_key: VerifyKey, curve_key: PublicKey, box: Optional[Box]):
+        self.verify_key = verify_key
+        self.curve_key = curve_key
+        self.box = box
+
+class OpenedMessage:
+    """Результат open_message: текст сообщения (и поле для БД) либо подтверждения доставки"""
+    __slots__ = ("text", "db_field", "message_id", "acks")
+
+    def __init__(self, text: Optional[str], db_field: Optional[str], message_id: Optional[str], acks: Optional[list]):
+        self.text = text
+        self.db_field = db_field
+        self.message_id = message_id  # ID сообщения отправителя (одинаков у всех повторов)
+        self.acks = acks              # Для ACK: ID подтвержденных сообщений
+
+class CryptoManager:
+    def __init__(self):
+        self.signing_key: Optional[SigningKey] = None 
+        self.verify_key: Optional[VerifyKey] = None   
+        self.private_key: Optional[PrivateKey] = None 
+        self.public_key: Optional[PublicKey] = None   
+        self.sym_key: Optional[bytes] = None          
+        self.my_id: str = ""                          
+        self.peer_cache = LRUCache(PEER_CACHE_SIZE)   # peer_id (hex) -> PeerKeys
+
+    def derive_keys_from_password(self, username: str, password: str):
+        """Генерация всех ключей из пары логин/пароль"""
+        self.load_keys(*self.derive_seeds(username, password))
+
+    @staticmethod
+    def derive_seeds(username: str, password: str):
+        """
+        Тяжелая часть логина: два Argon2id (SENSITIVE - около 1 ГиБ памяти и секунды CPU).
+        Не трогает состояние, поэтому выполняется в пуле потоков (см. crypto_pool.py).
+        Возвращает (seed ключа подписи, симметричный ключ БД).
+        """
+        salt = hashlib.sha256(username.encode()).digest()[:16]
+        
+        kdf = nacl.pwhash.argon2id.kdf(
+            nacl.secret.SecretBox.KEY_SIZE, password.encode(), salt,
+            opslimit=nacl.pwhash.argon2id.OPSLIMIT_SENSITIVE,
+            memlimit=nacl.pwhash.argon2id.MEMLIMIT_SENSITIVE
+        )
+        
+        # Симметричный ключ для БД
+        db_salt = hashlib.sha256((username + "_db_secure").encode()).digest()[:16]
+        sym_key = nacl.pwhash.argon2id.kdf(
+            nacl.secret.SecretBox.KEY_SIZE, password.encode(), db_salt,
+            opslimit=nacl.pwhash.argon2id.OPSLIMIT_INTERACTIVE,
+            memlimit=nacl.pwhash.argon2id.MEMLIMIT_INTERACTIVE
+        )
+        return kdf, sym_key
+
+    def load_keys(self, seed: bytes, sym_key: bytes):
+        """Быстрая часть: ключи из готового seed"""
+        # Ключи для подписи (Ed25519)
+        self.signing_key = SigningKey(seed)
+        self.verify_key = self.signing_key.verify_key
+        
+        # Ключи для шифрования (Curve25519)
+        self.private_key = self.signing_key.to_curve25519_private_key()
+        self.public_key = self.verify_key.to_curve25519_public_key()
+        
+        # ID пользователя - это Hex его публичного ключа подписи
+        self.my_id = self.verify_key.encode(encoder=HexEncoder).decode()
+        # Box в кеше построены на старом приватном ключе
+        self.invalidate_peer()
+        
+        self.sym_key = sym_key
+
+    # --- PEER KEY CACHE ---
+
+    def _peer_keys(self, pub_key_hex: str) -> PeerKeys:
+        """Ключи собеседника из кеша; при промахе - разбор hex, Ed25519->Curve25519 и Box"""
+        keys = self.peer_cache.get(pub_key_hex)
+        if keys is None:
+            verify_key = VerifyKey(pub_key_hex, encoder=HexEncoder)
+            curve_key = verify_key.to_curve25519_public_key()
+            box = Box(self.private_key, curve_key) if self.private_key else None
+            keys = PeerKeys(verify_key, curve_key, box)
+            self.peer_cache.put(pub_key_hex, keys)
+        return keys
+
+    def invalidate_peer(self, pub_key_hex: Optional[str] = None):
+        """Сбрасывает кеш ключей одного собеседника (или всех, если ID не указан)"""
+        if pub_key_hex is None: self.peer_cache.clear()
+        else: self.peer_cache.pop(pub_key_hex)
+
+    # --- ROUTING & IDENTITY (Blake3) ---
+    
+    def get_route_id(self, sender_pub_hex: str, receiver_pub_hex: str) -> str:
+        """ID маршрута = blake3(A + B). Конкатенация строк."""
+        combined = sender_pub_hex + receiver_pub_hex
+        return blake3.blake3(combined.encode()).hexdigest()
+
+    def get_target_hash(self, pub_key_hex: str) -> str:
+        """Хеш цели = blake3(B)"""
+        return blake3.blake3(pub_key_hex.encode()).hexdigest()
+
+    # --- SIGNATURES (Ed25519) ---
+
+    def sign_data(self, data_str: str) -> str:
+        """Подписывает строку и возвращает подпись в Base64"""
+        signed = self.signing_key.sign(data_str.encode('utf-8'))
+        return base64.b64encode(signed.signature).decode('utf-8')
+
+    def verify_sig(self, pub_key_hex: str, data_str: str, sig_b64: str) -> bool:
+        """Проверяет подпись данных"""
+        try:
+            verify_key = self._peer_keys(pub_key_hex).verify_key
+            sig_bytes = base64.b64decode(sig_b64)
+            verify_key.verify(data_str.encode('utf-8'), sig_bytes)
+            return True
+        except Exception:
+            return False
+
+    # --- E2EE (XSalsa20-Poly1305 + Ed25519 Signature) ---
+
+    def encrypt_message(self, target_pub_key_hex: str, message_text: str, message_id: Optional[str] = None) -> str:
+        try:
+            box = self._peer_keys(target_pub_key_hex).box
+        except Exception:
+            raise ValueError("Invalid target public key")
+
+        timestamp = time.time()
+        # Данные для подписи: текст + время + мой ID
+        sig_content = f"{message_text}{timestamp}{self.my_id}"
+        signature = self.sign_data(sig_content)
+
+        payload = {
+            "txt": message_text,
+            "ts": timestamp,
+            "sid": self.my_id,   # Мой ID (отправитель)
+            "sig": signature,    # Моя подпись
+            "rnd": base64.b64encode(os.urandom(16)).decode()
+        }
+        if message_id: payload["mid"] = message_id  # Повторная отправка идет новым пакетом с тем же mid
+        
+        payload_bytes = json.dumps(payload).encode('utf-8')
+        encrypted = box.encrypt(payload_bytes)
+        return base64.b64encode(encrypted).decode('utf-8')
+
+    def encrypt_ack(self, target_pub_key_hex: str, message_ids: list) -> str:
+        """
+        Подтверждение доставки. Снаружи неотличимо от сообщения (тот же Box, тот же тип DATA);
+        подпись не нужна - Box и так доказывает, что писал владелец ключа собеседника.
+        """
+        box = self._peer_keys(target_pub_key_hex).box
+        payload = {"ack": message_ids, "ts": time.time(), "sid": self.my_id,
+                   "rnd": base64.b64encode(os.urandom(16)).decode()}
+        return base64.b64encode(box.encrypt(json.dumps(payload).encode('utf-8'))).decode('utf-8')
+
+    def _open_payload(self, sender_pub_key_hex: str, encrypted_b64: str) -> dict:
+        box = self._peer_keys(sender_pub_key_hex).box
+        plaintext_bytes = box.decrypt(base64.b64decode(encrypted_b64))
+        return json.loads(plaintext_bytes.decode('utf-8'))
+
+    def decrypt_message(self, sender_pub_key_hex: str, encrypted_b64: str) -> str:
+        """Расшифровывает и ОБЯЗАТЕЛЬНО проверяет подпись автора"""
+        try:
+            return self._check_message(sender_pub_key_hex, self._open_payload(sender_pub_key_hex, encrypted_b64))
+        except Exception as e:
+            return f"[ERROR: Decryption Failed]"
+
+    def _check_message(self, sender_pub_key_hex: str, payload: dict) -> str:
+        try:
+            # 1. Проверка времени (защита от Replay-атак)
+            if time.time() - payload.get("ts", 0) > MAX_MESSAGE_AGE:
+                return "[ERROR: Message expired]"
+            
+            # 2. Проверка соответствия отправителя
+            if payload.get("sid") != sender_pub_key_hex:
+                return "[ERROR: Sender ID mismatch]"
+
+            # 3. Проверка цифровой подписи
+            sig_content = f"{payload['txt']}{payload['ts']}{payload['sid']}"
+            if not self.verify_sig(sender_pub_key_hex, sig_content, payload['sig']):
+                return "[ERROR: Invalid Signature]"
+
+            return payload.get("txt", "")
+        except Exception as e:
+            return f"[ERROR: Decryption Failed]"
+
+    # --- PROBE ENCRYPTION (SealedBox) ---
+
+    def encrypt_for_probe(self, target_pub_key_hex: str, data_str: str) -> str:
+        try:
+            box = SealedBox(self._peer_keys(target_pub_key_hex).curve_key)
+            encrypted = box.encrypt(data_str.encode('utf-8'))
+            return base64.b64encode(encrypted).decode('utf-8')
+        except Exception:
+            return ""
+
+    def decrypt_from_probe(self, encrypted_b64: str) -> str:
+        try:
+            box = SealedBox(self.private_key)
+            encrypted_bytes = base64.b64decode(encrypted_b64)
+            plaintext = box.decrypt(encrypted_bytes)
+            return plaintext.decode('utf-8')
+        except Exception:
+            return ""
+
+    def open_probe_auth(self, auth_b64: str, sig_b64: str) -> Optional[str]:
+        """
+        Расшифровка auth пробы и проверка подписи (A+B).signature(A) за один вызов,
+        чтобы вся работа уходила в пул одним заданием. Возвращает ID источника или None.
+        """
+        sender_id_json = self.decrypt_from_probe(auth_b64)
+        if not sender_id_json: return None
+        try:
+            sender_id = json.loads(sender_id_json).get('sid')
+        except Exception:
+            return None
+        if not sender_id: return None
+        if not self.verify_sig(sender_id, sender_id + self.my_id, sig_b64): return None
+        return sender_id
+
+    def open_message(self, sender_pub_key_hex: str, encrypted_b64: str) -> OpenedMessage:
+        """E2EE -> текст и перешифрованное поле для БД, либо список подтверждений для ACK"""
+        try:
+            payload = self._open_payload(sender_pub_key_hex, encrypted_b64)
+        except Exception:
+            text = "[ERROR: Decryption Failed]"
+            return OpenedMessage(text, self.encrypt_db_field(text), None, None)
+        if "ack" in payload:
+            acks = payload["ack"] if payload.get("sid") == sender_pub_key_hex and isinstance(payload["ack"], list) else []
+            return OpenedMessage(None, None, None, [str(mid) for mid in acks])
+        text = self._check_message(sender_pub_key_hex, payload)
+        message_id = payload.get("mid") if not text.startswith("[ERROR") else None
+        return OpenedMessage(text, self.encrypt_db_field(text), message_id, None)
+
+    def verify_many(self, items: list) -> list:
+        """[(pub_key_hex, data_str, sig_b64), ...] -> [bool, ...]"""
+        return [self.verify_sig(pub, data, sig) for pub, data, sig in items]
+
+    # --- DB Encryption (SecretBox) ---
+    def encrypt_db_field(self, data: str) -> str:
+        if not data: return ""
+        box = nacl.secret.SecretBox(self.sym_key)
+        encrypted = box.encrypt(data.encode('utf-8'))
+        return base64.b64encode(encrypted).decode('utf-8')
+
+    def decrypt_db_field(self, data_b64: str) -> str:
+        if not data_b64: return ""
+        try:
+            box = nacl.secret.SecretBox(self.sym_key)
+            encrypted = base64.b64decode(data_b64)
+            plaintext = box.decrypt(encrypted)
+            return plaintext.decode('utf-8')
+        except:
+            return "[DB DECRYPT FAIL]"
+
+    def decrypt_db_fields(self, values: list) -> list:
+        """Пакетная версия decrypt_db_field: один SecretBox на весь список"""
+        box = nacl.secret.SecretBox(self.sym_key)
+        res = []
+        for data_b64 in values:
+            if not data_b64:
+                res.append("")
+                continue
+            try:
+                res.append(box.decrypt(base64.b64decode(data_b64)).decode('utf-8'))
+            except:
+                res.append("[DB DECRYPT FAIL]")
+        return res
\ No newline at end of file
@@ -0,0 +1,122 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from crypto import CryptoManager
+
+
+class PoolBusy(RuntimeError):
+    pass
+
+
+class KeyDerivationPool:
+    """
+    Argon2id логина вне event loop.
+    libsodium отпускает GIL, поэтому хватает потоков; семафор ограничивает число
+    одновременных KDF (каждый SENSITIVE держит около 1 ГиБ), а max_pending - очередь ожидающих.
+    """
+    def __init__(self, max_concurrent: int = 1, max_pending: int = 8):
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="kdf")
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    async def derive(self, username: str, password: str):
+        """(seed, sym_key) для CryptoManager.load_keys. Отмена ожидающего вызова безопасна."""
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PoolBusy("Too many logins in progress")
+        self.pending += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.pending -= 1
+
+        loop = asyncio.get_running_loop()
+        try:
+            fut = self._executor.submit(CryptoManager.derive_seeds, username, password)
+        except BaseException:
+            self._slots.release()
+            raise
+        self.running += 1
+        # Слот освобождается только когда поток реально закончил: отмена корутины
+        # не останавливает Argon2, и память остается занятой до конца вычисления
+        fut.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        try:
+            result = await asyncio.wrap_future(fut)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        self.completed += 1
+        return result
+
+    def _release(self):
+        self.running -= 1
+        self._slots.release()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "running": self.running,
+            "pending": self.pending,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+        }
+
+
+class CryptoWorkerPool:
+    """
+    Пул потоков для libsodium на пути приема и в истории чата.
+    PyNaCl отпускает GIL внутри вызовов, поэтому потоки реально работают на разных ядрах.
+    Пакеты режутся на куски (не меньше min_chunk элементов), чтобы переход в поток
+    окупался; совсем маленькие пакеты считаются прямо в event loop.
+    """
+    def __init__(self, workers: int = None, min_chunk: int = 64, inline_below: int = 8):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_chunk = min_chunk
+        self.inline_below = inline_below
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="crypto")
+        self.jobs = 0
+        self.items = 0
+        self.inline = 0
+
+    async def run(self, fn, *args):
+        """Одна операция в пуле"""
+        self.jobs += 1
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def map_batch(self, fn, items: list) -> list:
+        """fn(list) -> list, распределенный по потокам кусками; порядок сохраняется"""
+        self.items += len(items)
+        if len(items) < self.inline_below:
+            self.inline += 1
+            return fn(items) if items else []
+        chunk = max(self.min_chunk, -(-len(items) // self.workers))
+        parts = await asyncio.gather(*(self.run(fn, items[i:i + chunk]) for i in range(0, len(items), chunk)))
+        return [value for part in parts for value in part]
+
+    async def decrypt_db_fields(self, crypto: CryptoManager, values: list) -> list:
+        return await self.map_batch(crypto.decrypt_db_fields, values)
+
+    async def verify_many(self, crypto: CryptoManager, items: list) -> list:
+        return await self.map_batch(crypto.verify_many, items)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "jobs": self.jobs,
+            "items": self.items,
+            "inline_batches": self.inline,
+        }
@@ -1,163 +1,362 @@
-import aiosqlite
-import time
-from datetime import datetime
-
-class DatabaseManager:
-    """
-    Менеджер локальной SQLite базы данных для архитектуры Beta-2.
-    Оперирует маршрутами на основе хешей и дедупликацией пакетов.
-    """
-    def __init__(self, db_path):
-        self.db_path = db_path
-        self.conn = None
-        self.crypto = None
-
-    def set_crypto(self, crypto_manager):
-        self.crypto = crypto_manager
-
-    async def connect(self):
-        self.conn = await aiosqlite.connect(self.db_path)
-        self.conn.row_factory = aiosqlite.Row
-        await self._init_tables()
-
-    async def _init_tables(self):
-        # ТАБЛИЦЫ ПОЛЬЗОВАТЕЛЯ (User DB)
-        await self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                packet_id TEXT UNIQUE, 
-                chat_id TEXT,
-                sender_id TEXT,
-                content TEXT, 
-                timestamp TEXT,
-                is_outgoing INTEGER,
-                is_read INTEGER DEFAULT 0
-            )
-        """)
-        
-        await self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS contacts (
-                user_id TEXT PRIMARY KEY,
-                nickname TEXT,
-                last_seen TEXT
-            )
-        """)
-
-        # --- ТАБЛИЦЫ ДЕМОНА (System DB) ---
-        await self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS neighbors (
-                user_id TEXT PRIMARY KEY,
-                address TEXT,
-                last_seen TEXT
-            )
-        """)
-        
-        # Очередь исходящих пакетов
-        await self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS outbox (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                packet_id TEXT,
-                next_hop_id TEXT, 
-                packet_json TEXT,
-                exclude_peer TEXT, 
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # Дедупликация (храним RouteID поисков и PacketID данных)
-        await self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS seen_packets (
-                packet_id TEXT PRIMARY KEY,
-                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        await self.conn.execute("CREATE TABLE IF NOT EXISTS local_users (user_id TEXT PRIMARY KEY)")
-
-        # Хранилище для офлайн-доставки
-        await self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS offline_mailbox (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                target_id TEXT,
-                packet_json TEXT,
-                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # ТАБЛИЦА МАРШРУТИЗАЦИИ (Beta-2)
-        # route_id - хеш, определяющий направление (A->B или B->A)
-        # next_hop_id - сосед, через которого лежит путь
-        # is_local - флаг, если маршрут ведет к локальному пользователю на этой ноде
-        await self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS routing_table (
-                route_id TEXT,
-                next_hop_id TEXT,
-                metric INTEGER,
-                is_local INTEGER DEFAULT 0,
-                remote_user_id TEXT,
-                expires_at TIMESTAMP,
-                PRIMARY KEY (route_id, next_hop_id)
-            )
-        """)
-        
-        await self.conn.commit()
-
-    async def close(self):
-        if self.conn:
-            await self.conn.close()
-
-    # --- МЕТОДЫ СИСТЕМЫ ---
-
-    async def mark_packet_seen(self, packet_id: str) -> bool:
-        """Регистрирует пакет. Возвращает True если пакет новый, False если дубль."""
-        try:
-            await self.conn.execute("INSERT INTO seen_packets (packet_id) VALUES (?)", (packet_id,))
-            await self.conn.commit()
-            return True
-        except aiosqlite.IntegrityError:
-            return False
-
-    async def register_local_user(self, user_id: str):
-        await self.conn.execute("INSERT OR IGNORE INTO local_users (user_id) VALUES (?)", (user_id,))
-        await self.conn.commit()
-
-    async def is_local_user(self, user_id: str) -> bool:
-        async with self.conn.execute("SELECT 1 FROM local_users WHERE user_id = ?", (user_id,)) as cursor:
-            return await cursor.fetchone() is not None
-
-    async def save_to_mailbox(self, target_id: str, packet_json: str):
-        await self.conn.execute("INSERT INTO offline_mailbox (target_id, packet_json) VALUES (?, ?)", (target_id, packet_json))
-        await self.conn.commit()
-
-    async def fetch_mailbox(self, user_id: str):
-        async with self.conn.execute("SELECT id, packet_json FROM offline_mailbox WHERE target_id = ?", (user_id,)) as cursor:
-            rows = await cursor.fetchall()
-        if rows:
-            ids = [row['id'] for row in rows]
-            await self.conn.execute(f"DELETE FROM offline_mailbox WHERE id IN ({','.join(['?']*len(ids))})", ids)
-            await self.conn.commit()
-        return [row['packet_json'] for row in rows]
-
-    # --- МЕТОДЫ МАРШРУТИЗАЦИИ (Beta-2) ---
-
-    async def add_route(self, route_id: str, next_hop_id: str, metric: int, is_local: int = 0, remote_user_id: str = None):
-        """
-        Добавляет или обновляет маршрут. 
-        В Beta-2 маршруты строятся автоматически при прохождении PROBE.
-        """
-        # TTL маршрута 30 минут
-        expires = time.time() + 1800 
-        await self.conn.execute("""
-            INSERT OR REPLACE INTO routing_table (route_id, next_hop_id, metric, is_local, remote_user_id, expires_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (route_id, next_hop_id, metric, is_local, remote_user_id, expires))
-        await self.conn.commit()
-
-    async def get_best_route(self, route_id: str):
-        """Возвращает лучший по метрике активный путь для route_id."""
-        async with self.conn.execute("""
-            SELECT next_hop_id, is_local, remote_user_id, metric FROM routing_table 
-            WHERE route_id = ? AND expires_at > ? 
-            ORDER BY metric ASC LIMIT 1
-        """, (route_id, time.time())) as cursor:
-            return await cursor.fetchone()
\ No newline at end of file
+import sys
+import asyncio
+import aiosqlite
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from datetime import datetime
+
+from dedup import SeenPacketCache
+from routing import RoutingTable
+from lru import LRUCache
+import migrations
+
+# WAL: читатели не блокируют писателя и наоборот.
+# synchronous=NORMAL в WAL не портит базу при падении процесса; при потере питания
+# могут пропасть последние транзакции - для мессенджера с повторной доставкой это приемлемо.
+WRITER_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",        # ~8 МиБ страничного кеша
+    "PRAGMA mmap_size = 67108864",      # 64 МиБ
+    "PRAGMA busy_timeout = 5000",
+]
+READER_PRAGMAS = [
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -4000",
+    "PRAGMA mmap_size = 67108864",
+    "PRAGMA busy_timeout = 5000",
+]
+
+class DatabaseManager:
+    """
+    Менеджер локальной SQLite базы данных для архитектуры Beta-2.
+    Оперирует маршрутами на основе хешей и дедупликацией пакетов.
+    """
+    def __init__(self, db_path, schema: str = migrations.SYSTEM, seen_window: float = 600.0, seen_generations: int = 4,
+                 seen_flush_batch: int = 256, seen_flush_interval: float = 2.0,
+                 group_commit: bool = True, commit_delay: float = 0.005, commit_batch: int = 256,
+                 plaintext_cache_size: int = 0, plaintext_cache_bytes: int = 0, read_pool_size: int = 0,
+                 route_ttl: float = 1800.0):
+        self.db_path = db_path
+        self.schema = schema  # migrations.SYSTEM (демон) или migrations.USER (пользователь)
+        self.schema_version = 0
+        self.conn = None  # Соединение писателя (и ретрансляции)
+
+        # Пул read-only соединений для запросов API: у каждого свой поток aiosqlite,
+        # поэтому тяжелое чтение истории не стоит в очереди перед записями ретрансляции
+        self.read_pool_size = read_pool_size
+        self._readers = []
+        self._idle_readers = None
+        self.crypto = None
+
+        # Групповой коммит: все записи идут через одну задачу-писателя,
+        # которая коммитит их пачкой по дедлайну или по размеру
+        self.group_commit = group_commit
+        self.commit_delay = commit_delay
+        self.commit_batch = commit_batch
+        self._write_queue = None
+        self._batch_full = None
+        self._writer_task = None
+
+        # Маршруты живут в памяти, routing_table - постоянное хранилище
+        self.routes = RoutingTable()
+        self.route_ttl = route_ttl
+
+        # Дедупликация отвечает из памяти, seen_packets пополняется пачками
+        self.seen = SeenPacketCache(seen_window, seen_generations)
+        self.seen_flush_batch = seen_flush_batch
+        self.seen_flush_interval = seen_flush_interval
+        self._seen_pending = []
+        self._seen_flushed_at = time.monotonic()
+
+        # Расшифрованные поля БД пользователя: ("msg", id) -> текст, ("nick", user_id) -> ник.
+        # Бюджет в байтах ограничивает, сколько открытого текста лежит в памяти
+        self.plaintext = LRUCache(plaintext_cache_size, plaintext_cache_bytes, sizeof=sys.getsizeof)
+
+    def cache_plaintext(self, key, text: str):
+        """Кладет только что записанный/расшифрованный текст в кеш"""
+        if text and text != "[DB DECRYPT FAIL]": self.plaintext.put(key, text)
+
+    def set_crypto(self, crypto_manager):
+        self.crypto = crypto_manager
+
+    async def connect(self):
+        self.conn = await aiosqlite.connect(self.db_path)
+        self.conn.row_factory = aiosqlite.Row
+        for pragma in WRITER_PRAGMAS: await self.conn.execute(pragma)
+        self.schema_version = await migrations.migrate(self.conn, self.schema)
+        await self._open_readers()
+        if self.schema == migrations.SYSTEM:
+            await self._warm_seen_cache()
+            await self._load_routes()
+        if self.group_commit:
+            self._write_queue = asyncio.Queue()
+            self._batch_full = asyncio.Event()
+            self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def _warm_seen_cache(self):
+        """После рестарта подгружаем в кеш пакеты, увиденные в пределах окна."""
+        async with self.conn.execute(
+            "SELECT packet_id FROM seen_packets WHERE received_at > datetime('now', ?)",
+            (f"-{int(self.seen.window)} seconds",)
+        ) as cursor:
+            async for row in cursor:
+                self.seen.add(row['packet_id'])
+
+    async def _load_routes(self):
+        """Загружает живые маршруты в память, истекшие удаляет."""
+        now = time.time()
+        async with self.conn.execute("SELECT * FROM routing_table WHERE expires_at > ?", (now,)) as cursor:
+            async for row in cursor:
+                self.routes.upsert(row['route_id'], row['next_hop_id'], row['metric'],
+                                   row['is_local'], row['remote_user_id'], row['expires_at'])
+        await self.conn.execute("DELETE FROM routing_table WHERE expires_at <= ?", (now,))
+        await self.conn.commit()
+
+    async def _open_readers(self):
+        self._idle_readers = asyncio.Queue()
+        uri = Path(self.db_path).absolute().as_uri() + "?mode=ro"
+        for _ in range(self.read_pool_size):
+            reader = await aiosqlite.connect(uri, uri=True)
+            reader.row_factory = aiosqlite.Row
+            for pragma in READER_PRAGMAS: await reader.execute(pragma)
+            self._readers.append(reader)
+            self._idle_readers.put_nowait(reader)
+
+    @asynccontextmanager
+    async def read(self):
+        """
+        Соединение для чтения: async with db.read() as conn.
+        Видит только закоммиченные данные. Без пула отдает соединение писателя.
+        """
+        if not self._readers:
+            yield self.conn
+            return
+        reader = await self._idle_readers.get()
+        try:
+            yield reader
+        finally:
+            self._idle_readers.put_nowait(reader)
+
+    async def close(self):
+        for reader in self._readers: await reader.close()
+        self._readers = []
+        if self.conn:
+            await self.flush_seen(durable=True)
+            if self._writer_task:
+                # Дописываем очередь и останавливаем писателя
+                self._write_queue.put_nowait(None)
+                self._batch_full.set()
+                await self._writer_task
+                self._writer_task = None
+            await self.conn.close()
+        self.plaintext.clear()
+
+    async def rebuild_unread_counts(self):
+        """Полный пересчет contacts.unread_count по messages (при миграции делается автоматически)"""
+        for sql in migrations.REBUILD_UNREAD[:-1]:
+            await self.execute_write(sql)
+        await self.execute_write(migrations.REBUILD_UNREAD[-1], durable=True)
+
+    async def check_query_plans(self) -> dict:
+        """Планы горячих запросов этой схемы (см. migrations.HOT_QUERIES)"""
+        async with self.read() as conn:
+            return await migrations.check_query_plans(conn, self.schema)
+
+    # --- ГРУППОВОЙ КОММИТ ---
+
+    _EXCLUSIVE = "exclusive"
+
+    def submit_write(self, sql: str, params=(), many: bool = False) -> asyncio.Future:
+        """Ставит запись в очередь писателя. Future завершится курсором после COMMIT."""
+        fut = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((sql, params, many, fut))
+        if self._write_queue.qsize() >= self.commit_batch:
+            self._batch_full.set()
+        return fut
+
+    async def execute_write(self, sql: str, params=(), many: bool = False, durable: bool = False):
+        """
+        Запись в БД. По умолчанию не ждет коммита (write-behind),
+        с durable=True возвращает курсор только после COMMIT.
+        """
+        if not self._writer_task:
+            return await self._write_now(sql, params, many)
+        fut = self.submit_write(sql, params, many)
+        if durable:
+            return await fut
+        fut.add_done_callback(self._report_write_error)
+        return None
+
+    async def run_exclusive(self, sql: str, params=()):
+        """
+        Выполняет оператор вне транзакции (VACUUM, PRAGMA wal_checkpoint):
+        писатель сначала коммитит текущую пачку. Возвращает строки результата.
+        """
+        if not self._writer_task:
+            await self.conn.commit()
+            async with self.conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+        fut = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((sql, params, self._EXCLUSIVE, fut))
+        self._batch_full.set()
+        return await fut
+
+    async def flush(self):
+        """Дожидается коммита всех записей, поставленных в очередь до вызова."""
+        if self._writer_task:
+            await self.submit_write(None)
+
+    async def _write_now(self, sql, params, many):
+        if many: cursor = await self.conn.executemany(sql, params)
+        else: cursor = await self.conn.execute(sql, params)
+        await self.conn.commit()
+        return cursor
+
+    @staticmethod
+    def _report_write_error(fut: asyncio.Future):
+        if not fut.cancelled() and fut.exception():
+            print(f"❌ [DB] Write failed: {fut.exception()}")
+
+    async def _writer_loop(self):
+        while True:
+            op = await self._write_queue.get()
+            if op is None: return
+            if op[2] == self._EXCLUSIVE:
+                await self._apply_exclusive(op)
+                continue
+            batch = [op]
+            # Ждем попутчиков до дедлайна, если пачка еще не набралась
+            if self._write_queue.qsize() + 1 < self.commit_batch:
+                self._batch_full.clear()
+                try: await asyncio.wait_for(self._batch_full.wait(), self.commit_delay)
+                except asyncio.TimeoutError: pass
+            stop, exclusive = False, None
+            while len(batch) < self.commit_batch and not self._write_queue.empty():
+                op = self._write_queue.get_nowait()
+                if op is None:
+                    stop = True
+                    break
+                if op[2] == self._EXCLUSIVE:
+                    exclusive = op
+                    break
+                batch.append(op)
+            await self._apply_batch(batch)
+            if exclusive: await self._apply_exclusive(exclusive)
+            if stop: return
+
+    async def _apply_exclusive(self, op):
+        sql, params, _, fut = op
+        try:
+            async with self.conn.execute(sql, params) as cursor:
+                rows = await cursor.fetchall()
+            if not fut.done(): fut.set_result(rows)
+        except Exception as e:
+            if not fut.done(): fut.set_exception(e)
+
+    async def _apply_batch(self, batch):
+        results = []
+        for sql, params, many, fut in batch:
+            if sql is None:
+                results.append((fut, None, None))
+                continue
+            try:
+                if many: cursor = await self.conn.executemany(sql, params)
+                else: cursor = await self.conn.execute(sql, params)
+                results.append((fut, cursor, None))
+            except Exception as e:
+                # Ошибка одного оператора не откатывает остальные
+                results.append((fut, None, e))
+        try:
+            await self.conn.commit()
+        except Exception as e:
+            results = [(fut, None, e) for fut, _, _ in results]
+        for fut, cursor, err in results:
+            if fut.done(): continue
+            if err: fut.set_exception(err)
+            else: fut.set_result(cursor)
+
+    # --- МЕТОДЫ СИСТЕМЫ ---
+
+    async def mark_packet_seen(self, packet_id: str) -> bool:
+        """Регистрирует пакет. Возвращает True если пакет новый, False если дубль."""
+        if not self.seen.check_and_add(packet_id):
+            return False
+        self._seen_pending.append((packet_id,))
+        if (len(self._seen_pending) >= self.seen_flush_batch
+                or time.monotonic() - self._seen_flushed_at >= self.seen_flush_interval):
+            await self.flush_seen()
+        return True
+
+    async def flush_seen(self, durable: bool = False):
+        """Сбрасывает накопленные packet_id в seen_packets одной транзакцией."""
+        self._seen_flushed_at = time.monotonic()
+        if not self._seen_pending: return
+        batch, self._seen_pending = self._seen_pending, []
+        sql = "INSERT OR IGNORE INTO seen_packets (packet_id) VALUES (?)"
+
+        def count_late(cursor):
+            # Уже записанные id - это дубли, которые кеш забыл: окно слишком короткое
+            self.seen.late_duplicates += len(batch) - cursor.rowcount
+
+        if durable or not self._writer_task:
+            count_late(await self.execute_write(sql, batch, many=True, durable=True))
+            return
+        fut = self.submit_write(sql, batch, many=True)
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception() or count_late(f.result()))
+        fut.add_done_callback(self._report_write_error)
+
+    async def register_local_user(self, user_id: str):
+        await self.execute_write("INSERT OR IGNORE INTO local_users (user_id) VALUES (?)", (user_id,), durable=True)
+
+    async def is_local_user(self, user_id: str) -> bool:
+        async with self.conn.execute("SELECT 1 FROM local_users WHERE user_id = ?", (user_id,)) as cursor:
+            return await cursor.fetchone() is not None
+
+    async def save_to_mailbox(self, target_id: str, packet_json: str):
+        await self.execute_write("INSERT INTO offline_mailbox (target_id, packet_json) VALUES (?, ?)", (target_id, packet_json))
+
+    async def fetch_mailbox(self, user_id: str):
+        async with self.conn.execute("SELECT id, packet_json FROM offline_mailbox WHERE target_id = ?", (user_id,)) as cursor:
+            rows = await cursor.fetchall()
+        if rows:
+            ids = [row['id'] for row in rows]
+            await self.execute_write(f"DELETE FROM offline_mailbox WHERE id IN ({','.join(['?']*len(ids))})", ids)
+        return [row['packet_json'] for row in rows]
+
+    # --- МЕТОДЫ МАРШРУТИЗАЦИИ (Beta-2) ---
+
+    async def add_route(self, route_id: str, next_hop_id: str, metric: int, is_local: int = 0, remote_user_id: str = None):
+        """
+        Добавляет или обновляет маршрут. 
+        В Beta-2 маршруты строятся автоматически при прохождении PROBE.
+        """
+        expires = time.time() + self.route_ttl
+        self.routes.upsert(route_id, next_hop_id, metric, is_local, remote_user_id, expires)
+        await self.execute_write("""
+            INSERT OR REPLACE INTO routing_table (route_id, next_hop_id, metric, is_local, remote_user_id, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (route_id, next_hop_id, metric, is_local, remote_user_id, expires))
+
+    async def renew_route(self, route: dict):
+        """Продлевает путь еще на route_ttl (REFRESH по активному разговору)"""
+        await self.add_route(route['route_id'], route['next_hop_id'], route['metric'], route['is_local'], route['remote_user_id'])
+
+    async def get_best_route(self, route_id: str):
+        """Возвращает лучший по метрике активный путь для route_id."""
+        await self.expire_routes()
+        return self.routes.get_best(route_id)
+
+    async def get_routes(self, route_id: str):
+        """Все активные пути для route_id, от лучшего к худшему (multipath)."""
+        await self.expire_routes()
+        return self.routes.get_routes(route_id)
+
+    async def expire_routes(self) -> int:
+        """Вытесняет истекшие маршруты из памяти и (write-behind) из routing_table."""
+        expired = self.routes.expire()
+        if expired:
+            await self.execute_write("DELETE FROM routing_table WHERE route_id = ? AND next_hop_id = ?", expired, many=True)
+        return len(expired)
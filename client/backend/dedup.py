@@ -0,0 +1,64 @@
+import time
+
+
+class SeenPacketCache:
+    """
+    Дедупликация пакетов в памяти.
+    Хранит несколько хеш-множеств («поколений»), которые ротируются по времени:
+    пакет гарантированно помнится не меньше window*(n-1)/n и не больше window секунд.
+    """
+    def __init__(self, window: float = 600.0, generations: int = 4):
+        self.window = window
+        self.generations = max(2, generations)
+        self.slot = window / self.generations
+        self._gens = [set()]
+        self._rotated_at = time.monotonic()
+
+        # Счетчики для подбора окна под трафик
+        self.hits = 0             # дубль пойман кешем
+        self.misses = 0           # пакет признан новым
+        self.late_duplicates = 0  # пакет уже был в seen_packets, но выпал из окна
+
+    def _rotate(self):
+        now = time.monotonic()
+        elapsed = now - self._rotated_at
+        if elapsed < self.slot: return
+        if elapsed >= self.window:
+            # Долгий простой: все поколения устарели
+            self._gens = [set()]
+            self._rotated_at = now
+            return
+        while now - self._rotated_at >= self.slot:
+            self._gens.insert(0, set())
+            if len(self._gens) > self.generations: self._gens.pop()
+            self._rotated_at += self.slot
+
+    def __contains__(self, packet_id: str) -> bool:
+        self._rotate()
+        return any(packet_id in gen for gen in self._gens)
+
+    def add(self, packet_id: str):
+        self._rotate()
+        self._gens[0].add(packet_id)
+
+    def check_and_add(self, packet_id: str) -> bool:
+        """Возвращает True если пакет новый (и запоминает его), False если дубль."""
+        if packet_id in self:
+            self.hits += 1
+            return False
+        self._gens[0].add(packet_id)
+        self.misses += 1
+        return True
+
+    def stats(self) -> dict:
+        self._rotate()
+        total = self.hits + self.misses
+        return {
+            "window": self.window,
+            "generations": len(self._gens),
+            "size": sum(len(gen) for gen in self._gens),
+            "hits": self.hits,
+            "misses": self.misses,
+            "late_duplicates": self.late_duplicates,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
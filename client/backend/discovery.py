@@ -0,0 +1,85 @@
+import time
+from collections import Counter
+
+class PendingRoute:
+    __slots__ = ("route_id", "target_id", "attempts", "started", "next_retry")
+
+    def __init__(self, route_id: str, target_id: str, next_retry: float):
+        self.route_id = route_id
+        self.target_id = target_id
+        self.attempts = 1
+        self.started = time.time()
+        self.next_retry = next_retry
+
+class RouteDiscovery:
+    """
+    Незавершенные поиски маршрута: route_id -> PendingRoute.
+    На один route_id уходит одна волна PROBE; сообщения, отправленные до ответа, ждут в окне
+    ReliableSender и уходят DATA, как только ответная проба запишет путь. Без ответа - повтор с растущей паузой.
+    Здесь только состояние: пробы строит и отправляет P2PNode.
+    """
+    def __init__(self, timeout: float = 5.0, backoff: float = 2.0, max_retries: int = 3):
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_retries = max_retries
+        self._pending = {}
+        # Когда мы последний раз отвечали собеседнику пробой (гасит пинг-понг ответов)
+        self._responded = {}
+        self.stats = {"started": 0, "retries": 0, "resolved": 0, "failed": 0}
+        self.resolved_by_attempt = Counter()  # С какой волны PROBE найден маршрут
+
+    def __len__(self):
+        return len(self._pending)
+
+    def get(self, route_id: str):
+        return self._pending.get(route_id)
+
+    def start(self, route_id: str, target_id: str) -> PendingRoute:
+        pending = self._pending[route_id] = PendingRoute(route_id, target_id, time.time() + self.timeout)
+        self.stats["started"] += 1
+        return pending
+
+    def resolve(self, route_id: str):
+        pending = self._pending.pop(route_id, None)
+        if pending:
+            self.stats["resolved"] += 1
+            self.resolved_by_attempt[pending.attempts] += 1
+        return pending
+
+    def due(self, now: float = None) -> list:
+        """Поиски, у которых вышло время ожидания ответа"""
+        now = time.time() if now is None else now
+        return [pending for pending in self._pending.values() if pending.next_retry <= now]
+
+    def retry(self, pending: PendingRoute, now: float = None) -> bool:
+        """Планирует следующую попытку. False - попытки кончились, поиск снят."""
+        now = time.time() if now is None else now
+        if pending.attempts > self.max_retries:
+            self._pending.pop(pending.route_id, None)
+            self.stats["failed"] += 1
+            return False
+        pending.next_retry = now + self.timeout * self.backoff ** pending.attempts
+        pending.attempts += 1
+        self.stats["retries"] += 1
+        return True
+
+    def may_respond(self, peer_user_id: str, now: float = None) -> bool:
+        """Отвечать одному собеседнику не чаще раза за timeout"""
+        now = time.time() if now is None else now
+        if now - self._responded.get(peer_user_id, 0.0) < self.timeout: return False
+        if len(self._responded) > 1024:
+            self._responded = {uid: ts for uid, ts in self._responded.items() if now - ts < self.timeout}
+        self._responded[peer_user_id] = now
+        return True
+
+    def clear(self):
+        """Смена пользователя: поиски шли от его имени"""
+        self._pending.clear()
+        self._responded.clear()
+
+    def get_stats(self) -> dict:
+        st = dict(self.stats)
+        st["pending"] = len(self._pending)
+        st["resolved_by_attempt"] = dict(self.resolved_by_attempt)
+        st["success_ratio"] = self.stats["resolved"] / self.stats["started"] if self.stats["started"] else 0.0
+        return st
@@ -0,0 +1,47 @@
+import json
+import asyncio
+
+
+class EventBus:
+    """
+    Push-события для UI (SSE /api/events).
+    У каждого подписчика своя ограниченная очередь: медленная вкладка не тормозит ноду.
+    При переполнении очередь сбрасывается и подписчик получает "resync" - UI перечитывает состояние целиком.
+    """
+    def __init__(self, queue_size: int = 256):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self.published = 0
+        self.resyncs = 0
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event_type: str, **data):
+        """Не блокирует: вызывается из горячих путей ноды"""
+        if not self._subscribers: return
+        self.published += 1
+        event = (event_type, data)
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.resyncs += 1
+                while not queue.empty(): queue.get_nowait()
+                queue.put_nowait(("resync", {}))
+
+    @staticmethod
+    def format_sse(event_type: str, data: dict) -> str:
+        return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+    def get_stats(self) -> dict:
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "resyncs": self.resyncs,
+        }
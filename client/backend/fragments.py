@@ -0,0 +1,84 @@
+import time
+import base64
+from collections import OrderedDict
+
+class PartialMessage:
+    __slots__ = ("route_id", "count", "chunks", "size", "started")
+
+    def __init__(self, route_id: str, count: int, started: float):
+        self.route_id = route_id
+        self.count = count
+        self.chunks = {}  # seq -> кусок шифротекста
+        self.size = 0
+        self.started = started
+
+class Reassembly:
+    """
+    Сборка FRAG-пакетов в сообщение: (отправитель, группа) -> куски по номерам, в любом порядке
+    (фрагменты одного сообщения могут идти разными путями).
+    В памяти не больше max_messages незавершенных сообщений и max_bytes кусков: при переполнении
+    выбрасываются самые старые; незавершенные дольше timeout - тоже. Потерянный фрагмент
+    не запрашивается: отправитель без ACK повторит сообщение целиком новой группой (reliable.py).
+    """
+    def __init__(self, max_messages: int = 64, max_bytes: int = 4 * 1024 * 1024, max_fragments: int = 64,
+                 timeout: float = 120.0):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_fragments = max_fragments
+        self.timeout = timeout
+        self._partial = OrderedDict()  # В порядке первого фрагмента: слева самые старые
+        self._bytes = 0
+        self.stats = {"fragments": 0, "assembled": 0, "rejected": 0, "expired": 0, "evicted": 0}
+
+    def add(self, sender_id: str, packet: dict):
+        """Фрагмент (разобранный FRAG). Возвращает собранный DATA-пакет или None, пока кусков не хватает."""
+        now = time.time()
+        self.expire(now)
+        count, seq = packet['count'], packet['seq']
+        key = (sender_id, packet['group'])
+        partial = self._partial.get(key)
+        if count > self.max_fragments or seq >= count or (partial and partial.count != count):
+            self.stats["rejected"] += 1
+            return None
+        if partial is None:
+            partial = self._partial[key] = PartialMessage(packet['route_id'], count, now)
+        self.stats["fragments"] += 1
+        if seq in partial.chunks: return None
+        chunk = base64.b64decode(packet['content']) if packet.get('content') else b""
+        partial.chunks[seq] = chunk
+        partial.size += len(chunk)
+        self._bytes += len(chunk)
+
+        if len(partial.chunks) == count:
+            self._drop(key)
+            self.stats["assembled"] += 1
+            content = b"".join(partial.chunks[i] for i in range(count))
+            return {"type": "DATA", "id": packet['group'], "route_id": partial.route_id,
+                    "content": base64.b64encode(content).decode()}
+
+        while self._partial and (len(self._partial) > self.max_messages or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._partial)))
+            self.stats["evicted"] += 1
+        return None
+
+    def expire(self, now: float = None) -> int:
+        now = time.time() if now is None else now
+        stale = [key for key, partial in self._partial.items() if now - partial.started > self.timeout]
+        for key in stale: self._drop(key)
+        self.stats["expired"] += len(stale)
+        return len(stale)
+
+    def _drop(self, key):
+        partial = self._partial.pop(key)
+        self._bytes -= partial.size
+
+    def clear(self):
+        """Смена пользователя: куски зашифрованы для него"""
+        self._partial.clear()
+        self._bytes = 0
+
+    def get_stats(self) -> dict:
+        st = dict(self.stats)
+        st["partial"] = len(self._partial)
+        st["bytes"] = self._bytes
+        return st
@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+
+import wire
+
+KIND_PROBE = "probe"  # В кадре только PROBE - при перегрузке можно потерять
+KIND_DATA = "data"    # В кадре есть DATA (или FRAG/REFRESH) - не теряется никогда
+
+class PeerInbox:
+    __slots__ = ("peer_id", "frames", "space", "scheduled", "closed", "received", "dropped", "evicted", "blocked")
+
+    def __init__(self, peer_id: str):
+        self.peer_id = peer_id
+        self.frames = deque()  # (kind, [пакет, ...])
+        self.space = asyncio.Event()
+        self.scheduled = False  # Сосед стоит в круге обработчиков
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+        self.evicted = 0
+        self.blocked = 0
+
+class InboundQueues:
+    """
+    Входящие кадры: ограниченная очередь на соседа и общий пул обработчиков.
+    Чтение сокета только разбирает кадр и кладет пакеты в очередь, обработка (SQLite, крипто) идет в воркерах.
+    Соседи обслуживаются по кругу по одному кадру, так что шумный сосед не задерживает остальных.
+    Перегрузка: DUMMY в очередь не попадает вовсе, кадр только с PROBE отбрасывается,
+    кадр с DATA сначала вытесняет самый старый PROBE-кадр, а если таких нет - ждет места.
+    Ожидание останавливает чтение сокета, и давление уходит к соседу через TCP.
+    """
+    def __init__(self, handler, queue_size: int = 64, workers: int = 4):
+        self.handler = handler  # async handler(packets, peer_id)
+        self.queue_size = queue_size
+        self.workers = workers
+        self._inboxes = {}
+        self._ready = asyncio.Queue()  # PeerInbox с кадрами; каждый сосед в ней не больше одного раза
+        self._tasks = []
+        self.dummies = 0
+        self.processed = 0
+
+    def _ensure_workers(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def put(self, peer_id: str, packets: list):
+        if not packets:
+            self.dummies += 1
+            return
+        self._ensure_workers()
+        inbox = self._inboxes.get(peer_id)
+        if inbox is None:
+            inbox = self._inboxes[peer_id] = PeerInbox(peer_id)
+        inbox.received += 1
+
+        kind = KIND_DATA if any(wire.packet_type(raw) in wire.DATA_PATH_TYPES for raw in packets) else KIND_PROBE
+        while len(inbox.frames) >= self.queue_size:
+            if kind == KIND_PROBE:
+                inbox.dropped += 1
+                return
+            victim = next((frame for frame in inbox.frames if frame[0] == KIND_PROBE), None)
+            if victim:
+                inbox.frames.remove(victim)
+                inbox.evicted += 1
+                continue
+            inbox.blocked += 1
+            inbox.space.clear()
+            await inbox.space.wait()
+            if inbox.closed: return
+
+        inbox.frames.append((kind, packets))
+        if not inbox.scheduled:
+            inbox.scheduled = True
+            self._ready.put_nowait(inbox)
+
+    def close_peer(self, peer_id: str):
+        """Сосед отключен: его необработанные кадры выбрасываются, ждущее чтение отпускается"""
+        inbox = self._inboxes.pop(peer_id, None)
+        if inbox:
+            inbox.closed = True
+            inbox.frames.clear()
+            inbox.space.set()
+
+    async def _worker(self):
+        while True:
+            inbox = await self._ready.get()
+            if inbox.closed or not inbox.frames:
+                inbox.scheduled = False
+                continue
+            _, packets = inbox.frames.popleft()
+            inbox.space.set()
+            try:
+                await self.handler(packets, inbox.peer_id)
+            except Exception as e:
+                print(f"❌ Packet error: {e}")
+            self.processed += 1
+            # Следующий кадр этого соседа - в конец круга
+            if inbox.frames and not inbox.closed:
+                self._ready.put_nowait(inbox)
+            else:
+                inbox.scheduled = False
+
+    def stop(self):
+        for task in self._tasks: task.cancel()
+        self._tasks = []
+
+    def get_stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "queue_size": self.queue_size,
+            "depth": sum(len(inbox.frames) for inbox in self._inboxes.values()),
+            "ready": self._ready.qsize(),
+            "processed": self.processed,
+            "dummies": self.dummies,
+            "peers": {
+                peer_id: {"depth": len(inbox.frames), "received": inbox.received, "dropped": inbox.dropped,
+                          "evicted": inbox.evicted, "blocked": inbox.blocked}
+                for peer_id, inbox in self._inboxes.items()
+            },
+        }
@@ -0,0 +1,101 @@
+import asyncio
+import time
+from database import DatabaseManager
+from network import P2PNode
+
+class DatabaseJanitor:
+    """
+    Фоновая чистка системной БД.
+    Удаляет устаревшие строки небольшими порциями, чтобы не занимать писателя надолго,
+    и периодически делает checkpoint / VACUUM.
+    """
+    def __init__(self, db: DatabaseManager, node: P2PNode, interval: float = 60.0, chunk_size: int = 500,
+                 seen_retention: float = 3600.0, outbox_stale_after: float = 120.0, outbox_max_age: float = 1800.0,
+                 mailbox_retention: float = 7 * 24 * 3600.0, vacuum_interval: float = 6 * 3600.0,
+                 vacuum_min_free_ratio: float = 0.2):
+        self.db = db
+        self.node = node
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.seen_retention = seen_retention
+        self.outbox_stale_after = outbox_stale_after
+        self.outbox_max_age = outbox_max_age
+        self.mailbox_retention = mailbox_retention
+        self.vacuum_interval = vacuum_interval
+        self.vacuum_min_free_ratio = vacuum_min_free_ratio
+        self.running = False
+
+        self.passes = 0
+        self.last_pass = {}
+        self.total = {}
+        self.last_vacuum = time.time()
+
+    async def start(self):
+        self.running = True
+        print(f"🧹 [GC] Janitor started. Interval: {self.interval}s")
+        while self.running:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_pass()
+            except Exception as e:
+                print(f"❌ [GC] Pass failed: {e}")
+
+    async def run_pass(self) -> dict:
+        reclaimed = {}
+
+        # Маршруты: истекшие выбрасываем из памяти и из routing_table
+        reclaimed["routing_table"] = await self.db.expire_routes()
+        reclaimed["routing_table"] += await self._delete_chunked("routing_table", "expires_at <= ?", (time.time(),))
+
+        # Дедупликация: кешу в памяти хватает окна, в таблице держим историю для отладки
+        reclaimed["seen_packets"] = await self._delete_chunked(
+            "seen_packets", "received_at < datetime('now', ?)", (f"-{int(self.seen_retention)} seconds",))
+
+        # Исходящие: адресные пакеты соседям, которые ушли, и все слишком старые.
+        # Очередь живет в памяти (outbox.py), журнал чистится вместе с ней
+        reclaimed["outbox"] = await self.node.outbox.purge(
+            set(self.node.active_connections), self.outbox_stale_after, self.outbox_max_age)
+
+        reclaimed["offline_mailbox"] = await self._delete_chunked(
+            "offline_mailbox", "received_at < datetime('now', ?)", (f"-{int(self.mailbox_retention)} seconds",))
+
+        await self.db.run_exclusive("PRAGMA wal_checkpoint(TRUNCATE)")
+        if time.time() - self.last_vacuum >= self.vacuum_interval:
+            await self._maybe_vacuum()
+
+        self.passes += 1
+        self.last_pass = reclaimed
+        for table, count in reclaimed.items():
+            self.total[table] = self.total.get(table, 0) + count
+        if any(reclaimed.values()):
+            print(f"🧹 [GC] Reclaimed: {reclaimed}")
+        return reclaimed
+
+    async def _delete_chunked(self, table: str, where: str, params=()) -> int:
+        """Удаляет строки порциями по chunk_size, отдавая управление между ними."""
+        deleted = 0
+        while True:
+            cursor = await self.db.execute_write(
+                f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?)",
+                (*params, self.chunk_size), durable=True)
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.chunk_size:
+                return deleted
+            await asyncio.sleep(0)
+
+    async def _maybe_vacuum(self):
+        self.last_vacuum = time.time()
+        (page_count,), = await self.db.run_exclusive("PRAGMA page_count")
+        (freelist,), = await self.db.run_exclusive("PRAGMA freelist_count")
+        # VACUUM переписывает весь файл - только если свободных страниц много
+        if page_count and freelist / page_count >= self.vacuum_min_free_ratio:
+            print(f"🧹 [GC] VACUUM ({freelist}/{page_count} pages free)")
+            await self.db.run_exclusive("VACUUM")
+
+    def get_stats(self) -> dict:
+        return {
+            "passes": self.passes,
+            "last_pass": self.last_pass,
+            "total": self.total,
+            "last_vacuum": self.last_vacuum,
+        }
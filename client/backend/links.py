@@ -0,0 +1,119 @@
+import time
+import random
+from collections import Counter
+
+import wire
+
+def _now_ms() -> int:
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+class LinkStats:
+    __slots__ = ("srtt", "rttvar", "loss", "samples", "peer_ts", "peer_ts_at", "last_echo")
+
+    def __init__(self):
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.loss = 0.0
+        self.samples = 0
+        self.peer_ts = 0        # Последний ts соседа - уйдет эхом в нашем кадре
+        self.peer_ts_at = 0     # Когда (по нашим часам) он пришел
+        self.last_echo = None   # Последнее учтенное эхо, чтобы не считать один замер дважды
+
+class LinkMonitor:
+    """
+    Качество каналов до соседей по кадрам такта (они идут постоянно, DUMMY тоже).
+    RTT: в бинарный кадр пишется наш ts и эхо последнего ts соседа со временем удержания,
+    RTT = сейчас - эхо - удержание, сравниваются только свои часы. Сглаживание как в TCP (RFC 6298).
+    Потери: EWMA доли кадров, которые не ушли соседу (очередь переполнена, таймаут отправки).
+    По этим оценкам выбирается следующий хоп для DATA среди почти равных путей.
+    """
+    def __init__(self, hop_cost: float = 750.0, spread: float = 0.25, default_rtt: float = 200.0,
+                 loss_alpha: float = 0.05):
+        self.hop_cost = hop_cost        # мс на хоп: ожидание такта у соседа
+        self.spread = spread            # Пути дороже лучшего не больше чем на spread делят нагрузку
+        self.default_rtt = default_rtt  # мс, пока замеров нет
+        self.loss_alpha = loss_alpha
+        self._links = {}
+        self.chosen = Counter()  # next_hop -> сколько DATA отдано через него
+
+    def _link(self, peer_id: str) -> LinkStats:
+        link = self._links.get(peer_id)
+        if link is None: link = self._links[peer_id] = LinkStats()
+        return link
+
+    def stamp(self, peer_id: str, frame: bytes) -> bytes:
+        """Отметки времени в кадр перед самой отправкой (очередь отправки входит в RTT)"""
+        now = _now_ms()
+        link = self._link(peer_id)
+        echo_delay = (now - link.peer_ts_at) & 0xFFFFFFFF if link.peer_ts else 0
+        return wire.stamp_frame(frame, now, link.peer_ts, echo_delay)
+
+    def on_frame(self, peer_id: str, data: bytes):
+        timing = wire.frame_timing(data)
+        if timing is None: return
+        ts, echo_ts, echo_delay = timing
+        now = _now_ms()
+        link = self._link(peer_id)
+        link.peer_ts, link.peer_ts_at = ts, now
+        if not echo_ts or echo_ts == link.last_echo: return
+        link.last_echo = echo_ts
+        rtt = ((now - echo_ts) & 0xFFFFFFFF) - echo_delay
+        if rtt < 0 or rtt > 60000: return  # Эхо от прошлого соединения или переполнение удержания
+        if not link.samples:
+            link.srtt, link.rttvar = float(rtt), rtt / 2
+        else:
+            link.rttvar = 0.75 * link.rttvar + 0.25 * abs(link.srtt - rtt)
+            link.srtt = 0.875 * link.srtt + 0.125 * rtt
+        link.samples += 1
+
+    def on_send(self, peer_id: str, ok: bool):
+        link = self._link(peer_id)
+        link.loss += self.loss_alpha * ((0.0 if ok else 1.0) - link.loss)
+
+    def forget(self, peer_id: str):
+        self._links.pop(peer_id, None)
+        self.chosen.pop(peer_id, None)
+
+    def rtt(self, peer_id: str) -> float:
+        link = self._links.get(peer_id)
+        if link and link.samples: return link.srtt
+        # Без замеров - среднее по измеренным соседям
+        measured = [link.srtt for link in self._links.values() if link.samples]
+        return sum(measured) / len(measured) if measured else self.default_rtt
+
+    def path_cost(self, route: dict) -> float:
+        """Ожидаемая задержка пути (мс): хопы до цели и полпути RTT до соседа, с поправкой на потери"""
+        link = self._links.get(route['next_hop_id'])
+        loss = link.loss if link else 0.0
+        return (route['metric'] * self.hop_cost + self.rtt(route['next_hop_id']) / 2) / max(1.0 - loss, 0.05)
+
+    def choose(self, routes: list):
+        """
+        Выбор пути среди доступных: пути не дороже лучшего на spread делят DATA случайно
+        с весом 1/цена, остальные ждут отказа лучших. Цена пишется в запись маршрута.
+        """
+        if not routes: return None
+        costs = []
+        for route in routes:
+            route['cost'] = cost = max(self.path_cost(route), 1e-3)
+            costs.append(cost)
+        best = min(costs)
+        near = [(route, cost) for route, cost in zip(routes, costs) if cost <= best * (1 + self.spread)]
+        if len(near) == 1:
+            route = near[0][0]
+        else:
+            route = random.choices([route for route, _ in near], weights=[1 / cost for _, cost in near])[0]
+        self.chosen[route['next_hop_id']] += 1
+        return route
+
+    def best(self, routes: list):
+        """Самый дешевый путь без случайности и без учета в chosen (служебный трафик: REFRESH)"""
+        if not routes: return None
+        return min(routes, key=self.path_cost)
+
+    def get_stats(self) -> dict:
+        return {
+            peer_id: {"srtt_ms": round(link.srtt, 1), "rttvar_ms": round(link.rttvar, 1), "samples": link.samples,
+                      "loss": round(link.loss, 4), "chosen": self.chosen.get(peer_id, 0)}
+            for peer_id, link in self._links.items()
+        }
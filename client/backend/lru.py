@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Ограниченный LRU-кеш. Потокобезопасен: используется и из пула потоков крипто-операций.
+    Кроме числа записей можно ограничить суммарный размер (max_bytes, размер записи считает sizeof).
+    """
+    def __init__(self, maxsize: int = 256, max_bytes: int = 0, sizeof=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if self.sizeof:
+                size = self.sizeof(value)
+                self.bytes += size - self._sizes.get(key, 0)
+                self._sizes[key] = size
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while self._data and (len(self._data) > self.maxsize or
+                                  (self.max_bytes and self.bytes > self.max_bytes)):
+                old_key, _ = self._data.popitem(last=False)
+                self.bytes -= self._sizes.pop(old_key, 0)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self.bytes -= self._sizes.pop(key, 0)
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,249 @@
+import json
+import aiosqlite
+
+import wire
+
+# --- СХЕМЫ БД И МИГРАЦИИ ---
+# Системная БД демона (bootstrap_peers.db) и БД пользователя (node_<id>.db) имеют разные схемы.
+# Версия схемы хранится в PRAGMA user_version. Шаги идемпотентны (IF NOT EXISTS, проверка колонок),
+# поэтому старые базы без версии спокойно проходят все шаги с первого.
+
+SYSTEM = "system"
+USER = "user"
+
+# ТАБЛИЦЫ ДЕМОНА (System DB)
+SYSTEM_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS neighbors (
+        user_id TEXT PRIMARY KEY,
+        address TEXT,
+        last_seen TEXT
+    )
+    """,
+    # Очередь исходящих пакетов
+    """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        packet_id TEXT,
+        next_hop_id TEXT,
+        packet_json TEXT,
+        exclude_peer TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # Дедупликация (храним RouteID поисков и PacketID данных)
+    """
+    CREATE TABLE IF NOT EXISTS seen_packets (
+        packet_id TEXT PRIMARY KEY,
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS local_users (user_id TEXT PRIMARY KEY)",
+    # Хранилище для офлайн-доставки
+    """
+    CREATE TABLE IF NOT EXISTS offline_mailbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        target_id TEXT,
+        packet_json TEXT,
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # ТАБЛИЦА МАРШРУТИЗАЦИИ (Beta-2)
+    # route_id - хеш, определяющий направление (A->B или B->A)
+    # next_hop_id - сосед, через которого лежит путь
+    # is_local - флаг, если маршрут ведет к локальному пользователю на этой ноде
+    """
+    CREATE TABLE IF NOT EXISTS routing_table (
+        route_id TEXT,
+        next_hop_id TEXT,
+        metric INTEGER,
+        is_local INTEGER DEFAULT 0,
+        remote_user_id TEXT,
+        expires_at TIMESTAMP,
+        PRIMARY KEY (route_id, next_hop_id)
+    )
+    """,
+]
+
+# Индексы под горячие запросы демона (см. HOT_QUERIES)
+SYSTEM_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_outbox_created ON outbox(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_outbox_packet ON outbox(packet_id)",
+    "CREATE INDEX IF NOT EXISTS idx_mailbox_target ON offline_mailbox(target_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_mailbox_received ON offline_mailbox(received_at)",
+    "CREATE INDEX IF NOT EXISTS idx_routes_expires ON routing_table(expires_at)",
+    "CREATE INDEX IF NOT EXISTS idx_seen_received ON seen_packets(received_at)",
+]
+
+# ТАБЛИЦЫ ПОЛЬЗОВАТЕЛЯ (User DB)
+USER_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        packet_id TEXT UNIQUE,
+        chat_id TEXT,
+        sender_id TEXT,
+        content TEXT,
+        timestamp TEXT,
+        is_outgoing INTEGER,
+        is_read INTEGER DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS contacts (
+        user_id TEXT PRIMARY KEY,
+        nickname TEXT,
+        last_seen TEXT
+    )
+    """,
+]
+
+USER_INDEXES = [
+    # Keyset-пагинация истории: WHERE chat_id = ? AND id < ? ORDER BY id
+    "CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id)",
+]
+
+# Счетчики непрочитанных в contacts.unread_count ведут триггеры:
+# они срабатывают в той же транзакции, что и INSERT сообщения или UPDATE is_read.
+UNREAD_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_messages_unread_insert
+    AFTER INSERT ON messages WHEN NEW.is_outgoing = 0 AND NEW.is_read = 0
+    BEGIN
+        INSERT INTO contacts (user_id, unread_count) VALUES (NEW.chat_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET unread_count = unread_count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_messages_unread_read
+    AFTER UPDATE OF is_read ON messages
+    WHEN NEW.is_outgoing = 0 AND OLD.is_read = 0 AND NEW.is_read = 1
+    BEGIN
+        UPDATE contacts SET unread_count = MAX(unread_count - 1, 0) WHERE user_id = NEW.chat_id;
+    END
+    """,
+]
+
+# Полный пересчет contacts.unread_count по messages
+REBUILD_UNREAD = [
+    """
+    INSERT OR IGNORE INTO contacts (user_id)
+    SELECT DISTINCT chat_id FROM messages WHERE is_outgoing = 0 AND is_read = 0
+    """,
+    """
+    UPDATE contacts SET unread_count = (
+        SELECT COUNT(*) FROM messages
+        WHERE chat_id = contacts.user_id AND is_read = 0 AND is_outgoing = 0
+    )
+    """,
+]
+
+async def _add_unread_counters(conn: aiosqlite.Connection):
+    columns = [row[1] for row in await conn.execute_fetchall("PRAGMA table_info(contacts)")]
+    if "unread_count" not in columns:
+        await conn.execute("ALTER TABLE contacts ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0")
+    for sql in UNREAD_TRIGGERS + REBUILD_UNREAD:
+        await conn.execute(sql)
+
+async def _add_outbox_priority(conn: aiosqlite.Connection):
+    # outbox стал журналом очереди в памяти (outbox.py): нужен класс приоритета пакета
+    columns = [row[1] for row in await conn.execute_fetchall("PRAGMA table_info(outbox)")]
+    if "priority" not in columns:
+        await conn.execute("ALTER TABLE outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 2")
+
+async def _add_message_status(conn: aiosqlite.Connection):
+    # Статус своих сообщений (queued/sent/delivered/failed) по ACK получателя; у старых - NULL
+    columns = [row[1] for row in await conn.execute_fetchall("PRAGMA table_info(messages)")]
+    if "status" not in columns:
+        await conn.execute("ALTER TABLE messages ADD COLUMN status TEXT")
+
+# Свои сообщения без ACK: восстанавливаются в окно при входе (network.restore_outgoing)
+PENDING_INDEX = [
+    "CREATE INDEX IF NOT EXISTS idx_messages_pending ON messages(id) WHERE is_outgoing = 1 AND status IN ('queued', 'sent')",
+]
+
+async def _binary_outbox(conn: aiosqlite.Connection):
+    # Журнал outbox хранит бинарные пакеты (wire.py): JSON-строки старых версий перекодируются,
+    # нераспознанные удаляются - иначе они отравили бы кадры такта
+    rows = await conn.execute_fetchall("SELECT id, packet_json FROM outbox WHERE typeof(packet_json) != 'blob'")
+    converted, dropped = [], []
+    for row_id, packet_json in rows:
+        try:
+            converted.append((wire.encode_packet(json.loads(packet_json)), row_id))
+        except Exception:
+            dropped.append((row_id,))
+    if converted: await conn.executemany("UPDATE outbox SET packet_json = ? WHERE id = ?", converted)
+    if dropped: await conn.executemany("DELETE FROM outbox WHERE id = ?", dropped)
+
+# (версия, шаг): шаг - список SQL или async-функция от соединения
+MIGRATIONS = {
+    SYSTEM: [
+        (1, SYSTEM_TABLES),
+        (2, SYSTEM_INDEXES),
+        (3, _add_outbox_priority),
+        (4, _binary_outbox),
+    ],
+    USER: [
+        (1, USER_TABLES),
+        (2, USER_INDEXES),
+        (3, _add_unread_counters),
+        (4, _add_message_status),
+        (5, PENDING_INDEX),
+    ],
+}
+
+async def get_version(conn: aiosqlite.Connection) -> int:
+    (version,), = await conn.execute_fetchall("PRAGMA user_version")
+    return version
+
+async def migrate(conn: aiosqlite.Connection, schema: str) -> int:
+    """Доводит схему до последней версии. Возвращает итоговую версию."""
+    version = await get_version(conn)
+    for target, step in MIGRATIONS[schema]:
+        if target <= version: continue
+        if callable(step):
+            await step(conn)
+        else:
+            for sql in step: await conn.execute(sql)
+        await conn.execute(f"PRAGMA user_version = {target}")
+        await conn.commit()
+        print(f"🗄️ [DB] {schema} schema -> v{target}")
+        version = target
+    return version
+
+# --- ПЛАНЫ ГОРЯЧИХ ЗАПРОСОВ ---
+# Каждый запрос должен идти по индексу: полный SCAN таблицы или сортировка во временном B-дереве
+# означают, что индекс пропал или запрос перестал ему соответствовать.
+
+HOT_QUERIES = {
+    SYSTEM: {
+        "outbox_journal_delete": ("DELETE FROM outbox WHERE id = ?", (1,)),
+        "mailbox_fetch": ("SELECT id, packet_json FROM offline_mailbox WHERE target_id = ?", ("x",)),
+        "gc_mailbox_age": ("SELECT rowid FROM offline_mailbox WHERE received_at < datetime('now', ?) LIMIT ?", ("-60 seconds", 500)),
+        "routes_load": ("SELECT * FROM routing_table WHERE expires_at > ?", (0,)),
+        "gc_routes_expired": ("SELECT rowid FROM routing_table WHERE expires_at <= ? LIMIT ?", (0, 500)),
+        "seen_warm": ("SELECT packet_id FROM seen_packets WHERE received_at > datetime('now', ?)", ("-600 seconds",)),
+        "gc_seen_age": ("SELECT rowid FROM seen_packets WHERE received_at < datetime('now', ?) LIMIT ?", ("-3600 seconds", 500)),
+    },
+    USER: {
+        "history_latest": ("SELECT * FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?", ("x", 50)),
+        "history_before": ("SELECT * FROM messages WHERE chat_id = ? AND id < ? ORDER BY id DESC LIMIT ?", ("x", 1, 50)),
+        "history_after": ("SELECT * FROM messages WHERE chat_id = ? AND id > ? ORDER BY id ASC LIMIT ?", ("x", 1, 50)),
+        "mark_read": ("UPDATE messages SET is_read = 1 WHERE chat_id = ? AND is_outgoing = 0 AND is_read = 0 AND id <= ?", ("x", 1)),
+        "message_by_packet": ("SELECT id FROM messages WHERE packet_id = ?", ("x",)),
+        "outgoing_pending": ("SELECT packet_id, chat_id, content, timestamp, status FROM messages WHERE is_outgoing = 1 AND status IN ('queued', 'sent') ORDER BY id", ()),
+        "set_status": ("UPDATE messages SET status = ? WHERE packet_id = ?", ("sent", "x")),
+    },
+}
+
+def is_full_scan(detail: str) -> bool:
+    return (detail.startswith("SCAN") and "USING" not in detail) or "TEMP B-TREE" in detail
+
+async def check_query_plans(conn: aiosqlite.Connection, schema: str) -> dict:
+    """EXPLAIN QUERY PLAN для горячих запросов схемы: {имя: {"plan": [...], "full_scan": bool}}"""
+    report = {}
+    for name, (sql, params) in HOT_QUERIES[schema].items():
+        rows = await conn.execute_fetchall(f"EXPLAIN QUERY PLAN {sql}", params)
+        plan = [row[3] for row in rows]
+        report[name] = {"plan": plan, "full_scan": any(is_full_scan(detail) for detail in plan)}
+    return report
@@ -1,258 +1,612 @@
-import asyncio
-import json
-import uuid
-import time
-from datetime import datetime
-from websockets.server import serve
-from websockets.client import connect as ws_connect
-from database import DatabaseManager
-
-class P2PNode:
-    def __init__(self, system_db: DatabaseManager):
-        self.system_db = system_db
-        self.active_connections = {} 
-        self.active_user_id = None
-        self.active_user_db = None
-        self.active_crypto = None
-
-    def set_active_user(self, user_id, user_db, crypto):
-        self.active_user_id = user_id
-        self.active_user_db = user_db
-        self.active_crypto = crypto
-
-    def remove_active_user(self):
-        self.active_user_id = None
-        self.active_user_db = None
-        self.active_crypto = None
-
-    async def start_server(self, port: int):
-        print(f"🌐 [P2P] Daemon listening on port {port}")
-        async with serve(self._handle_incoming, "0.0.0.0", port):
-            await asyncio.Future()
-
-    async def connect_to(self, address: str):
-        try:
-            uri = f"ws://{address}"
-            ws = await ws_connect(uri, open_timeout=5)
-            my_id_handshake = self.active_user_id if self.active_user_id else "daemon_node"
-            await ws.send(my_id_handshake)
-            peer_id = await ws.recv()
-            
-            if peer_id == my_id_handshake and peer_id != "daemon_node":
-                 await ws.close()
-                 return False
-
-            self.active_connections[peer_id] = ws
-            print(f"✅ [P2P] Connected to neighbor {peer_id[:8]}")
-            
-            await self.system_db.conn.execute("""
-                INSERT INTO neighbors (user_id, address, last_seen) 
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET last_seen=excluded.last_seen
-            """, (peer_id, address, datetime.now().isoformat()))
-            await self.system_db.conn.commit()
-            
-            asyncio.create_task(self._listen_socket(ws, peer_id))
-            return True
-        except Exception as e:
-            print(f"❌ [P2P] Connection failed: {e}")
-            return False
-
-    async def _handle_incoming(self, websocket):
-        try:
-            peer_id = await websocket.recv()
-            my_id_handshake = self.active_user_id if self.active_user_id else "daemon_node"
-            await websocket.send(my_id_handshake)
-            self.active_connections[peer_id] = websocket
-            print(f"🔗 [P2P] Neighbor connected: {peer_id[:8]}")
-            await self.system_db.conn.execute("""
-                INSERT INTO neighbors (user_id, address, last_seen) 
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET last_seen=excluded.last_seen
-            """, (peer_id, "incoming", datetime.now().isoformat()))
-            await self.system_db.conn.commit()
-            await self._listen_socket(websocket, peer_id)
-        except Exception: pass
-
-    async def _listen_socket(self, websocket, peer_id):
-        try:
-            async for message in websocket:
-                await self._process_envelope(message, from_peer=peer_id)
-        except:
-            if peer_id in self.active_connections: del self.active_connections[peer_id]
-
-    async def _process_envelope(self, envelope_json: str, from_peer: str):
-        try:
-            envelope = json.loads(envelope_json)
-            if envelope.get("t") == "DUMMY": return
-
-            if envelope.get("t") == "REAL":
-                inner_json = envelope.get("d")
-                packet = json.loads(inner_json)
-                pkt_type = packet.get("type")
-                pkt_id = packet.get("id")
-
-                # В Beta-2 мы регистрируем ВСЕ пакеты (PROBE и DATA) для трекера
-                is_new = await self.system_db.mark_packet_seen(pkt_id)
-
-                if pkt_type == "PROBE":
-                    # Для PROBE дедупликация внутри метода (нужно записать путь до отсева)
-                    await self._handle_probe(packet, from_peer, is_new)
-                elif pkt_type == "DATA":
-                    # Для DATA обрабатываем только если видим впервые
-                    if is_new:
-                        await self._handle_data(packet, from_peer)
-        except Exception as e:
-            print(f"❌ Packet error: {e}")
-
-    async def _handle_probe(self, packet, from_peer, is_new_probe):
-        probe_id = packet['id']
-        route_id = packet['route_id']   
-        rev_id = packet['rev_id']       
-        target_hash = packet['target_hash']
-        metric = packet['metric']
-
-        # 1. ЗАПИСЬ МАРШРУТА (Паутина строится здесь)
-        # Мы записываем rev_id, потому что этот путь ведет НАЗАД к источнику пробы
-        # ВАЖНО: Не перезаписываем LOCAL маршрут удаленным!
-        existing_rev = await self.system_db.get_best_route(rev_id)
-        if not (existing_rev and existing_rev['is_local']):
-            await self.system_db.add_route(rev_id, from_peer, metric + 1)
-
-        # 2. ПРОВЕРКА ЦЕЛИ
-        if self.active_user_id and self.active_crypto:
-            if self.active_crypto.get_target_hash(self.active_user_id) == target_hash:
-                # МЫ - ЦЕЛЬ (Боб). Обрабатываем только один раз.
-                if is_new_probe:
-                    sender_id_json = self.active_crypto.decrypt_from_probe(packet['auth'])
-                    if sender_id_json:
-                        try:
-                            sender_data = json.loads(sender_id_json)
-                            sender_id = sender_data.get('sid')
-                            
-                            # Проверяем подпись (A+B).signature(A)
-                            sig_data = sender_id + self.active_user_id
-                            if self.active_crypto.verify_sig(sender_id, sig_data, packet['sig']):
-                                print(f"🎯 [PROBE] Validated source: {sender_id[:8]}")
-                                
-                                # Боб метит ВХОДЯЩИЙ канал Алисы как LOCAL для себя
-                                await self.system_db.add_route(route_id, "LOCAL", 0, is_local=1, remote_user_id=sender_id)
-
-                                # Доставляем сообщение (E2EE)
-                                if packet.get('content'):
-                                    await self._deliver_to_active_user(packet, sender_id)
-                                
-                                # РАЗРЫВ ПЕТЛИ: Проверяем, не является ли rev_id уже локальным (значит мы Алиса)
-                                if existing_rev and existing_rev['is_local']:
-                                    return # Мы Алиса, получили ответ от Боба, цепочка замкнулась.
-
-                                # Если мы Боб - шлем ответную пробу
-                                await self._send_probe_response(sender_id)
-                        except Exception as e:
-                            print(f"Probe validation error: {e}")
-                return 
-
-        # 3. РЕТРАНСЛЯЦИЯ (Если пакет новый и TTL позволяет)
-        if is_new_probe and packet['ttl'] > 0:
-            packet['ttl'] -= 1
-            packet['metric'] += 1
-            await self.system_db.conn.execute("""
-                INSERT INTO outbox (packet_id, next_hop_id, packet_json, exclude_peer) 
-                VALUES (?, NULL, ?, ?)
-            """, (probe_id, json.dumps(packet), from_peer))
-            await self.system_db.conn.commit()
-
-    async def _send_probe_response(self, requester_id):
-        """Боб отправляет свою пробу Алисе в ответ"""
-        print(f"🔄 [PROBE] Sending symmetric response to {requester_id[:8]}")
-        
-        # Для Боба: прямой канал (route_id) это B+A, обратный (rev_id) это A+B
-        route_id = self.active_crypto.get_route_id(self.active_user_id, requester_id)
-        rev_id = self.active_crypto.get_route_id(requester_id, self.active_user_id)
-        
-        signature = self.active_crypto.sign_data(self.active_user_id + requester_id)
-        auth_payload = self.active_crypto.encrypt_for_probe(requester_id, json.dumps({"sid": self.active_user_id}))
-        
-        # Техническое сообщение о хендшейке
-        e2e_content = self.active_crypto.encrypt_message(requester_id, "🤝 [System] Connection established")
-        
-        probe_pkt_id = str(uuid.uuid4())
-        probe_packet = {
-            "type": "PROBE",
-            "id": probe_pkt_id,
-            "route_id": route_id,
-            "rev_id": rev_id,
-            "target_hash": self.active_crypto.get_target_hash(requester_id),
-            "metric": 0,
-            "ttl": 20,
-            "auth": auth_payload,
-            "sig": signature,
-            "content": e2e_content
-        }
-        
-        # Боб метит СВОЙ исходящий канал как LOCAL (чтобы не отвечать самому себе)
-        await self.system_db.add_route(route_id, "LOCAL", 0, is_local=1, remote_user_id=requester_id)
-        await self.system_db.mark_packet_seen(probe_pkt_id)
-        
-        await self.system_db.conn.execute("""
-            INSERT INTO outbox (packet_id, next_hop_id, packet_json, exclude_peer) 
-            VALUES (?, NULL, ?, NULL)
-        """, (probe_pkt_id, json.dumps(probe_packet)))
-        await self.system_db.conn.commit()
-
-    async def _handle_data(self, packet, from_peer):
-        """Пересылка данных с поддержкой Multipath Failover"""
-        route_id = packet.get('route_id')
-        
-        # Ищем ВСЕ возможные пути, отсортированные по метрике (от лучшего к худшему)
-        async with self.system_db.conn.execute("""
-            SELECT next_hop_id, is_local, remote_user_id FROM routing_table 
-            WHERE route_id = ? AND expires_at > ? 
-            ORDER BY metric ASC
-        """, (route_id, time.time())) as cursor:
-            routes = await cursor.fetchall()
-        
-        if not routes: return 
-
-        for route in routes:
-            if route['is_local']:
-                if self.active_user_id:
-                    await self._deliver_to_active_user(packet, route['remote_user_id'])
-                return
-            
-            # Проверяем, активен ли этот сосед прямо сейчас
-            next_hop = route['next_hop_id']
-            if next_hop in self.active_connections:
-                await self.system_db.conn.execute("""
-                    INSERT INTO outbox (packet_id, next_hop_id, packet_json, exclude_peer) 
-                    VALUES (?, ?, ?, ?)
-                """, (packet['id'], next_hop, json.dumps(packet), from_peer))
-                await self.system_db.conn.commit()
-                return 
-
-    async def _deliver_to_active_user(self, packet, sender_id):
-        """Финальная доставка сообщения в БД пользователя с дедупликацией по packet_id"""
-        try:
-            decrypted_text = self.active_crypto.decrypt_message(sender_id, packet.get("content"))
-            msg_uuid = packet.get('id')
-
-            # Дедупликация в БД пользователя по packet_id (колонка UNIQUE)
-            try:
-                local_content = self.active_crypto.encrypt_db_field(decrypted_text)
-                await self.active_user_db.conn.execute("""
-                    INSERT INTO messages (packet_id, chat_id, sender_id, content, timestamp, is_outgoing, is_read) 
-                    VALUES (?, ?, ?, ?, ?, 0, 0)
-                """, (msg_uuid, sender_id, sender_id, local_content, datetime.now().isoformat()))
-                
-                await self.active_user_db.conn.execute("""
-                    INSERT INTO contacts (user_id, last_seen) VALUES (?, ?) 
-                    ON CONFLICT(user_id) DO UPDATE SET last_seen=excluded.last_seen
-                """, (sender_id, datetime.now().isoformat()))
-                
-                await self.active_user_db.conn.commit()
-                print(f"📨 [MAIL] Delivered from {sender_id[:8]}")
-            except: 
-                # Если packet_id уже есть, INSERT упадет - это и есть дедупликация
-                pass 
-        except Exception as e:
-            print(f"Delivery error: {e}")
\ No newline at end of file
+import asyncio
+import json
+import uuid
+import time
+from datetime import datetime
+from websockets.server import serve
+from websockets.client import connect as ws_connect
+from database import DatabaseManager
+from outbox import Outbox, PRIO_OWN, PRIO_DATA, PRIO_PROBE
+from discovery import RouteDiscovery
+from inbound import InboundQueues
+from links import LinkMonitor
+from refresh import ActiveRoutes
+from probe_policy import ProbePolicy
+from reliable import ReliableSender, OutgoingMessage
+from fragments import Reassembly
+from crypto import MAX_MESSAGE_AGE
+import wire
+
+class P2PNode:
+    def __init__(self, system_db: DatabaseManager, crypto_pool=None, events=None, outbox: Outbox = None,
+                 discovery: RouteDiscovery = None, inbound_queue_size: int = 64, inbound_workers: int = 4,
+                 links: LinkMonitor = None, active_routes: ActiveRoutes = None, probe_policy: ProbePolicy = None,
+                 reliable: ReliableSender = None, reassembly: Reassembly = None, frame_size: int = 4096):
+        self.system_db = system_db
+        self.outbox = outbox or Outbox(system_db)  # Приоритетная очередь исходящих (журнал в outbox)
+        self.discovery = discovery or RouteDiscovery()  # Идущие поиски маршрута
+        self.inbound = InboundQueues(self._process_frame, inbound_queue_size, inbound_workers)
+        self.links = links or LinkMonitor()  # RTT/потери до соседей и выбор пути для DATA
+        self.active_routes = active_routes or ActiveRoutes()  # Разговоры, чьи маршруты продлеваются REFRESH
+        self.probe_policy = probe_policy or ProbePolicy()      # Кому и как далеко пересылать PROBE
+        self.reliable = reliable or ReliableSender()           # Окно своих сообщений без ACK и повторы
+        self.reassembly = reassembly or Reassembly()           # Сборка входящих FRAG
+        self.frame_size = frame_size  # Размер кадра такта: больше - свои сообщения режутся на FRAG
+        self.crypto_pool = crypto_pool  # CryptoWorkerPool: libsodium вне event loop
+        self.events = events            # EventBus: push-уведомления для UI
+        self.active_connections = {} 
+        self.degraded_peers = set()  # Соседи, не успевающие принимать кадры такта
+        self.wire_formats = {}       # peer_id -> формат кадров, согласованный в хендшейке
+        self.active_user_id = None
+        self.active_user_db = None
+        self.active_crypto = None
+
+    def set_active_user(self, user_id, user_db, crypto):
+        self.active_user_id = user_id
+        self.active_user_db = user_db
+        self.active_crypto = crypto
+        self.discovery.clear()
+        self.active_routes.clear()
+        self.reliable.clear()
+        self.reassembly.clear()
+
+    def remove_active_user(self):
+        self.active_user_id = None
+        self.active_user_db = None
+        self.active_crypto = None
+        self.discovery.clear()
+        self.active_routes.clear()
+        self.reliable.clear()
+        self.reassembly.clear()
+
+    def _publish(self, event_type: str, **data):
+        if self.events: self.events.publish(event_type, **data)
+
+    async def _run_crypto(self, fn, *args):
+        if self.crypto_pool: return await self.crypto_pool.run(fn, *args)
+        return fn(*args)
+
+    async def start_server(self, port: int):
+        print(f"🌐 [P2P] Daemon listening on port {port}")
+        async with serve(self._handle_incoming, "0.0.0.0", port):
+            await asyncio.Future()
+
+    async def connect_to(self, address: str):
+        try:
+            uri = f"ws://{address}"
+            ws = await ws_connect(uri, open_timeout=5)
+            my_id_handshake = self.active_user_id if self.active_user_id else "daemon_node"
+            await ws.send(wire.make_hello(my_id_handshake, wire.SUPPORTED_WIRE))
+            peer_id, peer_wire = wire.parse_hello(await ws.recv())
+            
+            if peer_id == my_id_handshake and peer_id != "daemon_node":
+                 await ws.close()
+                 return False
+
+            # Старая нода отвечает голым ID - общаемся JSON-конвертами
+            self.wire_formats[peer_id] = wire.choose_wire(peer_wire) if peer_wire else wire.WIRE_JSON
+            self.active_connections[peer_id] = ws
+            print(f"✅ [P2P] Connected to neighbor {peer_id[:8]}")
+            self._publish("peer", peer_id=peer_id, status="connected")
+            
+            await self.system_db.execute_write("""
+                INSERT INTO neighbors (user_id, address, last_seen) 
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET last_seen=excluded.last_seen
+            """, (peer_id, address, datetime.now().isoformat()))
+            
+            asyncio.create_task(self._listen_socket(ws, peer_id))
+            return True
+        except Exception as e:
+            print(f"❌ [P2P] Connection failed: {e}")
+            return False
+
+    async def _handle_incoming(self, websocket):
+        try:
+            peer_id, offered_wire = wire.parse_hello(await websocket.recv())
+            my_id_handshake = self.active_user_id if self.active_user_id else "daemon_node"
+            if offered_wire is None:
+                # Старая нода: голый ID в ответ и JSON-конверты
+                self.wire_formats[peer_id] = wire.WIRE_JSON
+                await websocket.send(my_id_handshake)
+            else:
+                self.wire_formats[peer_id] = wire.choose_wire(offered_wire)
+                await websocket.send(wire.make_hello(my_id_handshake, self.wire_formats[peer_id]))
+            self.active_connections[peer_id] = websocket
+            print(f"🔗 [P2P] Neighbor connected: {peer_id[:8]}")
+            self._publish("peer", peer_id=peer_id, status="connected")
+            await self.system_db.execute_write("""
+                INSERT INTO neighbors (user_id, address, last_seen) 
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET last_seen=excluded.last_seen
+            """, (peer_id, "incoming", datetime.now().isoformat()))
+            await self._listen_socket(websocket, peer_id)
+        except Exception: pass
+
+    async def _listen_socket(self, websocket, peer_id):
+        try:
+            async for message in websocket:
+                if isinstance(message, bytes): self.links.on_frame(peer_id, message)
+                try:
+                    packets = self._parse_envelope(message)
+                except Exception as e:
+                    print(f"❌ Packet error: {e}")
+                    continue
+                # Обработка - в пуле воркеров; при перегрузке put() ждет, и чтение сокета встает
+                await self.inbound.put(peer_id, packets)
+        except: pass
+        finally:
+            if self.active_connections.get(peer_id) is websocket:
+                del self.active_connections[peer_id]
+                self.wire_formats.pop(peer_id, None)
+                self.inbound.close_peer(peer_id)
+                self.links.forget(peer_id)
+                self._publish("peer", peer_id=peer_id, status="disconnected")
+
+    def drop_connection(self, peer_id: str):
+        """Отключает соседа (например, если он систематически не принимает кадры)."""
+        ws = self.active_connections.pop(peer_id, None)
+        self.degraded_peers.discard(peer_id)
+        self.wire_formats.pop(peer_id, None)
+        self.inbound.close_peer(peer_id)
+        self.links.forget(peer_id)
+        if ws:
+            print(f"✂️ [P2P] Dropping neighbor {peer_id[:8]}")
+            self._publish("peer", peer_id=peer_id, status="disconnected")
+            asyncio.create_task(ws.close())
+
+    @staticmethod
+    def _parse_envelope(message) -> list:
+        """Кадр соседа -> список бинарных пакетов (пустой для DUMMY)"""
+        if isinstance(message, bytes):
+            # Бинарный кадр: пакеты идут дальше без перекодирования
+            return wire.decode_frame(message)
+        # JSON-конверт (запасной формат): приводим пакеты к бинарному виду
+        envelope = json.loads(message)
+        if envelope.get("t") == "MUX":
+            inner = envelope.get("d", [])
+        elif envelope.get("t") == "REAL":
+            inner = [envelope.get("d")]
+        else:
+            return []
+        return [wire.encode_packet(json.loads(inner_json)) for inner_json in inner]
+
+    async def _process_frame(self, raw_packets: list, from_peer: str):
+        for raw in raw_packets:
+            await self._process_packet(raw, from_peer)
+
+    async def _process_packet(self, raw: bytes, from_peer: str):
+        try:
+            # Разбираем только заголовок - для ретрансляции тело не нужно
+            packet = wire.decode_header(raw)
+            pkt_type = packet.get("type")
+            pkt_id = packet.get("id")
+
+            # В Beta-2 мы регистрируем ВСЕ пакеты (PROBE и DATA) для трекера
+            is_new = await self.system_db.mark_packet_seen(pkt_id)
+
+            if pkt_type == "PROBE":
+                # Для PROBE дедупликация внутри метода (нужно записать путь до отсева)
+                await self._handle_probe(packet, raw, from_peer, is_new)
+            elif pkt_type in ("DATA", "FRAG"):
+                # Для DATA обрабатываем только если видим впервые; FRAG идет тем же путем
+                if is_new:
+                    await self._handle_data(packet, raw, from_peer)
+            elif pkt_type == "REFRESH":
+                if is_new:
+                    await self._handle_refresh(packet, raw, from_peer)
+        except Exception as e:
+            print(f"❌ Packet error: {e}")
+
+    async def _handle_probe(self, packet, raw, from_peer, is_new_probe):
+        probe_id = packet['id']
+        route_id = packet['route_id']   
+        rev_id = packet['rev_id']       
+        target_hash = packet['target_hash']
+        metric = packet['metric']
+
+        # 1. ЗАПИСЬ МАРШРУТА (Паутина строится здесь)
+        # Мы записываем rev_id, потому что этот путь ведет НАЗАД к источнику пробы
+        # ВАЖНО: Не перезаписываем LOCAL маршрут удаленным!
+        existing_rev = await self.system_db.get_best_route(rev_id)
+        if not (existing_rev and existing_rev['is_local']):
+            await self.system_db.add_route(rev_id, from_peer, metric + 1)
+
+        # 2. ПРОВЕРКА ЦЕЛИ
+        if self.active_user_id and self.active_crypto:
+            if self.active_crypto.get_target_hash(self.active_user_id) == target_hash:
+                # МЫ - ЦЕЛЬ (Боб). Обрабатываем только один раз.
+                if is_new_probe:
+                    packet = wire.decode_packet(raw)
+                    # Расшифровка auth и проверка подписи (A+B).signature(A) - одним заданием в пуле
+                    sender_id = await self._run_crypto(self.active_crypto.open_probe_auth, packet['auth'], packet['sig'])
+                    if sender_id and self.active_user_id:
+                        try:
+                            print(f"🎯 [PROBE] Validated source: {sender_id[:8]}")
+                            
+                            # Боб метит ВХОДЯЩИЙ канал Алисы как LOCAL для себя
+                            await self.system_db.add_route(route_id, "LOCAL", 0, is_local=1, remote_user_id=sender_id)
+
+                            # Доставляем сообщение (E2EE)
+                            if packet.get('content'):
+                                await self._deliver_to_active_user(packet, sender_id)
+                            
+                            # РАЗРЫВ ПЕТЛИ: Проверяем, не является ли rev_id уже локальным (значит мы Алиса)
+                            if existing_rev and existing_rev['is_local']:
+                                return # Мы Алиса, получили ответ от Боба, цепочка замкнулась.
+
+                            # Мы ищем этого собеседника (ответ или встречный поиск): путь к нему (rev_id)
+                            # только что записан - отправляем отложенные сообщения, отвечать не нужно
+                            if self.discovery.get(rev_id):
+                                await self._flush_discovery(rev_id)
+                                return
+
+                            # Если мы Боб - шлем ответную пробу (не чаще раза за timeout поиска)
+                            if self.discovery.may_respond(sender_id):
+                                await self._send_probe_response(sender_id, metric)
+                        except Exception as e:
+                            print(f"Probe validation error: {e}")
+                return 
+
+        # 3. РЕТРАНСЛЯЦИЯ (Если пакет новый и TTL позволяет)
+        if is_new_probe and packet['ttl'] > 0:
+            targets = self.probe_policy.relay_targets(metric, from_peer, list(self.active_connections))
+            if targets == []: return
+            relayed = wire.patch_header(raw, packet['ttl'] - 1, packet['metric'] + 1)
+            if targets is None:
+                await self.outbox.put(probe_id, relayed, exclude_peer=from_peer, priority=PRIO_PROBE)
+            else:
+                # Ограниченный fanout: адресные копии выбранным соседям
+                for next_hop in targets:
+                    await self.outbox.put(probe_id, relayed, next_hop, from_peer, priority=PRIO_PROBE)
+
+    def _make_probe(self, target_id: str, packet_id: str, content: str = None, ttl: int = 20) -> dict:
+        """PROBE от активного пользователя к target_id: route_id - наш канал к нему, rev_id - его к нам"""
+        crypto = self.active_crypto
+        return {
+            "type": "PROBE",
+            "id": packet_id,
+            "route_id": crypto.get_route_id(self.active_user_id, target_id),
+            "rev_id": crypto.get_route_id(target_id, self.active_user_id),
+            "target_hash": crypto.get_target_hash(target_id),
+            "metric": 0,
+            "ttl": ttl,
+            "auth": crypto.encrypt_for_probe(target_id, json.dumps({"sid": self.active_user_id})),
+            "sig": crypto.sign_data(self.active_user_id + target_id),
+            "content": content
+        }
+
+    async def _send_probe(self, probe: dict, durable: bool = False):
+        await self.system_db.mark_packet_seen(probe['id'])
+        await self.outbox.put(probe['id'], wire.encode_packet(probe), priority=PRIO_OWN, durable=durable)
+
+    async def discover_route(self, target_id: str, packet_id: str = None, content: str = None) -> bool:
+        """
+        Поиск маршрута к собеседнику: первое сообщение может ехать внутри PROBE, остальные ждут ответа.
+        Возвращает, ушло ли сообщение в пробе.
+        """
+        probe = self._make_probe(target_id, packet_id or str(uuid.uuid4()), content, self.probe_policy.ring_ttl(1))
+        raw = wire.encode_packet(probe)
+        if content and len(raw) > wire.frame_room(self.frame_size):
+            # PROBE не фрагментируется: большое сообщение дождется маршрута и уйдет FRAG
+            probe.update(id=str(uuid.uuid4()), content=None)
+            raw, content = wire.encode_packet(probe), None
+        # Алиса метит СВОЙ входящий канал (rev_id) как LOCAL
+        await self.system_db.add_route(probe['rev_id'], "LOCAL", 0, is_local=1, remote_user_id=target_id)
+        self.discovery.start(probe['route_id'], target_id)
+        await self.system_db.mark_packet_seen(probe['id'])
+        await self.outbox.put(probe['id'], raw, priority=PRIO_OWN, durable=bool(content))
+        return bool(content)
+
+    async def send_message(self, target_id: str, message_id: str, text: str, content: str):
+        """
+        Свое сообщение собеседнику: в очередь окна, по маршруту - DATA, пока окно не заполнено.
+        Без маршрута первое сообщение едет внутри PROBE, остальные ждут ответа без новой волны.
+        Возвращает (тип пакета, статус).
+        """
+        route_id = self.active_crypto.get_route_id(self.active_user_id, target_id)
+        self.active_routes.touch(route_id, target_id)
+        msg = self.reliable.track(message_id, target_id, route_id, text, content)
+        # Сосед на связи по цене пути, иначе лучший по хопам (пакет дождется соседа в outbox)
+        route = await self.select_route(route_id) or await self.system_db.get_best_route(route_id)
+        if route and not route['is_local']:
+            sent = await self._pump(route_id, route)
+            return "DATA", "sent" if msg in sent else "queued"
+        if self.discovery.get(route_id):
+            # Поиск уже идет: сообщение ждет маршрута в очереди окна
+            return "DATA", "finding_route"
+        if await self.discover_route(target_id, message_id, content):
+            self.reliable.launch(msg)
+            self.reliable.on_transmit(msg, message_id)
+        return "PROBE", "finding_route"
+
+    async def restore_outgoing(self):
+        """
+        После входа: свои сообщения без ACK (queued/sent) из БД пользователя снова в окно.
+        Текст перешифровывается заново; то, что не восстановить, помечается failed.
+        """
+        user_db, crypto = self.active_user_db, self.active_crypto
+        async with user_db.read() as conn, conn.execute("""
+            SELECT packet_id, chat_id, content, timestamp, status FROM messages
+            WHERE is_outgoing = 1 AND status IN ('queued', 'sent') ORDER BY id
+        """) as cursor:
+            rows = await cursor.fetchall()
+        if not rows: return
+        now = time.time()
+        failed, restored = {}, 0
+        for message_id, target_id, local_content, timestamp, status in rows:
+            try:
+                created = datetime.fromisoformat(timestamp).timestamp()
+                text = await self._run_crypto(crypto.decrypt_db_field, local_content)
+                if now - created > self.reliable.max_wait or text == "[DB DECRYPT FAIL]":
+                    raise ValueError("Message is not recoverable")
+                content = await self._run_crypto(crypto.encrypt_message, target_id, text, message_id)
+            except Exception:
+                failed.setdefault(target_id, []).append(message_id)
+                continue
+            if user_db is not self.active_user_db: return  # Пользователь сменился во время восстановления
+            route_id = crypto.get_route_id(self.active_user_id, target_id)
+            self.reliable.restore(message_id, target_id, route_id, text, content, created, status == 'sent')
+            restored += 1
+        for target_id, message_ids in failed.items():
+            await self._set_status(message_ids, "failed", target_id)
+        if restored:
+            print(f"📤 [RELIABLE] Restored {restored} unacknowledged messages")
+        for route_id, target_id in self.reliable.waiting_routes():
+            if await self._pump(route_id): continue
+            route = await self.system_db.get_best_route(route_id)
+            if not (route and not route['is_local']) and not self.discovery.get(route_id):
+                await self.discover_route(target_id)
+
+    async def _pump(self, route_id: str, route: dict = None) -> list:
+        """Ждущие сообщения разговора уходят DATA, пока есть место в окне"""
+        route = route or await self.select_route(route_id)
+        if not route or route['is_local']: return []
+        sent = self.reliable.ready(route_id)
+        for msg in sent:
+            await self._transmit(msg, await self.select_route(route_id) or route)
+        if sent: await self._set_status([msg.message_id for msg in sent], "sent", sent[0].target_id)
+        return sent
+
+    async def _transmit(self, msg: OutgoingMessage, route: dict):
+        """
+        Отправка (или повтор) сообщения DATA. Повтор - новый пакет: ретрансляторы отсеивают
+        виденный packet_id, получатель узнает сообщение по mid. Устаревший шифротекст пересобирается.
+        """
+        if time.time() - msg.encrypted_at > MAX_MESSAGE_AGE / 2:
+            msg.content = await self._run_crypto(self.active_crypto.encrypt_message, msg.target_id, msg.text, msg.message_id)
+            msg.encrypted_at = time.time()
+        # Первая отправка - с ID сообщения; повтор или восстановленное (ID мог уйти в PROBE) - новый
+        packet_id = msg.message_id if msg.packet_id is None else str(uuid.uuid4())
+        packet = {"type": "DATA", "id": packet_id, "route_id": msg.route_id, "content": msg.content, "ttl": 20}
+        # Не помещается в кадр - FRAG по кадру каждый, кадры остаются постоянного размера
+        for part in wire.fragment(packet, self.frame_size):
+            await self.system_db.mark_packet_seen(part['id'])
+            await self.outbox.put(part['id'], wire.encode_packet(part), route['next_hop_id'],
+                                  priority=PRIO_OWN, durable=not msg.attempts)
+        self.reliable.on_transmit(msg, packet_id)
+
+    async def _set_status(self, message_ids: list, status: str, chat_id: str):
+        """Статус своих сообщений: в БД пользователя и событием для UI"""
+        user_db = self.active_user_db
+        if not user_db or not message_ids: return
+        await user_db.execute_write("UPDATE messages SET status = ? WHERE packet_id = ?",
+                                    [(status, message_id) for message_id in message_ids], many=True)
+        for message_id in message_ids:
+            self._publish("status", chat_id=chat_id, packet_id=message_id, status=status)
+
+    async def _flush_discovery(self, route_id: str):
+        """Маршрут найден: ждущие сообщения уходят DATA по лучшему пути"""
+        pending = self.discovery.resolve(route_id)
+        if not pending: return
+        sent = await self._pump(route_id)
+        if sent:
+            print(f"🚀 [ROUTE] Route to {pending.target_id[:8]} found, sending {len(sent)} queued messages")
+
+    async def check_discoveries(self):
+        """Повтор PROBE для поисков без ответа; исчерпавшие попытки снимаются"""
+        for pending in self.discovery.due():
+            route = await self.system_db.get_best_route(pending.route_id)
+            if route and not route['is_local']:
+                await self._flush_discovery(pending.route_id)
+            elif not self.discovery.retry(pending):
+                print(f"⌛ [ROUTE] No route to {pending.target_id[:8]} after {pending.attempts} probes")
+                failed = self.reliable.fail_route(pending.route_id)
+                await self._set_status([msg.message_id for msg in failed], "failed", pending.target_id)
+            elif self.active_user_id:
+                # Повтор без контента: первое сообщение уже ушло в исходной пробе
+                print(f"🔁 [PROBE] Retry {pending.attempts - 1} for {pending.target_id[:8]}")
+                # Expanding ring: каждая следующая волна дальше предыдущей
+                ttl = self.probe_policy.ring_ttl(pending.attempts)
+                await self._send_probe(self._make_probe(pending.target_id, str(uuid.uuid4()), ttl=ttl))
+
+    async def run_discovery(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.check_discoveries()
+            except Exception as e:
+                print(f"Discovery error: {e}")
+
+    async def _on_acks(self, sender_id: str, message_ids: list):
+        """ACK собеседника: сообщения доставлены, окно сдвигается"""
+        route_id = self.active_crypto.get_route_id(self.active_user_id, sender_id)
+        acked = self.reliable.ack(route_id, message_ids)
+        await self._set_status([msg.message_id for msg in acked], "delivered", sender_id)
+        await self._pump(route_id)
+
+    async def _flush_acks(self):
+        """Накопленные подтверждения - одним ACK на отправителя, обратным путем как DATA"""
+        for sender_id, message_ids in self.reliable.take_acks().items():
+            route_id = self.active_crypto.get_route_id(self.active_user_id, sender_id)
+            route = await self.select_route(route_id)
+            # Без пути ACK не ждет: отправитель повторит сообщение, и подтверждение уйдет снова
+            if not route or route['is_local']: continue
+            content = await self._run_crypto(self.active_crypto.encrypt_ack, sender_id, message_ids)
+            packet_id = str(uuid.uuid4())
+            packet = {"type": "DATA", "id": packet_id, "route_id": route_id, "content": content, "ttl": 20}
+            await self.system_db.mark_packet_seen(packet_id)
+            await self.outbox.put(packet_id, wire.encode_packet(packet), route['next_hop_id'], priority=PRIO_OWN)
+            self.reliable.stats["acks_sent"] += 1
+
+    async def check_reliable(self):
+        """Подтверждения получателям и повтор сообщений без ACK"""
+        if not self.active_user_id: return
+        await self._flush_acks()
+        now = time.time()
+        for msg in self.reliable.due(now):
+            if self.reliable.exhausted(msg, now):
+                self.reliable.drop(msg)
+                print(f"⌛ [RELIABLE] No ACK for {msg.message_id[:8]} after {msg.attempts} attempts")
+                await self._set_status([msg.message_id], "failed", msg.target_id)
+                await self._pump(msg.route_id)
+                continue
+            route = await self.select_route(msg.route_id)
+            if not route or route['is_local']:
+                # Пути нет (истек или соседи ушли): попытка не тратится, маршрут ищется заново
+                self.reliable.postpone(msg, now)
+                if not self.discovery.get(msg.route_id): await self.discover_route(msg.target_id)
+                continue
+            print(f"🔁 [RELIABLE] Retransmit {msg.message_id[:8]} (attempt {msg.attempts + 1})")
+            await self._transmit(msg, route)
+        for msg in self.reliable.expired_waiting(now):
+            await self._set_status([msg.message_id], "failed", msg.target_id)
+
+    async def run_reliable(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.check_reliable()
+            except Exception as e:
+                print(f"Reliable error: {e}")
+
+    async def _send_probe_response(self, requester_id, hops: int = None):
+        """Боб отправляет свою пробу Алисе в ответ (hops - сколько прошла ее проба)"""
+        print(f"🔄 [PROBE] Sending symmetric response to {requester_id[:8]}")
+        # Для Боба: прямой канал (route_id) это B+A, обратный (rev_id) это A+B.
+        # Свой исходящий канал Боб LOCAL не метит: иначе его DATA к Алисе снова уходили бы PROBE,
+        # а собственная проба, вернувшаяся через соседа, и так отсеивается по packet_id.
+        # Техническое сообщение о хендшейке
+        e2e_content = self.active_crypto.encrypt_message(requester_id, "🤝 [System] Connection established")
+        ttl = self.probe_policy.response_ttl(hops) if hops is not None else self.probe_policy.max_ttl
+        await self._send_probe(self._make_probe(requester_id, str(uuid.uuid4()), e2e_content, ttl))
+
+    async def select_route(self, route_id: str, exclude_peer: str = None):
+        """
+        Путь для DATA: LOCAL, если сообщение нам, иначе выбор среди соседей на связи
+        по цене пути (хопы, RTT, потери) с распределением по почти равным путям (multipath).
+        exclude_peer - откуда пришел пакет: он его уже видел и назад не примет.
+        """
+        routes = await self._candidate_routes(route_id, exclude_peer)
+        if routes and routes[0]['is_local']: return routes[0]
+        return self.links.choose(routes)
+
+    async def _candidate_routes(self, route_id: str, exclude_peer: str = None) -> list:
+        """[LOCAL] или пути через соседей на связи (деградировавшие - только если нет здоровых)"""
+        # Ищем ВСЕ возможные пути, отсортированные по метрике (от лучшего к худшему)
+        routes = await self.system_db.get_routes(route_id)
+        if not routes: return []
+        if routes[0]['is_local']: return routes[:1]
+
+        live = [route for route in routes
+                if route['next_hop_id'] in self.active_connections and route['next_hop_id'] != exclude_peer]
+        # Деградировавший сосед - только если нет здоровых путей
+        healthy = [route for route in live if route['next_hop_id'] not in self.degraded_peers]
+        return healthy or live
+
+    async def _handle_data(self, packet, raw, from_peer):
+        """Пересылка данных с поддержкой Multipath Failover"""
+        route = await self.select_route(packet.get('route_id'), exclude_peer=from_peer)
+        if not route: return
+
+        if route['is_local']:
+            if self.active_user_id:
+                await self._deliver_to_active_user(wire.decode_packet(raw), route['remote_user_id'])
+            return
+
+        await self.outbox.put(packet['id'], raw, route['next_hop_id'], from_peer, priority=PRIO_DATA)
+
+    async def _handle_refresh(self, packet, raw, from_peer):
+        """
+        REFRESH продлевает запись маршрута на каждом хопе. Хоп выбирается детерминированно - самый дешевый путь
+        (к нему сходится DATA), без случайного multipath и без учета в статистике выбора.
+        """
+        routes = await self._candidate_routes(packet['route_id'], exclude_peer=from_peer)
+        if not routes: return
+        route = routes[0] if routes[0]['is_local'] else self.links.best(routes)
+        await self.system_db.renew_route(route)
+        self.active_routes.stats["renewed"] += 1
+        if route['is_local']: return  # Получатель: продлен свой LOCAL
+        self.active_routes.stats["relayed"] += 1
+        await self.outbox.put(packet['id'], raw, route['next_hop_id'], from_peer, priority=PRIO_DATA)
+
+    async def refresh_routes(self) -> int:
+        """Продлевает пути активных разговоров, которым скоро истекать. Возвращает число REFRESH."""
+        sent = 0
+        now = time.time()
+        for route_id, peer_user_id in self.active_routes.active(now):
+            routes = await self.system_db.get_routes(route_id)
+            for route in routes:
+                if route['is_local'] or route['next_hop_id'] not in self.active_connections: continue
+                if not self.active_routes.needs_refresh(route, now): continue
+                packet_id = str(uuid.uuid4())
+                refresh = {"type": "REFRESH", "id": packet_id, "route_id": route_id, "ttl": 20}
+                await self.system_db.renew_route(route)
+                await self.system_db.mark_packet_seen(packet_id)
+                await self.outbox.put(packet_id, wire.encode_packet(refresh), route['next_hop_id'], priority=PRIO_OWN)
+                sent += 1
+        if sent:
+            self.active_routes.stats["refreshes"] += sent
+            print(f"♻️ [ROUTE] Refreshed {sent} paths of active chats")
+        return sent
+
+    async def run_refresh(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_routes()
+            except Exception as e:
+                print(f"Refresh error: {e}")
+
+    async def _deliver_to_active_user(self, packet, sender_id):
+        """Финальная доставка сообщения в БД пользователя с дедупликацией по ID сообщения"""
+        user_db = self.active_user_db
+        try:
+            # Расшифровка E2EE и перешифровка для БД - одним заданием в пуле
+            if packet.get('type') == "FRAG":
+                # Сообщение целиком - когда придут все фрагменты группы
+                packet = self.reassembly.add(sender_id, packet)
+                if packet is None: return
+            opened = await self._run_crypto(self.active_crypto.open_message, sender_id, packet.get("content"))
+            if user_db is not self.active_user_db: return  # Пользователь сменился, пока шла расшифровка
+            if opened.acks is not None:
+                if sender_id and opened.acks: await self._on_acks(sender_id, opened.acks)
+                return
+            # Повторы одного сообщения идут разными пакетами с одним mid
+            msg_uuid = opened.message_id or packet.get('id')
+
+            # Дедупликация в БД пользователя по packet_id (колонка UNIQUE)
+            try:
+                cursor = await user_db.execute_write("""
+                    INSERT INTO messages (packet_id, chat_id, sender_id, content, timestamp, is_outgoing, is_read) 
+                    VALUES (?, ?, ?, ?, ?, 0, 0)
+                """, (msg_uuid, sender_id, sender_id, opened.db_field, datetime.now().isoformat()), durable=True)
+                
+                await user_db.execute_write("""
+                    INSERT INTO contacts (user_id, last_seen) VALUES (?, ?) 
+                    ON CONFLICT(user_id) DO UPDATE SET last_seen=excluded.last_seen
+                """, (sender_id, datetime.now().isoformat()))
+                
+                user_db.cache_plaintext(("msg", cursor.lastrowid), opened.text)
+                if sender_id:
+                    # Входящее сообщение держит разговор активным: наш путь к отправителю продлевается
+                    self.active_routes.touch(self.active_crypto.get_route_id(self.active_user_id, sender_id), sender_id)
+                print(f"📨 [MAIL] Delivered from {sender_id[:8]}")
+                self._publish("message", chat_id=sender_id, id=cursor.lastrowid, is_outgoing=0)
+            except: 
+                # Если packet_id уже есть, INSERT упадет - это и есть дедупликация
+                pass 
+            # Подтверждаем и повтор: прошлый ACK мог потеряться
+            if sender_id and opened.message_id: self.reliable.queue_ack(sender_id, opened.message_id)
+        except Exception as e:
+            print(f"Delivery error: {e}")
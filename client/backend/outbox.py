@@ -0,0 +1,211 @@
+import time
+from collections import deque, Counter, OrderedDict
+
+from database import DatabaseManager
+import wire
+
+# Классы приоритета: меньше - раньше уходит в кадр
+PRIO_OWN = 0     # Пакеты этой ноды: свои сообщения и ответные пробы
+PRIO_DATA = 1    # Ретрансляция DATA по установленному маршруту
+PRIO_PROBE = 2   # Ретрансляция PROBE (широковещательный поиск)
+PRIORITIES = (PRIO_OWN, PRIO_DATA, PRIO_PROBE)
+
+SELF_SOURCE = "self"
+
+class OutboxEntry:
+    __slots__ = ("id", "packet_id", "next_hop_id", "packet", "exclude_peer", "priority", "created_at", "source")
+
+    def __init__(self, id: int, packet_id: str, next_hop_id, packet: bytes, exclude_peer, priority: int, created_at: float):
+        self.id = id
+        self.packet_id = packet_id
+        self.next_hop_id = next_hop_id
+        self.packet = packet
+        self.exclude_peer = exclude_peer
+        self.priority = priority
+        self.created_at = created_at
+        self.source = source_of(packet, exclude_peer)
+
+def source_of(packet: bytes, exclude_peer) -> str:
+    """
+    Источник для справедливого планирования: сосед, от которого пришел ретранслируемый пакет.
+    Свои пакеты делятся по route_id, чтобы разные чаты не стояли друг за другом.
+    """
+    if exclude_peer: return exclude_peer
+    if isinstance(packet, bytes) and len(packet) >= wire.HEADER.size:
+        return f"{SELF_SOURCE}:{wire.HEADER.unpack_from(packet)[3].hex()[:16]}"
+    return SELF_SOURCE
+
+class FairQueue:
+    """
+    Подочередь одного класса приоритета, разбитая на потоки по источникам.
+    Порядок потоков - порядок обхода DRR (обслуженный поток уходит в конец), deficit - остаток кванта.
+    """
+    def __init__(self):
+        self.flows = OrderedDict()  # source -> deque[OutboxEntry]
+        self.deficit = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for flow in self.flows.values(): yield from flow
+
+    def flow_len(self, source: str) -> int:
+        flow = self.flows.get(source)
+        return len(flow) if flow else 0
+
+    def append(self, entry: OutboxEntry):
+        flow = self.flows.get(entry.source)
+        if flow is None:
+            flow = self.flows[entry.source] = deque()
+            self.deficit[entry.source] = 0
+        flow.append(entry)
+        self.size += 1
+
+    def remove(self, entry: OutboxEntry):
+        flow = self.flows[entry.source]
+        flow.remove(entry)
+        self.size -= 1
+        if not flow:
+            # Опустевший поток теряет накопленный deficit (классический DRR)
+            del self.flows[entry.source]
+            del self.deficit[entry.source]
+
+class Outbox:
+    """
+    Очередь исходящих пакетов в памяти.
+    Адресные пакеты лежат в подочередях по next_hop, широковещательные (next_hop = NULL) - отдельно,
+    и те и другие разбиты по классам приоритета. Таблица outbox - только журнал для рестарта:
+    строка пишется при постановке в очередь и удаляется пачкой после отправки.
+    """
+    def __init__(self, db: DatabaseManager, source_limit: int = 256):
+        self.db = db
+        self.source_limit = source_limit  # Квота: пакетов одного источника в одной подочереди
+        self._unicast = {}  # next_hop_id -> [FairQueue на каждый приоритет]
+        self._broadcast = [FairQueue() for _ in PRIORITIES]
+        self._by_packet = Counter()
+        self._next_id = 1
+        self.enqueued = 0
+        self.removed = 0
+        self.dropped = Counter()  # source -> отброшено по квоте
+
+    def __len__(self):
+        return sum(self._by_packet.values())
+
+    async def load(self) -> int:
+        """Восстанавливает очередь из журнала после рестарта"""
+        rows = await self.db.conn.execute_fetchall("""
+            SELECT id, packet_id, next_hop_id, packet_json, exclude_peer, priority,
+                   CAST(strftime('%s', created_at) AS REAL) AS created_ts
+            FROM outbox ORDER BY id
+        """)
+        skipped = 0
+        for row in rows:
+            self._next_id = row['id'] + 1
+            if not isinstance(row['packet_json'], bytes):
+                # Не бинарный пакет (журнал старой версии) - в кадр такта его не упаковать
+                skipped += 1
+                continue
+            self._append(OutboxEntry(row['id'], row['packet_id'], row['next_hop_id'], row['packet_json'],
+                                     row['exclude_peer'], row['priority'], row['created_ts'] or time.time()))
+        if skipped: print(f"⚠️ [OUTBOX] Skipped {skipped} non-binary packets in journal")
+        if rows: print(f"📤 [OUTBOX] Restored {len(rows) - skipped} packets from journal")
+        return len(rows) - skipped
+
+    async def put(self, packet_id: str, packet: bytes, next_hop_id: str = None, exclude_peer: str = None,
+                  priority: int = PRIO_PROBE, durable: bool = False):
+        """
+        Ставит пакет в очередь; журнал пишется через групповой коммит.
+        Ретранслируемый пакет сверх квоты источника отбрасывается (возвращает None).
+        """
+        entry = OutboxEntry(self._next_id, packet_id, next_hop_id, packet, exclude_peer, priority, time.time())
+        if priority != PRIO_OWN and self._queue_for(entry).flow_len(entry.source) >= self.source_limit:
+            self.dropped[entry.source] += 1
+            return None
+        self._next_id += 1
+        self._append(entry)
+        self.enqueued += 1
+        await self.db.execute_write("""
+            INSERT INTO outbox (id, packet_id, next_hop_id, packet_json, exclude_peer, priority)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (entry.id, packet_id, next_hop_id, packet, exclude_peer, priority), durable=durable)
+        return entry
+
+    def _queue_for(self, entry: OutboxEntry) -> FairQueue:
+        if not entry.next_hop_id: return self._broadcast[entry.priority]
+        queues = self._unicast.get(entry.next_hop_id)
+        if queues is None:
+            queues = self._unicast[entry.next_hop_id] = [FairQueue() for _ in PRIORITIES]
+        return queues[entry.priority]
+
+    def _append(self, entry: OutboxEntry):
+        self._queue_for(entry).append(entry)
+        self._by_packet[entry.packet_id] += 1
+
+    def unicast(self, next_hop_id: str, priority: int):
+        queues = self._unicast.get(next_hop_id)
+        return queues[priority] if queues else None
+
+    def broadcast(self, priority: int) -> FairQueue:
+        return self._broadcast[priority]
+
+    async def remove(self, entries: list):
+        """Убирает отправленные пакеты из памяти и журнала (одной операцией)"""
+        if not entries: return
+        for entry in entries:
+            self._queue_for(entry).remove(entry)
+            self._by_packet[entry.packet_id] -= 1
+            if self._by_packet[entry.packet_id] <= 0: del self._by_packet[entry.packet_id]
+        self.removed += len(entries)
+        self._drop_empty()
+        await self.db.execute_write("DELETE FROM outbox WHERE id = ?", [(entry.id,) for entry in entries], many=True)
+
+    async def purge(self, neighbors, stale_after: float, max_age: float) -> int:
+        """
+        Чистка: адресные пакеты соседям, которых нет дольше stale_after,
+        и любые пакеты старше max_age. Возвращает число удаленных.
+        """
+        now = time.time()
+        doomed = []
+        for next_hop_id, queues in self._unicast.items():
+            limit = max_age if next_hop_id in neighbors else min(stale_after, max_age)
+            doomed.extend(entry for queue in queues for entry in queue if now - entry.created_at > limit)
+        doomed.extend(entry for queue in self._broadcast for entry in queue if now - entry.created_at > max_age)
+        await self.remove(doomed)
+        return len(doomed)
+
+    def _drop_empty(self):
+        for next_hop_id in [hop for hop, queues in self._unicast.items() if not any(queues)]:
+            del self._unicast[next_hop_id]
+
+    def count(self, packet_id: str) -> int:
+        return self._by_packet.get(packet_id, 0)
+
+    def entries(self) -> list:
+        """Все пакеты в порядке постановки (для отладки)"""
+        res = [entry for queues in self._unicast.values() for queue in queues for entry in queue]
+        res.extend(entry for queue in self._broadcast for entry in queue)
+        res.sort(key=lambda entry: entry.id)
+        return res
+
+    def get_stats(self) -> dict:
+        depth = [len(self._broadcast[prio]) + sum(len(queues[prio]) for queues in self._unicast.values())
+                 for prio in PRIORITIES]
+        return {
+            "depth": sum(depth),
+            "depth_by_priority": {"own": depth[PRIO_OWN], "data": depth[PRIO_DATA], "probe": depth[PRIO_PROBE]},
+            "next_hops": {hop: sum(len(queue) for queue in queues) for hop, queues in self._unicast.items()},
+            "broadcast": sum(len(queue) for queue in self._broadcast),
+            "enqueued": self.enqueued,
+            "removed": self.removed,
+            "sources": self._source_depths(),
+            "dropped_by_source": dict(self.dropped.most_common(16)),
+        }
+
+    def _source_depths(self) -> dict:
+        depths = Counter()
+        for queues in list(self._unicast.values()) + [self._broadcast]:
+            for queue in queues:
+                for source, flow in queue.flows.items(): depths[source] += len(flow)
+        return dict(depths.most_common(16))
@@ -0,0 +1,60 @@
+import random
+from collections import Counter
+
+class ProbePolicy:
+    """
+    Политика ретрансляции PROBE вместо слепого флуда на всех соседей.
+    - gossip: после первых min_hops хопов проба пересылается с вероятностью probability;
+    - degree_threshold: нода с числом соседей не больше порога пересылает всегда и всем
+      (лист или мост - без нее часть сети пробу не увидит);
+    - fanout: не больше fanout соседей на ретрансляцию (0 - все), выбор случайный;
+    - expanding ring: первая волна с TTL ring_start, каждая следующая попытка поиска - вдвое дальше до max_ttl.
+    Значения по умолчанию (probability=1, fanout=0, ring_start=0) дают прежний флуд.
+    """
+    def __init__(self, probability: float = 1.0, min_hops: int = 2, fanout: int = 0, degree_threshold: int = 2,
+                 ring_start: int = 0, max_ttl: int = 20):
+        self.probability = probability
+        self.min_hops = min_hops
+        self.fanout = fanout
+        self.degree_threshold = degree_threshold
+        self.ring_start = ring_start
+        self.max_ttl = max_ttl
+        self.stats = Counter()
+        self.originated_by_ttl = Counter()
+
+    def relay_targets(self, hops: int, from_peer: str, neighbors: list):
+        """
+        Кому переслать новую пробу, прошедшую hops хопов.
+        None - всем, кроме from_peer (широковещательная запись outbox), [] - не пересылать.
+        """
+        candidates = [peer_id for peer_id in neighbors if peer_id != from_peer]
+        self.stats["received"] += 1
+        if not candidates: return []
+        if len(neighbors) > self.degree_threshold:
+            if hops >= self.min_hops and random.random() >= self.probability:
+                self.stats["suppressed"] += 1
+                self.stats["saved_copies"] += len(candidates)
+                return []
+            if self.fanout and len(candidates) > self.fanout:
+                self.stats["relayed"] += 1
+                self.stats["copies"] += self.fanout
+                self.stats["saved_copies"] += len(candidates) - self.fanout
+                return random.sample(candidates, self.fanout)
+        self.stats["relayed"] += 1
+        self.stats["copies"] += len(candidates)
+        return None
+
+    def ring_ttl(self, attempt: int) -> int:
+        """TTL своей пробы для попытки поиска attempt (с 1)"""
+        ttl = self.max_ttl if not self.ring_start else min(self.ring_start * 2 ** (attempt - 1), self.max_ttl)
+        self.originated_by_ttl[ttl] += 1
+        return ttl
+
+    def response_ttl(self, hops: int) -> int:
+        """Ответная проба: путь назад известен по длине, небольшой запас на обход"""
+        return min(hops + 1 + 2, self.max_ttl)
+
+    def get_stats(self) -> dict:
+        st = dict(self.stats)
+        st["originated_by_ttl"] = dict(self.originated_by_ttl)
+        return st
@@ -0,0 +1,40 @@
+import time
+
+class ActiveRoutes:
+    """
+    Активные разговоры: наш route_id к собеседнику -> (собеседник, время последнего сообщения в любую сторону).
+    Их пути продлеваются до истечения: по каждому живому пути уходит REFRESH (пакет без тела, как DATA),
+    каждый хоп продлевает свою запись маршрута, получатель - свой LOCAL.
+    Разговор без сообщений дольше active_window выпадает, и его маршруты истекают без волны PROBE.
+    """
+    def __init__(self, refresh_before: float = 300.0, active_window: float = 1800.0):
+        self.refresh_before = refresh_before
+        self.active_window = active_window
+        self._routes = {}
+        self.stats = {"refreshes": 0, "relayed": 0, "renewed": 0, "went_idle": 0}
+
+    def __len__(self):
+        return len(self._routes)
+
+    def touch(self, route_id: str, peer_user_id: str):
+        self._routes[route_id] = (peer_user_id, time.time())
+
+    def active(self, now: float = None) -> list:
+        """[(route_id, собеседник)] для продления; затихшие разговоры выбрасываются"""
+        now = time.time() if now is None else now
+        idle = [route_id for route_id, (_, last) in self._routes.items() if now - last > self.active_window]
+        for route_id in idle: del self._routes[route_id]
+        self.stats["went_idle"] += len(idle)
+        return [(route_id, peer_user_id) for route_id, (peer_user_id, _) in self._routes.items()]
+
+    def needs_refresh(self, route: dict, now: float = None) -> bool:
+        now = time.time() if now is None else now
+        return route['expires_at'] - now <= self.refresh_before
+
+    def clear(self):
+        self._routes.clear()
+
+    def get_stats(self) -> dict:
+        st = dict(self.stats)
+        st["active"] = len(self._routes)
+        return st
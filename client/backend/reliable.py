@@ -0,0 +1,202 @@
+import time
+from collections import OrderedDict, deque
+
+class OutgoingMessage:
+    __slots__ = ("message_id", "target_id", "route_id", "text", "content", "encrypted_at",
+                 "packet_id", "attempts", "sent_at", "deadline", "created")
+
+    def __init__(self, message_id: str, target_id: str, route_id: str, text: str, content: str):
+        self.message_id = message_id
+        self.target_id = target_id
+        self.route_id = route_id
+        self.text = text              # Для перешифровки повторов (у шифротекста есть срок годности)
+        self.content = content
+        self.encrypted_at = time.time()
+        self.packet_id = None         # Пакет последней отправки
+        self.attempts = 0
+        self.sent_at = 0.0
+        self.deadline = 0.0
+        self.created = time.time()
+
+class RouteWindow:
+    __slots__ = ("inflight", "waiting", "srtt", "rttvar", "rto")
+
+    def __init__(self, rto: float):
+        self.inflight = OrderedDict()  # message_id -> OutgoingMessage, отправлены и ждут ACK
+        self.waiting = deque()         # Не отправлены: окно заполнено или нет маршрута
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = rto
+
+class ReliableSender:
+    """
+    Надежная доставка своих сообщений: сквозные ACK получателя и повтор по таймеру.
+    На каждый разговор (route_id) - скользящее окно: без ACK в полете не больше window сообщений,
+    остальные ждут. RTO по RTT подтверждений (RFC 6298, повторы не замеряются - алгоритм Карна),
+    с каждой попыткой сообщения удваивается. Повтор идет новым пакетом (ретрансляторы отсеивают
+    виденный packet_id), получатель узнает сообщение по mid внутри шифротекста.
+    Здесь только состояние: пакеты собирает и отправляет P2PNode.
+    """
+    def __init__(self, window: int = 16, initial_rto: float = 10.0, min_rto: float = 2.0, max_rto: float = 120.0,
+                 max_attempts: int = 6, max_wait: float = 600.0):
+        self.window = window
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_attempts = max_attempts
+        self.max_wait = max_wait  # Сколько сообщение может ждать маршрута или ACK, прежде чем стать failed
+        self._windows = {}
+        self._acks = {}  # Получатель: sender_id -> [message_id] к отправке одним ACK
+        self.stats = {"tracked": 0, "transmissions": 0, "retransmissions": 0, "acked": 0, "failed": 0,
+                      "duplicate_acks": 0, "acks_sent": 0}
+
+    def _window(self, route_id: str) -> RouteWindow:
+        window = self._windows.get(route_id)
+        if window is None: window = self._windows[route_id] = RouteWindow(self.initial_rto)
+        return window
+
+    def track(self, message_id: str, target_id: str, route_id: str, text: str, content: str) -> OutgoingMessage:
+        msg = OutgoingMessage(message_id, target_id, route_id, text, content)
+        self._window(route_id).waiting.append(msg)
+        self.stats["tracked"] += 1
+        return msg
+
+    def restore(self, message_id: str, target_id: str, route_id: str, text: str, content: str, created: float,
+                sent: bool) -> OutgoingMessage:
+        """
+        Сообщение из БД пользователя после перезапуска или повторного входа.
+        sent: первая копия уже ушла (или лежит в журнале outbox) - ждет ACK в полете, без замера RTT.
+        """
+        msg = self.track(message_id, target_id, route_id, text, content)
+        msg.created = created
+        msg.packet_id = message_id  # Пакет с ID сообщения мог уже уйти (DATA или PROBE): повтор - новым
+        if sent:
+            window = self._window(route_id)
+            window.waiting.remove(msg)
+            window.inflight[message_id] = msg
+            msg.attempts = 1
+            msg.deadline = time.time() + window.rto
+        return msg
+
+    def launch(self, msg: OutgoingMessage):
+        """Сообщение уходит вне очереди (внутри PROBE поиска маршрута)"""
+        window = self._window(msg.route_id)
+        if msg in window.waiting: window.waiting.remove(msg)
+        window.inflight[msg.message_id] = msg
+
+    def ready(self, route_id: str, now: float = None) -> list:
+        """Ждущие сообщения, которые помещаются в окно: переводятся в полет, отправить их должен вызвавший"""
+        now = time.time() if now is None else now
+        window = self._windows.get(route_id)
+        if not window: return []
+        res = []
+        while window.waiting and len(window.inflight) < self.window:
+            msg = window.waiting.popleft()
+            # Таймер сразу: пока идет отправка, повтор не сработает, а при сбое отправки - сработает
+            msg.deadline = now + window.rto
+            window.inflight[msg.message_id] = msg
+            res.append(msg)
+        return res
+
+    def on_transmit(self, msg: OutgoingMessage, packet_id: str, now: float = None):
+        now = time.time() if now is None else now
+        if msg.attempts: self.stats["retransmissions"] += 1
+        msg.attempts += 1
+        msg.packet_id = packet_id
+        msg.sent_at = now
+        rto = self._window(msg.route_id).rto
+        msg.deadline = now + min(rto * 2 ** (msg.attempts - 1), self.max_rto)
+        self.stats["transmissions"] += 1
+
+    def postpone(self, msg: OutgoingMessage, now: float = None):
+        """Нет маршрута: попытка не тратится, проверим через RTO"""
+        now = time.time() if now is None else now
+        msg.deadline = now + self._window(msg.route_id).rto
+
+    def ack(self, route_id: str, message_ids: list, now: float = None) -> list:
+        now = time.time() if now is None else now
+        window = self._windows.get(route_id)
+        acked = []
+        for message_id in message_ids:
+            msg = window.inflight.pop(message_id, None) if window else None
+            if msg is None:
+                self.stats["duplicate_acks"] += 1
+                continue
+            # sent_at = 0: восстановленное сообщение, время отправки неизвестно
+            if msg.attempts == 1 and msg.sent_at: self._sample_rtt(window, now - msg.sent_at)
+            acked.append(msg)
+        self.stats["acked"] += len(acked)
+        self._drop_empty(route_id)
+        return acked
+
+    def _sample_rtt(self, window: RouteWindow, rtt: float):
+        if window.srtt is None:
+            window.srtt, window.rttvar = rtt, rtt / 2
+        else:
+            window.rttvar = 0.75 * window.rttvar + 0.25 * abs(window.srtt - rtt)
+            window.srtt = 0.875 * window.srtt + 0.125 * rtt
+        window.rto = min(max(window.srtt + 4 * window.rttvar, self.min_rto), self.max_rto)
+
+    def due(self, now: float = None) -> list:
+        """Сообщения в полете, чей таймер истек"""
+        now = time.time() if now is None else now
+        return [msg for window in self._windows.values() for msg in window.inflight.values() if msg.deadline <= now]
+
+    def exhausted(self, msg: OutgoingMessage, now: float = None) -> bool:
+        now = time.time() if now is None else now
+        return msg.attempts >= self.max_attempts or now - msg.created > self.max_wait
+
+    def drop(self, msg: OutgoingMessage):
+        window = self._windows.get(msg.route_id)
+        if window:
+            window.inflight.pop(msg.message_id, None)
+            if msg in window.waiting: window.waiting.remove(msg)
+        self.stats["failed"] += 1
+        self._drop_empty(msg.route_id)
+
+    def expired_waiting(self, now: float = None) -> list:
+        """Ждущие маршрута дольше max_wait - снимаются"""
+        now = time.time() if now is None else now
+        res = [msg for window in self._windows.values() for msg in window.waiting if now - msg.created > self.max_wait]
+        for msg in res: self.drop(msg)
+        return res
+
+    def fail_route(self, route_id: str) -> list:
+        """Маршрут не найден: все сообщения разговора снимаются"""
+        window = self._windows.pop(route_id, None)
+        if not window: return []
+        res = list(window.inflight.values()) + list(window.waiting)
+        self.stats["failed"] += len(res)
+        return res
+
+    def _drop_empty(self, route_id: str):
+        window = self._windows.get(route_id)
+        # RTO без сообщений не храним: новый разговор начнет с initial_rto
+        if window and not window.inflight and not window.waiting and window.srtt is None:
+            del self._windows[route_id]
+
+    def waiting_routes(self) -> list:
+        """[(route_id, собеседник)] разговоров, где есть неотправленные сообщения"""
+        return [(route_id, window.waiting[0].target_id) for route_id, window in self._windows.items() if window.waiting]
+
+    def queue_ack(self, sender_id: str, message_id: str):
+        self._acks.setdefault(sender_id, []).append(message_id)
+
+    def take_acks(self) -> dict:
+        acks, self._acks = self._acks, {}
+        return acks
+
+    def clear(self):
+        self._windows.clear()
+        self._acks.clear()
+
+    def get_stats(self) -> dict:
+        st = dict(self.stats)
+        st["inflight"] = sum(len(window.inflight) for window in self._windows.values())
+        st["waiting"] = sum(len(window.waiting) for window in self._windows.values())
+        st["routes"] = {
+            route_id[:16]: {"inflight": len(window.inflight), "waiting": len(window.waiting),
+                            "srtt": window.srtt, "rto": window.rto}
+            for route_id, window in list(self._windows.items())[:16]
+        }
+        return st
@@ -0,0 +1,85 @@
+import bisect
+import heapq
+import time
+
+
+class RoutingTable:
+    """
+    Таблица маршрутизации в памяти (Beta-2).
+    Для каждого route_id хранит пути, отсортированные по метрике (multipath),
+    а истекшие записи вытесняет через кучу по expires_at.
+    SQLite используется только как постоянное хранилище (write-behind).
+    """
+    def __init__(self):
+        self._routes = {}  # route_id -> [route, ...] по возрастанию metric
+        self._heap = []    # (expires_at, route_id, next_hop_id)
+        self._paths = 0    # Число путей во всех route_id: len() и порог сжатия кучи без обхода таблицы
+
+    def __len__(self):
+        return self._paths
+
+    def upsert(self, route_id: str, next_hop_id: str, metric: int, is_local: int = 0,
+               remote_user_id: str = None, expires_at: float = 0.0) -> dict:
+        """Добавляет или заменяет путь route_id через next_hop_id."""
+        route = {
+            "route_id": route_id,
+            "next_hop_id": next_hop_id,
+            "metric": metric,
+            "is_local": is_local,
+            "remote_user_id": remote_user_id,
+            "expires_at": expires_at,
+        }
+        paths = self._routes.setdefault(route_id, [])
+        self._remove_path(paths, next_hop_id)
+        bisect.insort(paths, route, key=lambda r: r['metric'])
+        self._paths += 1
+        heapq.heappush(self._heap, (expires_at, route_id, next_hop_id))
+        if len(self._heap) > 2 * len(self) + 64:
+            self._compact()
+        return route
+
+    def get_routes(self, route_id: str, now: float = None) -> list:
+        """Все живые пути для route_id, от лучшего к худшему."""
+        now = time.time() if now is None else now
+        return [route for route in self._routes.get(route_id, ()) if route['expires_at'] > now]
+
+    def get_best(self, route_id: str, now: float = None):
+        now = time.time() if now is None else now
+        for route in self._routes.get(route_id, ()):
+            if route['expires_at'] > now: return route
+        return None
+
+    def all_routes(self, now: float = None) -> list:
+        now = time.time() if now is None else now
+        return [route for paths in self._routes.values() for route in paths if route['expires_at'] > now]
+
+    def expire(self, now: float = None) -> list:
+        """Вытесняет истекшие пути. Возвращает их ключи (route_id, next_hop_id)."""
+        now = time.time() if now is None else now
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, route_id, next_hop_id = heapq.heappop(self._heap)
+            paths = self._routes.get(route_id)
+            if not paths: continue
+            for route in paths:
+                # Запись в куче могла устареть после обновления маршрута
+                if route['next_hop_id'] == next_hop_id and route['expires_at'] == expires_at:
+                    paths.remove(route)
+                    self._paths -= 1
+                    expired.append((route_id, next_hop_id))
+                    break
+            if not paths: del self._routes[route_id]
+        return expired
+
+    def _compact(self):
+        """Пересобирает кучу без записей, устаревших после обновлений маршрутов."""
+        self._heap = [(route['expires_at'], route['route_id'], route['next_hop_id'])
+                      for paths in self._routes.values() for route in paths]
+        heapq.heapify(self._heap)
+
+    def _remove_path(self, paths: list, next_hop_id: str):
+        for i, route in enumerate(paths):
+            if route['next_hop_id'] == next_hop_id:
+                del paths[i]
+                self._paths -= 1
+                return
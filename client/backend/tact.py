@@ -1,64 +1,407 @@
-import asyncio
-import json
-import random
-import string
-import time
-from database import DatabaseManager
-from network import P2PNode
-
-class TactEngine:
-    def __init__(self, db: DatabaseManager, node: P2PNode, interval: float, packet_size: int):
-        self.db = db
-        self.node = node
-        self.interval = interval
-        self.packet_size = packet_size
-        self.running = False
-
-    async def start(self):
-        self.running = True
-        print(f"⏱️ [TACT] Engine started. Tick: {self.interval}s")
-        while self.running:
-            start_time = time.time()
-            await self._tick()
-            elapsed = time.time() - start_time
-            sleep_time = max(0.1, self.interval - elapsed)
-            await asyncio.sleep(sleep_time)
-
-    async def _tick(self):
-        neighbors = list(self.node.active_connections.items())
-        if not neighbors: return
-
-        async with self.db.conn.execute("SELECT id, next_hop_id, packet_json, exclude_peer FROM outbox ORDER BY created_at ASC LIMIT 5") as cursor:
-            rows = await cursor.fetchall()
-
-        if not rows:
-            dummy = self._create_envelope("", is_dummy=True)
-            for _, ws in neighbors:
-                try: await ws.send(dummy)
-                except: pass
-            return
-
-        for row in rows:
-            msg_id, next_hop, payload, exclude_peer = row['id'], row['next_hop_id'], row['packet_json'], row['exclude_peer']
-            envelope = self._create_envelope(payload, is_dummy=False)
-            if next_hop:
-                ws = self.node.active_connections.get(next_hop)
-                if ws:
-                    try: await ws.send(envelope)
-                    except: pass
-            else:
-                for peer_id, ws in neighbors:
-                    if peer_id == exclude_peer: continue # <--- ВОТ ТУТ ЗАЩИТА
-                    try: await ws.send(envelope)
-                    except: pass
-            await self.db.conn.execute("DELETE FROM outbox WHERE id = ?", (msg_id,))
-        await self.db.conn.commit()
-        
-    def _create_envelope(self, payload_str: str, is_dummy: bool) -> str:
-        msg_type = "DUMMY" if is_dummy else "REAL"
-        envelope = { "t": msg_type, "d": payload_str, "x": "" }
-        current_len = len(json.dumps(envelope).encode('utf-8'))
-        padding_needed = self.packet_size - current_len
-        if padding_needed > 0:
-            envelope["x"] = ''.join(random.choices(string.ascii_letters + string.digits, k=padding_needed))
-        return json.dumps(envelope)
\ No newline at end of file
+import asyncio
+import json
+import random
+import string
+import time
+from collections import Counter
+from functools import lru_cache
+from database import DatabaseManager
+from network import P2PNode
+from outbox import PRIORITIES
+import wire
+
+@lru_cache(maxsize=512)
+def _packet_as_json(packet: bytes) -> str:
+    """Бинарный пакет -> JSON-строка для соседей на запасном формате"""
+    return json.dumps(wire.decode_packet(packet))
+
+class FramePacker:
+    """Набивает один кадр такта постоянного размера пакетами для одного соседа."""
+    JSON_OVERHEAD = len(json.dumps({"t": "MUX", "d": [], "x": ""}))
+
+    def __init__(self, capacity: int, wire_format: str = wire.WIRE_BINARY):
+        self.capacity = capacity
+        self.binary = wire_format == wire.WIRE_BINARY
+        self.packets = []
+        # Бинарный кадр несет отметки времени для замера RTT (links.py)
+        self.overhead = wire.FRAME_HEADER.size + wire.FRAME_TIMING.size if self.binary else self.JSON_OVERHEAD
+        self.used = self.overhead
+
+    def cost(self, packet: bytes) -> int:
+        if self.binary:
+            return wire.packet_cost(packet)
+        # Строка экранируется внутри JSON-списка, плюс разделитель ", "
+        return len(json.dumps(_packet_as_json(packet))) + 2
+
+    def fits(self, cost: int) -> bool:
+        # Пакет больше кадра уходит один. Свои сообщения режутся на FRAG (wire.fragment),
+        # такой пакет может прийти только от старой ноды
+        return not self.packets or self.used + cost <= self.capacity
+
+    def add(self, packet: bytes, cost: int):
+        self.packets.append(packet)
+        self.used += cost
+
+    @property
+    def payload_bytes(self) -> int:
+        return self.used - self.overhead
+
+    def build(self):
+        """Готовый кадр: bytes для бинарного формата, str для JSON"""
+        if self.binary:
+            return wire.encode_frame(self.packets, self.capacity, timed=True)
+        msg_type = "MUX" if self.packets else "DUMMY"
+        envelope = { "t": msg_type, "d": [_packet_as_json(pkt) for pkt in self.packets], "x": "" }
+        current_len = len(json.dumps(envelope).encode('utf-8'))
+        padding_needed = self.capacity - current_len
+        if padding_needed > 0:
+            envelope["x"] = ''.join(random.choices(string.ascii_letters + string.digits, k=padding_needed))
+        return json.dumps(envelope)
+
+class FrameBatch:
+    """
+    Кадры одному соседу за такт (не больше max_frames): пакет идет в первый кадр, где есть место.
+    Интерфейс как у FramePacker, чтобы упаковка не знала, сколько кадров в такте.
+    """
+    def __init__(self, capacity: int, wire_format: str, max_frames: int = 1):
+        self.capacity = capacity
+        self.wire_format = wire_format
+        self.max_frames = max_frames
+        self.frames = [FramePacker(capacity, wire_format)]
+
+    @property
+    def binary(self) -> bool:
+        return self.frames[0].binary
+
+    @property
+    def packets(self) -> list:
+        return [pkt for packer in self.frames for pkt in packer.packets]
+
+    def cost(self, packet: bytes) -> int:
+        return self.frames[0].cost(packet)
+
+    def _slot(self, cost: int):
+        for packer in self.frames:
+            if packer.fits(cost): return packer
+        return None
+
+    def fits(self, cost: int) -> bool:
+        return len(self.frames) < self.max_frames or self._slot(cost) is not None
+
+    def add(self, packet: bytes, cost: int):
+        packer = self._slot(cost)
+        if packer is None:
+            packer = FramePacker(self.capacity, self.wire_format)
+            self.frames.append(packer)
+        packer.add(packet, cost)
+
+class AdaptiveRate:
+    """
+    Темп такта по глубине outbox, в заданных границах.
+    Остался хвост после такта - сначала сокращается интервал (до min_interval),
+    потом растет число кадров на соседа за такт (до max_burst).
+    Очередь пуста idle_ticks тактов подряд - откат в обратном порядке, но не реже max_interval:
+    это нижняя граница cover-трафика. Темп общий для всех соседей, каналы остаются одинаковыми.
+    """
+    def __init__(self, interval: float, min_interval: float, max_interval: float, max_burst: int = 1,
+                 idle_ticks: int = 3):
+        self.min_interval = min(min_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.max_burst = max(1, max_burst)
+        self.idle_ticks = idle_ticks
+        self.interval = interval
+        self.burst = 1
+        self._idle = 0
+
+    def update(self, backlog: int):
+        if backlog > 0:
+            self._idle = 0
+            if self.interval > self.min_interval:
+                self.interval = max(self.min_interval, self.interval / 2)
+            elif self.burst < self.max_burst:
+                self.burst += 1
+            return
+        self._idle += 1
+        if self._idle < self.idle_ticks: return
+        self._idle = 0
+        if self.burst > 1:
+            self.burst -= 1
+        elif self.interval < self.max_interval:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+
+    @property
+    def frame_rate(self) -> float:
+        """Кадров в секунду на каждого соседа"""
+        return self.burst / self.interval
+
+class NeighborSender:
+    """
+    Отдельная задача отправки для одного соседа.
+    Такт только кладет кадры в ограниченную очередь, медленный сокет не тормозит остальных.
+    """
+    def __init__(self, peer_id: str, ws, queue_size: int, send_timeout: float, links=None):
+        self.peer_id = peer_id
+        self.ws = ws
+        self.links = links  # LinkMonitor: отметки времени в кадр и исход отправки
+        self.send_timeout = send_timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.misses = 0  # Подряд пропущенных дедлайнов / переполнений очереди
+        self.sent = 0
+        self.timeouts = 0
+        self.dropped = 0
+        self.task = asyncio.create_task(self._run())
+
+    def enqueue(self, frame) -> bool:
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            # Сосед не успевает забирать кадры - кадр теряется
+            self.dropped += 1
+            self.misses += 1
+            if self.links: self.links.on_send(self.peer_id, False)
+            return False
+
+    async def _run(self):
+        while True:
+            frame = await self.queue.get()
+            if self.links and isinstance(frame, bytes):
+                frame = self.links.stamp(self.peer_id, frame)
+            ok = False
+            try:
+                await asyncio.wait_for(self.ws.send(frame), self.send_timeout)
+                self.sent += 1
+                self.misses = 0
+                ok = True
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                self.misses += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.misses += 1
+            if self.links: self.links.on_send(self.peer_id, ok)
+
+    def close(self):
+        self.task.cancel()
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "timeouts": self.timeouts,
+            "dropped": self.dropped,
+            "misses": self.misses,
+        }
+
+class TactEngine:
+    def __init__(self, db: DatabaseManager, node: P2PNode, interval: float, packet_size: int, scan_limit: int = 64,
+                 send_queue_size: int = 4, send_timeout: float = 1.0, degraded_after: int = 3, drop_after: int = 10,
+                 quantum: int = 1024, min_interval: float = None, max_interval: float = None, max_burst: int = 1):
+        self.db = db
+        self.node = node
+        # Без границ темп постоянный: interval и один кадр на соседа
+        self.rate = AdaptiveRate(interval, min_interval or interval, max_interval or interval, max_burst)
+        self.packet_size = packet_size
+        self.scan_limit = scan_limit
+        self.quantum = quantum  # DRR: байт на источник за круг
+        self.running = False
+
+        # Отправка кадров: по задаче на соседа, с дедлайном на каждую отправку
+        self.send_queue_size = send_queue_size
+        self.send_timeout = send_timeout
+        self.degraded_after = degraded_after
+        self.drop_after = drop_after
+        self.senders = {}
+
+        # Метрики заполнения кадров и ровности такта
+        self.stats = {"frames": 0, "real_frames": 0, "packets": 0, "payload_bytes": 0,
+                      "tick_jitter_ms": 0.0, "max_tick_jitter_ms": 0.0}
+        self.deferred = Counter()  # source -> пакето-тактов ожидания в очереди
+        # Хвост доступных к отправке пакетов после такта и скорость разгребания (EWMA, пакетов/с)
+        self.backlog = 0
+        self.drain_rate = 0.0
+
+    def get_stats(self) -> dict:
+        st = dict(self.stats)
+        real_capacity = st["real_frames"] * self.packet_size
+        st["fill_ratio"] = st["payload_bytes"] / real_capacity if real_capacity else 0.0
+        st["packets_per_frame"] = st["packets"] / st["real_frames"] if st["real_frames"] else 0.0
+        st["neighbors"] = {peer_id: sender.get_stats() for peer_id, sender in self.senders.items()}
+        st["degraded"] = list(self.node.degraded_peers)
+        st["deferred_by_source"] = dict(self.deferred.most_common(16))
+        st["interval"] = self.rate.interval
+        st["frames_per_tick"] = self.rate.burst
+        st["frame_rate"] = self.rate.frame_rate
+        st["min_cover_rate"] = 1 / self.rate.max_interval
+        st["outbox_depth"] = len(self.node.outbox)
+        st["backlog"] = self.backlog
+        st["drain_rate"] = self.drain_rate
+        st["drain_time"] = self.backlog / self.drain_rate if self.drain_rate else (0.0 if not self.backlog else None)
+        return st
+
+    async def start(self):
+        self.running = True
+        print(f"⏱️ [TACT] Engine started. Tick: {self.rate.interval}s "
+              f"(adaptive {self.rate.min_interval}-{self.rate.max_interval}s, up to {self.rate.max_burst} frames)")
+        last_start = None
+        scheduled = self.rate.interval
+        while self.running:
+            start_time = time.time()
+            if last_start is not None:
+                self._record_jitter(start_time - last_start, scheduled)
+            last_start = start_time
+            try:
+                await self._tick()
+            except Exception as e:
+                # Один плохой пакет не должен останавливать такт (и cover-трафик) навсегда
+                print(f"❌ [TACT] Tick error: {e}")
+            # Темп следующего такта уже учитывает хвост этого
+            scheduled = self.rate.interval
+            elapsed = time.time() - start_time
+            sleep_time = max(0.1, scheduled - elapsed)
+            await asyncio.sleep(sleep_time)
+
+    def _record_jitter(self, actual_interval: float, scheduled: float):
+        jitter_ms = abs(actual_interval - scheduled) * 1000
+        # EWMA, чтобы видеть тренд, а не единичные всплески
+        self.stats["tick_jitter_ms"] = 0.9 * self.stats["tick_jitter_ms"] + 0.1 * jitter_ms
+        self.stats["max_tick_jitter_ms"] = max(self.stats["max_tick_jitter_ms"], jitter_ms)
+
+    def _sync_senders(self, neighbors: dict):
+        """Создает задачи отправки для новых соседей и закрывает для ушедших."""
+        for peer_id in list(self.senders):
+            sender = self.senders[peer_id]
+            if neighbors.get(peer_id) is not sender.ws:
+                sender.close()
+                del self.senders[peer_id]
+        for peer_id, ws in neighbors.items():
+            if peer_id not in self.senders:
+                # Очередь рассчитана на максимальную пачку кадров за такт
+                self.senders[peer_id] = NeighborSender(peer_id, ws, self.send_queue_size * self.rate.max_burst,
+                                                       self.send_timeout, self.node.links)
+
+    def _check_senders(self):
+        """Помечает деградировавших соседей и отключает безнадежных."""
+        for peer_id, sender in list(self.senders.items()):
+            if sender.misses >= self.drop_after:
+                sender.close()
+                del self.senders[peer_id]
+                self.node.drop_connection(peer_id)
+            elif sender.misses >= self.degraded_after:
+                self.node.degraded_peers.add(peer_id)
+            else:
+                self.node.degraded_peers.discard(peer_id)
+
+    async def _tick(self):
+        neighbors = dict(self.node.active_connections)
+        self._sync_senders(neighbors)
+        if not neighbors: return
+
+        # Каждому соседу ровно burst кадров за такт: пакеты упаковываются (first-fit)
+        # по классам приоритета, что не влезло - ждет следующего такта
+        burst = self.rate.burst
+        frames = {
+            peer_id: FrameBatch(self.packet_size, self.node.wire_formats.get(peer_id, wire.WIRE_JSON), burst)
+            for peer_id in neighbors
+        }
+        outbox = self.node.outbox
+        sent = []
+        self.backlog = 0
+        for priority in PRIORITIES:
+            # Адресные пакеты: у каждого соседа своя подочередь
+            for peer_id, packer in frames.items():
+                queue = outbox.unicast(peer_id, priority)
+                if queue: sent.extend(self._drr(queue, lambda entry, packer=packer: self._pack_unicast(packer, entry)))
+            # Широковещательные: пакет должен влезть во все кадры сразу
+            queue = outbox.broadcast(priority)
+            if queue: sent.extend(self._drr(queue, lambda entry: self._pack_broadcast(frames, entry)))
+
+        # Такт только раздает кадры по очередям, отправка идет параллельно
+        dummies = {}
+        for peer_id in neighbors:
+            batch = frames[peer_id]
+            for i in range(burst):
+                packer = batch.frames[i] if i < len(batch.frames) else None
+                if packer and packer.packets:
+                    frame = packer.build()
+                    self.stats["real_frames"] += 1
+                    self.stats["packets"] += len(packer.packets)
+                    self.stats["payload_bytes"] += packer.payload_bytes
+                else:
+                    # Один DUMMY на формат за такт, пустые места пачки добиваются им же
+                    if batch.binary not in dummies: dummies[batch.binary] = FramePacker(self.packet_size, batch.wire_format).build()
+                    frame = dummies[batch.binary]
+                self.stats["frames"] += 1
+                self.senders[peer_id].enqueue(frame)
+        self._check_senders()
+
+        # Подстройка темпа по хвосту, который остался в доступных подочередях
+        interval = self.rate.interval
+        self.drain_rate = 0.8 * self.drain_rate + 0.2 * (len(sent) / interval)
+        self.rate.update(self.backlog)
+
+        # Отправленные - из памяти сразу, из журнала одной операцией группового коммита
+        await outbox.remove(sent)
+
+    def _drr(self, queue, pack) -> list:
+        """
+        Deficit Round Robin по источникам подочереди: за круг каждый поток получает quantum байт.
+        Шумный источник забирает не больше своей доли кадра, остальные потоки не ждут его хвост.
+        pack(entry) кладет пакет в кадр(ы) и возвращает False, если он не влез.
+        Порядок внутри потока сохраняется; подочередь не меняется до outbox.remove().
+        """
+        taken = []
+        taken_by_flow = {}
+        blocked = set()
+
+        def eligible(source) -> bool:
+            pos = taken_by_flow.get(source, 0)
+            return source not in blocked and pos < min(len(queue.flows[source]), self.scan_limit)
+
+        while True:
+            sources = [source for source in queue.flows if eligible(source)]
+            if not sources: break
+            for source in sources:
+                flow = queue.flows[source]
+                pos = taken_by_flow.get(source, 0)
+                # Квант за круг; заблокированный поток не копит его бесконечно
+                cap = self.quantum + max(self.packet_size, len(flow[pos].packet))
+                queue.deficit[source] = min(queue.deficit[source] + self.quantum, cap)
+                while pos < min(len(flow), self.scan_limit):
+                    entry = flow[pos]
+                    if len(entry.packet) > queue.deficit[source]: break
+                    if not pack(entry):
+                        blocked.add(source)
+                        break
+                    queue.deficit[source] -= len(entry.packet)
+                    taken.append(entry)
+                    pos += 1
+                taken_by_flow[source] = pos
+                # Обслуженный поток уходит в конец: следующий такт начнет с другого
+                queue.flows.move_to_end(source)
+
+        # Сколько пакетов каждого источника осталось ждать следующего такта
+        for source, flow in queue.flows.items():
+            waiting = len(flow) - taken_by_flow.get(source, 0)
+            if waiting > 0:
+                self.deferred[source] += waiting
+                self.backlog += waiting
+        return taken
+
+    @staticmethod
+    def _pack_unicast(packer: FramePacker, entry) -> bool:
+        cost = packer.cost(entry.packet)
+        if not packer.fits(cost): return False
+        packer.add(entry.packet, cost)
+        return True
+
+    @staticmethod
+    def _pack_broadcast(frames: dict, entry) -> bool:
+        targets = [peer_id for peer_id in frames if peer_id != entry.exclude_peer] # <--- ВОТ ТУТ ЗАЩИТА
+        costs = {peer_id: frames[peer_id].cost(entry.packet) for peer_id in targets}
+        if not all(frames[peer_id].fits(costs[peer_id]) for peer_id in targets):
+            return False
+        for peer_id in targets:
+            frames[peer_id].add(entry.packet, costs[peer_id])
+        return True
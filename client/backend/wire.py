@@ -0,0 +1,234 @@
+import os
+import json
+import uuid
+import base64
+import struct
+
+# --- D-MASH WIRE FORMAT (v1) ---
+# Пакет:  [заголовок фиксированной длины][тело]
+# Кадр:   [заголовок кадра][len|пакет]...[случайный паддинг до PACKET_SIZE]
+# JSON-конверты остаются запасным вариантом, если сосед не умеет бинарный формат.
+
+WIRE_VERSION = 1
+WIRE_BINARY = "bin1"
+WIRE_JSON = "json"
+SUPPORTED_WIRE = [WIRE_BINARY, WIRE_JSON]
+
+# REFRESH: пакет без тела по пути DATA, продлевает маршрут на каждом хопе
+# FRAG: кусок сообщения, не помещающегося в кадр; идет по пути DATA, собирается у получателя
+TYPE_CODES = {"PROBE": 1, "DATA": 2, "REFRESH": 3, "FRAG": 4}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+# Пакеты по пути DATA (по route_id к собеседнику): при перегрузке не теряются, в отличие от PROBE
+DATA_PATH_TYPES = frozenset({"DATA", "FRAG", "REFRESH"})
+
+# версия, тип, id (uuid), route_id (blake3), ttl, metric
+HEADER = struct.Struct("!BB16s32sBH")
+TYPE_OFFSET = 1
+TTL_OFFSET = 50
+METRIC_OFFSET = 51
+
+# Тело PROBE: rev_id, target_hash, подпись (Ed25519), длина auth; дальше auth и E2EE контент
+PROBE_BODY = struct.Struct("!32s32s64sH")
+
+# Тело FRAG: id сообщения (группа), номер фрагмента, число фрагментов; дальше кусок шифротекста
+FRAG_BODY = struct.Struct("!16sHH")
+
+# Кадр такта: версия, вид, число пакетов
+FRAME_HEADER = struct.Struct("!BBH")
+FRAME_DUMMY = 0
+FRAME_MUX = 1
+# Флаг вида кадра: в последних байтах - отметки времени для RTT (links.py).
+# Старые декодеры смотрят только на число пакетов и хвост кадра не читают.
+FRAME_TIMED = 0x80
+# ts отправителя (мс), эхо последнего ts соседа, сколько эхо пролежало у отправителя (мс)
+FRAME_TIMING = struct.Struct("!IIH")
+LEN_PREFIX = struct.Struct("!H")
+
+class WireError(ValueError):
+    pass
+
+# --- ПАКЕТЫ ---
+
+def encode_packet(packet: dict) -> bytes:
+    """dict пакета (как в JSON-формате) -> бинарный пакет"""
+    pkt_type = TYPE_CODES[packet['type']]
+    header = HEADER.pack(
+        WIRE_VERSION, pkt_type,
+        uuid.UUID(packet['id']).bytes,
+        bytes.fromhex(packet['route_id']),
+        packet.get('ttl', 0), packet.get('metric', 0)
+    )
+    content = base64.b64decode(packet['content']) if packet.get('content') else b""
+    if pkt_type == TYPE_CODES["PROBE"]:
+        auth = base64.b64decode(packet['auth']) if packet.get('auth') else b""
+        body = PROBE_BODY.pack(
+            bytes.fromhex(packet['rev_id']),
+            bytes.fromhex(packet['target_hash']),
+            base64.b64decode(packet['sig']),
+            len(auth)
+        ) + auth + content
+    elif pkt_type == TYPE_CODES["FRAG"]:
+        body = FRAG_BODY.pack(uuid.UUID(packet['group']).bytes, packet['seq'], packet['count']) + content
+    else:
+        body = content
+    return header + body
+
+def decode_header(data: bytes) -> dict:
+    """
+    Дешевый разбор: только фиксированные поля (для ретрансляции).
+    Шифротекст, auth и подпись не трогаются.
+    """
+    if len(data) < HEADER.size:
+        raise WireError("Packet too short")
+    version, pkt_type, pkt_id, route_id, ttl, metric = HEADER.unpack_from(data)
+    if version != WIRE_VERSION:
+        raise WireError(f"Unsupported wire version {version}")
+    if pkt_type not in TYPE_NAMES:
+        raise WireError(f"Unknown packet type {pkt_type}")
+    packet = {
+        "type": TYPE_NAMES[pkt_type],
+        "id": str(uuid.UUID(bytes=pkt_id)),
+        "route_id": route_id.hex(),
+        "ttl": ttl,
+        "metric": metric,
+    }
+    if pkt_type == TYPE_CODES["PROBE"]:
+        rev_id, target_hash, _, _ = PROBE_BODY.unpack_from(data, HEADER.size)
+        packet["rev_id"] = rev_id.hex()
+        packet["target_hash"] = target_hash.hex()
+    return packet
+
+def decode_packet(data: bytes) -> dict:
+    """Полный разбор пакета в dict (для доставки и отладки)"""
+    packet = decode_header(data)
+    offset = HEADER.size
+    if packet['type'] == "PROBE":
+        _, _, sig, auth_len = PROBE_BODY.unpack_from(data, offset)
+        offset += PROBE_BODY.size
+        packet["sig"] = base64.b64encode(sig).decode()
+        packet["auth"] = base64.b64encode(data[offset:offset + auth_len]).decode()
+        offset += auth_len
+    elif packet['type'] == "FRAG":
+        group, seq, count = FRAG_BODY.unpack_from(data, offset)
+        offset += FRAG_BODY.size
+        packet.update(group=str(uuid.UUID(bytes=group)), seq=seq, count=count)
+    content = data[offset:]
+    packet["content"] = base64.b64encode(content).decode() if content else ""
+    return packet
+
+def fragment(packet: dict, frame_size: int) -> list:
+    """
+    DATA, не помещающийся в бинарный кадр frame_size, -> FRAG-пакеты ровно на кадр (каждый со своим id,
+    группа - id исходного пакета). Помещается - [packet] как есть.
+    """
+    content = base64.b64decode(packet['content']) if packet.get('content') else b""
+    count = fragment_count(len(content), frame_size)
+    if count == 1: return [packet]
+    chunk = fragment_chunk(frame_size)
+    if count > 0xFFFF:
+        raise WireError("Message too large")
+    return [{
+        "type": "FRAG", "id": str(uuid.uuid4()), "route_id": packet['route_id'], "ttl": packet.get('ttl', 0),
+        "group": packet['id'], "seq": seq, "count": count,
+        "content": base64.b64encode(content[seq * chunk:(seq + 1) * chunk]).decode()
+    } for seq in range(count)]
+
+def fragment_chunk(frame_size: int) -> int:
+    """Байт шифротекста в одном FRAG"""
+    return frame_room(frame_size) - HEADER.size - FRAG_BODY.size
+
+def fragment_count(content_len: int, frame_size: int) -> int:
+    """Сколько пакетов займет DATA с content_len байт шифротекста (1 - без фрагментации)"""
+    if content_len <= frame_room(frame_size) - HEADER.size: return 1
+    return -(-content_len // fragment_chunk(frame_size))
+
+def packet_type(data: bytes):
+    """Тип пакета по одному байту заголовка ("PROBE"/"DATA"/... или None)"""
+    return TYPE_NAMES.get(data[TYPE_OFFSET]) if len(data) >= HEADER.size else None
+
+def patch_header(data: bytes, ttl: int, metric: int) -> bytes:
+    """Меняет ttl/metric на месте, без разбора тела"""
+    buf = bytearray(data)
+    struct.pack_into("!BH", buf, TTL_OFFSET, ttl, metric)
+    return bytes(buf)
+
+# --- КАДРЫ ТАКТА ---
+
+def encode_frame(packets: list, frame_size: int, timed: bool = False) -> bytes:
+    """
+    Упаковывает пакеты в кадр и добивает случайными байтами до frame_size.
+    timed: последние FRAME_TIMING.size байт - место под отметки времени (stamp_frame).
+    """
+    kind = (FRAME_MUX if packets else FRAME_DUMMY) | (FRAME_TIMED if timed else 0)
+    parts = [FRAME_HEADER.pack(WIRE_VERSION, kind, len(packets))]
+    for pkt in packets:
+        parts.append(LEN_PREFIX.pack(len(pkt)))
+        parts.append(pkt)
+    frame = b"".join(parts)
+    tail = FRAME_TIMING.size if timed else 0
+    if len(frame) + tail < frame_size:
+        frame += os.urandom(frame_size - tail - len(frame))
+    if timed:
+        frame += bytes(tail)
+    return frame
+
+def decode_frame(data: bytes) -> list:
+    """Кадр -> список бинарных пакетов (пустой для DUMMY)"""
+    if len(data) < FRAME_HEADER.size:
+        raise WireError("Frame too short")
+    version, kind, count = FRAME_HEADER.unpack_from(data)
+    if version != WIRE_VERSION:
+        raise WireError(f"Unsupported wire version {version}")
+    if kind & ~FRAME_TIMED == FRAME_DUMMY:
+        return []
+    packets = []
+    offset = FRAME_HEADER.size
+    for _ in range(count):
+        (length,) = LEN_PREFIX.unpack_from(data, offset)
+        offset += LEN_PREFIX.size
+        if offset + length > len(data):
+            raise WireError("Truncated frame")
+        packets.append(data[offset:offset + length])
+        offset += length
+    return packets
+
+def frame_timing(data: bytes):
+    """(ts, echo_ts, echo_delay) из кадра с FRAME_TIMED, иначе None"""
+    if len(data) < FRAME_HEADER.size + FRAME_TIMING.size or not data[1] & FRAME_TIMED:
+        return None
+    return FRAME_TIMING.unpack_from(data, len(data) - FRAME_TIMING.size)
+
+def stamp_frame(data: bytes, ts: int, echo_ts: int, echo_delay: int) -> bytes:
+    """Копия кадра с отметками времени (кадр может быть общим DUMMY для всех соседей)"""
+    buf = bytearray(data)
+    FRAME_TIMING.pack_into(buf, len(buf) - FRAME_TIMING.size, ts, echo_ts, min(echo_delay, 0xFFFF))
+    return bytes(buf)
+
+def packet_cost(packet: bytes) -> int:
+    return LEN_PREFIX.size + len(packet)
+
+def frame_room(frame_size: int) -> int:
+    """Наибольший пакет, который один помещается в бинарный кадр frame_size"""
+    return frame_size - FRAME_HEADER.size - FRAME_TIMING.size - LEN_PREFIX.size
+
+# --- HANDSHAKE ---
+
+def make_hello(my_id: str, wire) -> str:
+    """Приветствие с ID и списком (или выбранным) форматов"""
+    return json.dumps({"id": my_id, "wire": wire})
+
+def parse_hello(message: str):
+    """Возвращает (peer_id, wire). Для старых нод (голый ID) wire = None."""
+    try:
+        hello = json.loads(message)
+    except (TypeError, ValueError):
+        return message, None
+    if not isinstance(hello, dict) or "id" not in hello:
+        return message, None
+    return hello["id"], hello.get("wire")
+
+def choose_wire(offered) -> str:
+    if isinstance(offered, str): offered = [offered]
+    for fmt in SUPPORTED_WIRE:
+        if offered and fmt in offered: return fmt
+    return WIRE_JSON
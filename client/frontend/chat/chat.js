@@ -1,6 +1,14 @@
 let currentChatId = null;
 let peersMap = {}; 
+// Keyset-пагинация истории: id самого старого и самого нового загруженного сообщения
+let oldestMsgId = null;
+let lastMsgId = null;
+let hasOlder = false;
+let loadingOlder = false;
+const PAGE_SIZE = 50;
 const myId = localStorage.getItem('my_id');
+// Отметки своих сообщений; у сообщений до появления статусов (status = null) - просто ✓
+const STATUS_MARKS = {queued: '🕓', sent: '✓', delivered: '✓✓', failed: '⚠'};
 
 async function init() {
     if (!myId) {
@@ -10,9 +18,39 @@ async function init() {
     // Визуально показываем короткий, но сохраняем полный в памяти
     document.getElementById('my-id').innerText = `ID: ${myId.substring(0, 16)}... (Click to Copy)`;
     
+    document.getElementById('messages').addEventListener('scroll', onMessagesScroll);
+    
     updateState();
-    setInterval(updateState, 2000);
-    setInterval(refreshMessages, 1000);
+    subscribeEvents();
+}
+
+// Push-канал: бекенд сам сообщает о новых сообщениях и соседях, опроса по таймеру нет
+let stateTimer = null;
+function scheduleUpdateState() {
+    // Несколько событий подряд - один запрос к /api/state и /api/peers
+    if (stateTimer) return;
+    stateTimer = setTimeout(() => { stateTimer = null; updateState(); }, 200);
+}
+
+function subscribeEvents() {
+    const events = new EventSource('/api/events');
+    // После (пере)подключения события за время разрыва потеряны - перечитываем все
+    events.addEventListener('hello', () => { scheduleUpdateState(); refreshMessages(); });
+    events.addEventListener('resync', () => { scheduleUpdateState(); refreshMessages(); });
+    events.addEventListener('peer', scheduleUpdateState);
+    events.addEventListener('contacts', scheduleUpdateState);
+    events.addEventListener('status', (e) => {
+        // Статус своего сообщения (отправлено, доставлено по ACK, не доставлено) - правим отметку на месте
+        const ev = JSON.parse(e.data);
+        const mark = document.querySelector(`.msg-status[data-packet="${ev.packet_id}"]`);
+        if (mark && STATUS_MARKS[ev.status]) mark.innerText = STATUS_MARKS[ev.status];
+        scheduleUpdateState();
+    });
+    events.addEventListener('message', (e) => {
+        const ev = JSON.parse(e.data);
+        if (ev.chat_id === currentChatId) refreshMessages();
+        scheduleUpdateState();
+    });
 }
 
 async function logout() {
@@ -85,6 +123,9 @@ async function startChat(targetId = null) {
     }
     
     currentChatId = targetId;
+    oldestMsgId = null;
+    lastMsgId = null;
+    hasOlder = false;
     document.getElementById('chatHeader').style.display = 'flex';
     document.getElementById('messages').innerHTML = '';
     
@@ -111,48 +152,82 @@ async function startChat(targetId = null) {
     refreshMessages();
 }
 
+function renderMessage(m) {
+    const time = new Date(m.timestamp).toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
+    const status = m.is_outgoing
+        ? `<span class="msg-status" data-packet="${m.packet_id}">${STATUS_MARKS[m.status] || '✓'}</span>` : '';
+    return `
+        <div class="msg ${m.is_outgoing ? 'me' : 'other'}" data-id="${m.id}">
+            ${m.content}
+            <div style="font-size: 9px; opacity: 0.5; text-align: right; margin-top: 3px;">${time} ${status}</div>
+        </div>
+    `;
+}
+
+async function fetchMessages(chatId, params) {
+    const query = new URLSearchParams({limit: PAGE_SIZE, ...params});
+    return await fetch(`/api/messages/${chatId}?${query}`).then(res => res.json()).catch(() => []);
+}
+
 async function refreshMessages() {
     if(!currentChatId) return;
+    const chatId = currentChatId;
     
-    const res = await fetch(`/api/messages/${currentChatId}`);
-    const msgs = await res.json();
-    
+    // Первый запрос - последняя страница, дальше только новые сообщения после lastMsgId
+    const firstLoad = lastMsgId === null;
     const container = document.getElementById('messages');
     const isAtBottom = container.scrollHeight - container.scrollTop <= container.clientHeight + 50;
+    let params = firstLoad ? {} : {after: lastMsgId};
+    while (true) {
+        const msgs = await fetchMessages(chatId, params);
+        if (chatId !== currentChatId) return;
+        // Пока шел запрос, этот же диапазон мог прийти другим вызовом
+        const fresh = msgs.filter(m => lastMsgId === null || m.id > lastMsgId);
+        if (fresh.length) {
+            container.insertAdjacentHTML('beforeend', fresh.map(renderMessage).join(''));
+            lastMsgId = fresh[fresh.length - 1].id;
+            if (firstLoad && oldestMsgId === null) {
+                oldestMsgId = fresh[0].id;
+                hasOlder = msgs.length >= PAGE_SIZE;
+            }
+        }
+        // Полная страница новых - за ней могут быть еще (много сообщений между событиями или за разрыв SSE)
+        if (!params.after || msgs.length < PAGE_SIZE) break;
+        params = {after: lastMsgId};
+    }
+    if (lastMsgId === null) return;
 
-    const newHtml = msgs.map(m => {
-        const time = new Date(m.timestamp).toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
-        const status = m.is_outgoing ? '✓' : '';
-        return `
-            <div class="msg ${m.is_outgoing ? 'me' : 'other'}">
-                ${m.content}
-                <div style="font-size: 9px; opacity: 0.5; text-align: right; margin-top: 3px;">${time} ${status}</div>
-            </div>
-        `;
-    }).join('');
-
-    // Проверяем, есть ли новые сообщения (простая проверка по количеству)
-    const hasNewMessages = container.querySelectorAll('.msg').length < msgs.length;
+    // Прочитанными сообщения помечает сам бекенд при выдаче страницы
+    if (isAtBottom || firstLoad) {
+        container.scrollTop = container.scrollHeight;
+    }
+}
 
-    if (container.innerHTML.length !== newHtml.length) {
-        container.innerHTML = newHtml;
-        if (isAtBottom) {
-            container.scrollTop = container.scrollHeight;
-        }
+async function loadOlderMessages() {
+    if (!currentChatId || !hasOlder || loadingOlder || oldestMsgId === null) return;
+    const chatId = currentChatId;
+    loadingOlder = true;
+    try {
+        const msgs = await fetchMessages(chatId, {before: oldestMsgId});
+        if (chatId !== currentChatId) return;
+        hasOlder = msgs.length >= PAGE_SIZE;
+        if (!msgs.length) return;
 
-        // --- ИСПРАВЛЕНИЕ ЗДЕСЬ ---
-        // Если мы в этом чате и появились новые сообщения,
-        // немедленно сообщаем бекенду, что мы их прочитали.
-        if (hasNewMessages) {
-            await fetch('/api/read_chat', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({ chat_id: currentChatId })
-            });
-        }
+        // Сохраняем позицию прокрутки, чтобы страница не прыгала
+        const container = document.getElementById('messages');
+        const prevHeight = container.scrollHeight;
+        container.insertAdjacentHTML('afterbegin', msgs.map(renderMessage).join(''));
+        container.scrollTop += container.scrollHeight - prevHeight;
+        oldestMsgId = msgs[0].id;
+    } finally {
+        loadingOlder = false;
     }
 }
 
+function onMessagesScroll() {
+    if (document.getElementById('messages').scrollTop < 100) loadOlderMessages();
+}
+
 function showConnect() {
     document.getElementById('connectModal').style.display = 'flex';
 }
@@ -200,7 +275,6 @@ async function send() {
     
     document.getElementById('msgInput').value = '';
     refreshMessages();
-    setTimeout(updateState, 500);
 }
 
 // ДОБАВЬ ЭТУ ФУНКЦИЮ В КОНЕЦ